@@ -0,0 +1,132 @@
+"""
+Runs a batch of commands at once in one process, reading all of their pipes
+with select() instead of a thread or a worker per command.
+"""
+import collections
+import os
+import select
+import subprocess
+import time
+
+import six
+
+
+# commands a batch runs at once unless it asks for a different number
+DEFAULT_MAX_PARALLEL = 16
+
+# most commands a batch may run at once, each of which takes two pipes
+MAX_PARALLEL = 64
+
+READ_SIZE = 65536
+
+
+def max_parallel_for(max_parallel):
+    """
+    Returns how many commands a batch asking for max_parallel runs at once.
+    """
+    return max(1, min(max_parallel or DEFAULT_MAX_PARALLEL, MAX_PARALLEL))
+
+
+class RunningCommand(object):
+    def __init__(self, index, process, started, spawned):
+        self.index = index
+        self.process = process
+        self.started = started
+        self.spawned = spawned
+
+        self.output = {'stdout': [], 'stderr': []}
+        # pipes which haven't reached EOF yet
+        self.open_pipes = 2
+
+    def result(self):
+        return (b''.join(self.output['stdout']), b''.join(self.output['stderr']),
+            self.process.wait())
+
+
+class CommandBatch(object):
+    """
+    Runs commands up to max_parallel at a time. run() calls
+    finished(index, result, started, spawned) as each one finishes, with
+    (stdout, stderr, returncode) as the result, or the exception raised when
+    it couldn't be started.
+    """
+
+    def __init__(self, commands, env=None, cwd=None, max_parallel=None):
+        self.env = env
+        self.cwd = cwd
+        self.max_parallel = max_parallel_for(max_parallel)
+
+        self._pending = collections.deque(enumerate(commands))
+        self._running = 0
+        # (command, pipe, stream) by the pipe's fd
+        self._pipes = {}
+
+    def _spawn(self, command):
+        shell = isinstance(command, six.string_types)
+
+        return subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, env=self.env, cwd=self.cwd)
+
+    def _start(self, finished):
+        while self._pending and self._running < self.max_parallel:
+            index, command = self._pending.popleft()
+
+            started = time.time()
+
+            try:
+                process = self._spawn(command)
+            except Exception as e:
+                finished(index, e, started, None)
+                continue
+
+            running = RunningCommand(index, process, started, time.time())
+            self._running += 1
+
+            self._pipes[process.stdout.fileno()] = running, process.stdout, 'stdout'
+            self._pipes[process.stderr.fileno()] = running, process.stderr, 'stderr'
+
+    def _read(self, fd, finished):
+        running, pipe, stream = self._pipes[fd]
+
+        chunk = os.read(fd, READ_SIZE)
+
+        if chunk:
+            running.output[stream].append(chunk)
+            return
+
+        pipe.close()
+        del self._pipes[fd]
+
+        running.open_pipes -= 1
+
+        if not running.open_pipes:
+            self._running -= 1
+            finished(running.index, running.result(), running.started, running.spawned)
+
+    def run(self, finished):
+        try:
+            self._start(finished)
+
+            while self._pipes:
+                readable, writable, exceptional = select.select(list(self._pipes), [], [])
+
+                for fd in readable:
+                    self._read(fd, finished)
+
+                self._start(finished)
+        finally:
+            # the client went away, don't leave the commands running
+            self.kill()
+
+    def kill(self):
+        running = set(command for command, pipe, stream in self._pipes.values())
+
+        for command in running:
+            if command.process.poll() is None:
+                command.process.kill()
+            command.process.wait()
+
+        for command, pipe, stream in self._pipes.values():
+            pipe.close()
+
+        self._pipes.clear()
@@ -0,0 +1,719 @@
+"""
+Benchmarks for errand-boy.
+
+python -m errand_boy.bench --output results.json
+
+Each suite measures one layer:
+
+framing     send_algo/recv_algo and their binary counterparts, in memory
+serializers dumps/loads of a run_cmd() result with each serializer
+mock        MockTransport round trips, without sockets or commands
+unixsocket  UNIXSocketTransport.run_cmd against a server started for the run,
+            at each concurrency level and output size
+tcpsocket   the same with TCPSocketTransport, over loopback
+memory      subprocess.Popen against run_cmd from a parent with a large RSS,
+            with the peak RSS/PSS of the process tree and page faults taken.
+            Linux only, and only run when asked for with --suite=memory
+
+Results are printed as a table, and written as JSON with --output so runs can
+be compared.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import six
+
+from . import __version__
+from . import serializers
+from .transports.base import BaseTransport
+from .transports.tcpsocket import TCPSocketTransport
+from .transports.unixsocket import UNIXSocketTransport
+
+
+SUITES = ('framing', 'serializers', 'mock', 'unixsocket', 'tcpsocket', 'memory')
+# memory allocates a large parent, only run it when asked for
+DEFAULT_SUITES = ('framing', 'serializers', 'mock', 'unixsocket', 'tcpsocket')
+
+PAGE_SIZE = 4096
+
+MB = 1024 * 1024
+
+TABLE_COLUMNS = ['suite', 'name', 'framing', 'serializer', 'concurrency', 'size', 'count',
+    'ops_per_sec', 'p50', 'p99']
+MEMORY_TABLE_COLUMNS = ['name', 'concurrency', 'count', 'ops_per_sec', 'p50', 'p99',
+    'peak_rss', 'peak_pss', 'minor_faults', 'major_faults', 'server_pss',
+    'pss_per_process']
+
+# the highest resolution clock available
+clock = getattr(time, 'perf_counter', time.time)
+
+# runs a server on the socket path given as the first argument
+SERVER_SCRIPT = '''
+import sys
+from errand_boy.transports.unixsocket import UNIXSocketTransport
+UNIXSocketTransport(socket_path=sys.argv[1]).run_server(pool_size=int(sys.argv[2]), max_accepts=0)
+'''
+
+# runs a server on the loopback port given as the first argument
+TCP_SERVER_SCRIPT = '''
+import sys
+from errand_boy.transports.tcpsocket import TCPSocketTransport
+TCPSocketTransport(port=int(sys.argv[1])).run_server(pool_size=int(sys.argv[2]), max_accepts=0)
+'''
+
+
+def percentile(samples, fraction):
+    """
+    Nearest-rank percentile of samples, which must be sorted.
+    """
+    if not samples:
+        return None
+
+    index = int(math.ceil(fraction * len(samples))) - 1
+
+    return samples[min(max(index, 0), len(samples) - 1)]
+
+
+def summarize(samples, elapsed):
+    """
+    Summarizes per-operation durations, in seconds, from a run which took
+    elapsed seconds of wall time.
+    """
+    samples = sorted(samples)
+
+    return {
+        'count': len(samples),
+        'elapsed': elapsed,
+        'ops_per_sec': len(samples) / elapsed if elapsed else None,
+        'mean': sum(samples) / len(samples) if samples else None,
+        'min': samples[0] if samples else None,
+        'p50': percentile(samples, 0.5),
+        'p90': percentile(samples, 0.9),
+        'p99': percentile(samples, 0.99),
+        'max': samples[-1] if samples else None,
+    }
+
+
+def time_calls(func, iterations):
+    samples = []
+
+    started = clock()
+
+    for i in six.moves.range(iterations):
+        before = clock()
+        func()
+        samples.append(clock() - before)
+
+    return samples, clock() - started
+
+
+def framing_funcs(transport, framing, body):
+    """
+    Returns functions which write a message with body to a list, and read
+    it back.
+    """
+    sent = []
+
+    def send(connection, data):
+        sent.append(data)
+
+    def recv(connection, length):
+        return connection.read(length)
+
+    def recv_into(connection, buf):
+        return connection.readinto(buf)
+
+    if framing == 'text':
+        def send_message():
+            transport.send_algo(None, send, '200 OK', body=body)
+
+        read_message = transport.recv_algo
+    else:
+        def send_message():
+            transport.send_binary_algo(None, send, status=200, body=body)
+
+        read_message = transport.recv_binary_algo
+
+    # keep one message to read back
+    send_message()
+    message = sent.pop()
+
+    def write():
+        send_message()
+        del sent[:]
+
+    def read():
+        read_message(io.BytesIO(message), recv, recv_into)
+
+    return write, read
+
+
+def bench_framing(iterations, sizes):
+    transport = BaseTransport()
+
+    results = []
+
+    for size in sizes:
+        body = b'a' * size
+
+        for framing in ('text', 'binary'):
+            write, read = framing_funcs(transport, framing, body)
+
+            for operation, func in (('send', write), ('recv', read)):
+                samples, elapsed = time_calls(func, iterations)
+
+                result = {'suite': 'framing', 'name': operation, 'framing': framing,
+                    'size': size}
+                result.update(summarize(samples, elapsed))
+                results.append(result)
+
+    return results
+
+
+def bench_serializers(iterations, sizes):
+    results = []
+
+    for size in sizes:
+        obj = (b'a' * size, b'', 0)
+
+        for name, serializer in sorted(serializers.SERIALIZERS.items()):
+            data = b''.join(serializer.dumps(obj))
+
+            for operation, func in (('dumps', lambda: serializer.dumps(obj)),
+                    ('loads', lambda: serializer.loads(data))):
+                samples, elapsed = time_calls(func, iterations)
+
+                result = {'suite': 'serializers', 'name': operation, 'serializer': name,
+                    'size': size}
+                result.update(summarize(samples, elapsed))
+                results.append(result)
+
+    return results
+
+
+def bench_mock(iterations):
+    try:
+        from .transports.mock import MockTransport
+    except ImportError as e:
+        sys.stderr.write('Skipping the mock suite: {}\n'.format(e))
+        return []
+
+    transport = MockTransport()
+
+    results = []
+
+    with transport.get_session() as session:
+        samples, elapsed = time_calls(lambda: session.subprocess.PIPE, iterations)
+
+    result = {'suite': 'mock', 'name': 'get'}
+    result.update(summarize(samples, elapsed))
+    results.append(result)
+
+    return results
+
+
+class Server(object):
+    """
+    An errand-boy server on a socket of its own, so a running daemon isn't
+    disturbed.
+    """
+
+    script = SERVER_SCRIPT
+
+    def __init__(self, pool_size):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'errand-boy')
+
+        self.start(self.socket_path, pool_size)
+
+    def start(self, address, pool_size):
+        self.devnull = open(os.devnull, 'w')
+
+        self.process = subprocess.Popen([sys.executable, '-c', self.script,
+            str(address), str(pool_size)], stdout=self.devnull,
+            stderr=subprocess.STDOUT)
+
+        # wait for the server to listen
+        while not self.listening():
+            if self.process.poll() is not None:
+                raise RuntimeError('The server exited with {}'.format(self.process.returncode))
+            time.sleep(0.01)
+
+    def listening(self):
+        return os.path.exists(self.socket_path)
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+        self.devnull.close()
+
+        self.cleanup()
+
+    def cleanup(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class TCPServer(Server):
+    """
+    An errand-boy server on a free loopback port.
+    """
+
+    script = TCP_SERVER_SCRIPT
+
+    def __init__(self, pool_size):
+        self.port = free_port()
+
+        self.start(self.port, pool_size)
+
+    def listening(self):
+        try:
+            socket.create_connection(('127.0.0.1', self.port)).close()
+        except socket.error:
+            return False
+
+        return True
+
+    def cleanup(self):
+        pass
+
+
+def free_port():
+    """
+    Returns a loopback port nothing is listening on.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def run_concurrently(func, concurrency, iterations):
+    """
+    Calls func iterations times from each of concurrency threads.
+    """
+    samples = []
+    errors = []
+    lock = threading.Lock()
+
+    def run():
+        try:
+            thread_samples, elapsed = time_calls(func, iterations)
+        except Exception as e:
+            errors.append(e)
+            return
+
+        with lock:
+            samples.extend(thread_samples)
+
+    threads = [threading.Thread(target=run) for i in six.moves.range(concurrency)]
+
+    started = clock()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = clock() - started
+
+    if errors:
+        raise errors[0]
+
+    return samples, elapsed
+
+
+def bench_unixsocket(iterations, concurrency_levels, sizes, socket_path=None):
+    """
+    Benchmarks run_cmd against the server on socket_path, or one started
+    with a worker per client thread.
+    """
+    server = None
+
+    if socket_path is None:
+        server = Server(max(concurrency_levels))
+        socket_path = server.socket_path
+
+    try:
+        return bench_run_cmd('unixsocket', lambda: UNIXSocketTransport(socket_path=socket_path),
+            iterations, concurrency_levels, sizes)
+    finally:
+        if server is not None:
+            server.close()
+
+
+def bench_tcpsocket(iterations, concurrency_levels, sizes, address=None):
+    """
+    Benchmarks run_cmd over TCP against the server on address, a (host,
+    port) pair, or one started on loopback with a worker per client thread.
+    """
+    server = None
+
+    if address is None:
+        server = TCPServer(max(concurrency_levels))
+        address = '127.0.0.1', server.port
+
+    host, port = address
+
+    try:
+        return bench_run_cmd('tcpsocket', lambda: TCPSocketTransport(host=host, port=port),
+            iterations, concurrency_levels, sizes)
+    finally:
+        if server is not None:
+            server.close()
+
+
+def bench_run_cmd(suite, get_transport, iterations, concurrency_levels, sizes):
+    """
+    Times run_cmd with a transport from get_transport for each output size
+    and concurrency level.
+    """
+    results = []
+
+    for size in sizes:
+        command = 'head -c {} /dev/zero'.format(size)
+
+        for concurrency in concurrency_levels:
+            transport = get_transport()
+
+            samples, elapsed = run_concurrently(lambda: transport.run_cmd(command),
+                concurrency, iterations)
+
+            result = {'suite': suite, 'name': 'run_cmd',
+                'concurrency': concurrency, 'size': size}
+            result.update(summarize(samples, elapsed))
+            results.append(result)
+
+    return results
+
+
+def allocate(size):
+    """
+    Returns size bytes of memory, with every page written to so it counts
+    towards the process' RSS.
+    """
+    ballast = bytearray(size)
+
+    for offset in six.moves.range(0, size, PAGE_SIZE):
+        ballast[offset] = 1
+
+    return ballast
+
+
+def process_tree(pid):
+    """
+    Returns pid and the pids of all its descendants, from /proc.
+    """
+    children = {}
+
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+
+        # the command name may contain spaces, the parent pid follows it
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+
+    pids = [pid]
+
+    for parent in pids:
+        pids.extend(children.get(parent, []))
+
+    return pids
+
+
+def memory_usage(pids):
+    """
+    Returns the total RSS and PSS of pids in bytes, skipping pids that have
+    exited. Both are None where /proc/<pid>/smaps_rollup isn't available.
+    """
+    rss = None
+    pss = None
+
+    for pid in pids:
+        try:
+            with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            continue
+
+        rss = rss or 0
+        pss = pss or 0
+
+        for line in lines:
+            if line.startswith('Rss:'):
+                rss += int(line.split()[1]) * 1024
+            elif line.startswith('Pss:'):
+                pss += int(line.split()[1]) * 1024
+
+    return rss, pss
+
+
+class MemorySampler(threading.Thread):
+    """
+    Polls the memory used by a process and its descendants, keeping the
+    peaks.
+    """
+
+    def __init__(self, pid, interval=0.01):
+        super(MemorySampler, self).__init__()
+        self.daemon = True
+
+        self.pid = pid
+        self.interval = interval
+
+        self.peak_rss = None
+        self.peak_pss = None
+
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.sample()
+            self._stopped.wait(self.interval)
+
+    def sample(self):
+        rss, pss = memory_usage(process_tree(self.pid))
+
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+            self.peak_pss = max(self.peak_pss or 0, pss)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.sample()
+
+
+def no_op():
+    pass
+
+
+def popen_cmd(command, **kwargs):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        **kwargs)
+    stdout, stderr = process.communicate()
+
+    return stdout, stderr, process.returncode
+
+
+def measure_memory(func, concurrency, iterations):
+    """
+    Runs func like run_concurrently, adding the peak memory of this process
+    and its descendants and the page faults taken while it ran.
+    """
+    import resource
+
+    # children's faults are counted once they've been waited for, which
+    # covers the copy-on-write faults forked commands take
+    who = (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+
+    sampler = MemorySampler(os.getpid())
+    before = [resource.getrusage(w) for w in who]
+
+    sampler.start()
+
+    try:
+        samples, elapsed = run_concurrently(func, concurrency, iterations)
+    finally:
+        sampler.stop()
+
+    after = [resource.getrusage(w) for w in who]
+
+    result = summarize(samples, elapsed)
+    result.update({
+        'peak_rss': sampler.peak_rss,
+        'peak_pss': sampler.peak_pss,
+        'minor_faults': sum(a.ru_minflt - b.ru_minflt for a, b in zip(after, before)),
+        'major_faults': sum(a.ru_majflt - b.ru_majflt for a, b in zip(after, before)),
+    })
+
+    return result
+
+
+def bench_memory(iterations, concurrency_levels, parent_size, command=('true',),
+        socket_path=None):
+    """
+    Compares running command with subprocess.Popen straight from a process
+    grown to parent_size bytes, with and without forcing a fork, against
+    running it with run_cmd.
+
+    Peak RSS and PSS are of the whole process tree, the benchmark and the
+    errand-boy server included, so the numbers show what each approach
+    costs the machine. server_pss is what the server and its workers use
+    once the run is over, divided by process in pss_per_process.
+    """
+    command = list(command)
+
+    ballast = allocate(parent_size)
+
+    methods = [
+        ('popen', lambda: popen_cmd(command), None),
+        # a preexec_fn makes Popen fork, where it would otherwise use vfork
+        # or posix_spawn when the platform and Python version allow it
+        ('popen_fork', lambda: popen_cmd(command, preexec_fn=no_op), None),
+    ]
+
+    server = None
+
+    if socket_path is None:
+        server = Server(max(concurrency_levels))
+        socket_path = server.socket_path
+
+    transport = UNIXSocketTransport(socket_path=socket_path)
+    methods.append(('run_cmd', lambda: transport.run_cmd(command), server))
+
+    results = []
+
+    try:
+        for name, func, method_server in methods:
+            for concurrency in concurrency_levels:
+                result = {'suite': 'memory', 'name': name, 'concurrency': concurrency,
+                    'parent_size': len(ballast)}
+                result.update(measure_memory(func, concurrency, iterations))
+
+                if method_server is not None:
+                    pids = process_tree(method_server.process.pid)
+                    server_pss = memory_usage(pids)[1]
+
+                    result['server_pss'] = server_pss
+                    result['pss_per_process'] = server_pss // len(pids) if server_pss else None
+
+                results.append(result)
+    finally:
+        if server is not None:
+            server.close()
+
+    return results
+
+
+def environment():
+    return {
+        'errand_boy': __version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN') if hasattr(os, 'sysconf') else None,
+        'time': time.time(),
+    }
+
+
+def format_table(results, columns=TABLE_COLUMNS):
+    def cell(column, value):
+        if value is None:
+            return '-'
+        if column.endswith(('rss', 'pss', 'per_process')):
+            # bytes in MB
+            return '{:.1f}M'.format(value / float(MB))
+        if isinstance(value, float):
+            return '{:.6g}'.format(value)
+        return str(value)
+
+    rows = [columns] + [[cell(column, result.get(column)) for column in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths))
+        for row in rows) + '\n'
+
+
+def int_list(value):
+    return [int(part) for part in value.split(',')]
+
+
+def host_port(value):
+    host, port = value.rsplit(':', 1)
+
+    return host, int(port)
+
+
+parser = argparse.ArgumentParser(description='Benchmark errand-boy.')
+parser.add_argument('--suite', dest='suites', action='append', choices=SUITES,
+           help='Suite to run, may be given more than once. Runs all but memory by default.')
+parser.add_argument('--iterations', dest='iterations', type=int, default=1000,
+           help='Operations per measurement, or per client thread for unixsocket and tcpsocket.')
+parser.add_argument('--concurrency', dest='concurrency', type=int_list, default=[1, 4, 16],
+           help='Comma separated numbers of client threads for unixsocket and tcpsocket.')
+parser.add_argument('--sizes', dest='sizes', type=int_list, default=[0, 65536, 1048576],
+           help='Comma separated body and command output sizes in bytes.')
+parser.add_argument('--socket-path', dest='socket_path', default=None,
+           help='Benchmark the server on this socket instead of starting one.')
+parser.add_argument('--address', dest='address', type=host_port, default=None,
+           help='Benchmark the TCP server on this host:port instead of starting one.')
+parser.add_argument('--parent-size', dest='parent_size', type=int, default=2048,
+           help='Memory in MB the memory suite allocates before running commands.')
+parser.add_argument('--command', dest='command', default='true',
+           help='Command the memory suite runs, split on whitespace.')
+parser.add_argument('--output', dest='output', default=None,
+           help='Write the results to this file as JSON.')
+
+
+def main(argv):
+    args = parser.parse_args(argv[1:])
+
+    suites = args.suites or DEFAULT_SUITES
+
+    results = []
+
+    if 'framing' in suites:
+        results.extend(bench_framing(args.iterations, args.sizes))
+
+    if 'serializers' in suites:
+        results.extend(bench_serializers(args.iterations, args.sizes))
+
+    if 'mock' in suites:
+        results.extend(bench_mock(args.iterations))
+
+    if 'unixsocket' in suites:
+        # commands are much slower than framing, keep the run short
+        iterations = max(args.iterations // 10, 1)
+
+        results.extend(bench_unixsocket(iterations, args.concurrency, args.sizes,
+            args.socket_path))
+
+    if 'tcpsocket' in suites:
+        iterations = max(args.iterations // 10, 1)
+
+        results.extend(bench_tcpsocket(iterations, args.concurrency, args.sizes,
+            args.address))
+
+    if results:
+        sys.stdout.write(format_table(results))
+
+    if 'memory' in suites:
+        iterations = max(args.iterations // 10, 1)
+
+        memory_results = bench_memory(iterations, args.concurrency, args.parent_size * MB,
+            args.command.split(), args.socket_path)
+
+        sys.stdout.write(format_table(memory_results, MEMORY_TABLE_COLUMNS))
+
+        results.extend(memory_results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv)
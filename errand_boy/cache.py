@@ -0,0 +1,196 @@
+import collections
+import hashlib
+import os
+import pickle
+import signal
+import threading
+import time
+
+from multiprocessing.managers import BaseManager
+
+
+# seconds between checks of whether the server a cache belongs to is gone
+PARENT_POLL_INTERVAL = 1
+
+# seconds a request waits for an identical one to finish before running the
+# command itself, in case the worker running it died
+COALESCE_TIMEOUT = 30
+
+
+def cache_key(command, env=None, cwd=None):
+    """
+    Returns the key of a command's result, which is the same for the same
+    command, environment and working directory.
+    """
+    if env is not None:
+        env = sorted(env.items())
+
+    return hashlib.sha1(pickle.dumps((command, env, cwd), protocol=2)).hexdigest()
+
+
+class CacheEntry(object):
+    def __init__(self, value, size, stored_at, ttl):
+        self.value = value
+        self.size = size
+        self.stored_at = stored_at
+        self.ttl = ttl
+
+    def fresh(self, now, ttl):
+        """
+        Whether the entry is younger than both its own ttl and the ttl the
+        request accepts.
+        """
+        return now - self.stored_at < min(self.ttl, ttl)
+
+
+class ResultCache(object):
+    """
+    Results of commands, evicting the least recently used ones once there
+    are more than max_entries or they add up to more than max_bytes.
+
+    A request for a result which isn't cached claims its key, and identical
+    requests wait for the claim to be stored or released instead of running
+    the same command again.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024,
+            coalesce_timeout=COALESCE_TIMEOUT):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.coalesce_timeout = coalesce_timeout
+
+        self.size = 0
+
+        self._entries = collections.OrderedDict()
+        # when each claimed key was claimed
+        self._claims = {}
+        self._changed = threading.Condition()
+
+    def _get(self, key, ttl, now):
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        if not entry.fresh(now, ttl):
+            if now - entry.stored_at >= entry.ttl:
+                self._remove(key)
+            return None
+
+        # most recently used last
+        del self._entries[key]
+        self._entries[key] = entry
+
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+
+    def get(self, key, ttl):
+        """
+        Returns the result cached at most ttl seconds ago for key, or None.
+        """
+        with self._changed:
+            entry = self._get(key, ttl, time.time())
+
+        return entry.value if entry is not None else None
+
+    def claim(self, key, ttl, wait=True):
+        """
+        Returns (result, False) when a result at most ttl seconds old is
+        cached for key. Otherwise the key is claimed and (None, True) is
+        returned; the caller must store() or release() it.
+
+        While another caller has the key claimed, this waits for it when
+        wait is true, for up to coalesce_timeout seconds, and returns
+        (None, False) straight away otherwise.
+        """
+        with self._changed:
+            while True:
+                now = time.time()
+
+                entry = self._get(key, ttl, now)
+
+                if entry is not None:
+                    return entry.value, False
+
+                claimed_at = self._claims.get(key)
+
+                if claimed_at is None or now - claimed_at >= self.coalesce_timeout:
+                    self._claims[key] = now
+                    return None, True
+
+                if not wait:
+                    return None, False
+
+                self._changed.wait(claimed_at + self.coalesce_timeout - now)
+
+    def store(self, key, value, ttl, size):
+        """
+        Caches value, whose size is size bytes, for ttl seconds and releases
+        the claim on key.
+        """
+        with self._changed:
+            self._claims.pop(key, None)
+
+            if key in self._entries:
+                self._remove(key)
+
+            if ttl > 0 and size <= self.max_bytes:
+                self._entries[key] = CacheEntry(value, size, time.time(), ttl)
+                self.size += size
+
+                while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+
+            self._changed.notify_all()
+
+    def release(self, key):
+        """
+        Releases the claim on key without caching anything, letting one of
+        the callers waiting for it claim it.
+        """
+        with self._changed:
+            self._claims.pop(key, None)
+            self._changed.notify_all()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CacheManager(BaseManager):
+    """
+    Keeps a ResultCache in a process of its own, which every worker shares
+    through a proxy.
+    """
+
+
+CacheManager.register('ResultCache', ResultCache)
+
+
+def exit_with_parent(parent_pid):
+    while os.getppid() == parent_pid:
+        time.sleep(PARENT_POLL_INTERVAL)
+
+    os._exit(0)
+
+
+def manager_init(parent_pid):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # a server killed without shutting the manager down would leave it behind
+    watcher = threading.Thread(target=exit_with_parent, args=(parent_pid,))
+    watcher.daemon = True
+    watcher.start()
+
+
+def start_cache(max_entries, max_bytes):
+    """
+    Starts a CacheManager, returning it and a proxy of the ResultCache it
+    holds. Start it before the workers are forked, so they inherit the proxy.
+    """
+    manager = CacheManager()
+    manager.start(manager_init, (os.getpid(),))
+
+    return manager, manager.ResultCache(max_entries, max_bytes)
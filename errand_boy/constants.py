@@ -1 +1,17 @@
+import struct
+
+
 CRLF = b'\r\n'
+
+# Binary framing, used once both ends have agreed on it with a HELLO request.
+# Every frame starts with a fixed header: magic byte, method, status,
+# request id, then the lengths of the path, headers and body that follow it.
+BINARY_MAGIC = 0xEB
+BINARY_HEADER = struct.Struct('!BBHIHIQ')
+
+# a method's code is its index
+BINARY_METHODS = ('', 'GET', 'CALL', 'RUN', 'HELLO', 'STREAM', 'STATS', 'DEL', 'BATCH', 'INPUT')
+BINARY_METHOD_CODES = dict((method, code) for code, method in enumerate(BINARY_METHODS))
+
+# first version of errand-boy which understands binary framing
+BINARY_FRAMING_VERSION = (0, 3, 9)
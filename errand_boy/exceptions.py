@@ -12,3 +12,15 @@ class SessionClosedError(ErrandBoyBaseError):
 
 class UnknownMethodError(ErrandBoyBaseError):
     pass
+
+
+class ProtocolError(ErrandBoyBaseError):
+    pass
+
+
+class ServerBusyError(ErrandBoyBaseError):
+    pass
+
+
+class UnsupportedError(ErrandBoyBaseError):
+    pass
@@ -0,0 +1,207 @@
+import bisect
+import logging
+import multiprocessing
+import threading
+
+from six.moves import BaseHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, anything larger goes in +Inf
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576,
+    4194304, 16777216, 67108864)
+
+
+class Counter(object):
+    """
+    A count kept in shared memory, so every worker process forked after it
+    was made adds to the same one.
+    """
+
+    def __init__(self, name, help, lock):
+        self.name = name
+        self.help = help
+        self.lock = lock
+
+        self._value = multiprocessing.RawValue('d', 0)
+
+    @property
+    def value(self):
+        return int(self._value.value)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self._value.value += amount
+
+    def set(self, value):
+        with self.lock:
+            self._value.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    Counts observations in fixed buckets, in shared memory like Counter.
+    """
+
+    def __init__(self, name, help, buckets, lock):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.lock = lock
+
+        # one count per bucket, one for +Inf, then the sum
+        self._data = multiprocessing.RawArray('d', len(self.buckets) + 2)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            self._data[index] += 1
+            self._data[-1] += value
+
+    def snapshot(self):
+        """
+        Returns the count, the sum and the cumulative count of each bucket
+        as (upper bound, count) pairs.
+        """
+        with self.lock:
+            data = self._data[:]
+
+        counts = data[:-1]
+        buckets = []
+        total = 0
+
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += int(count)
+            buckets.append((bound, total))
+
+        return {'count': total, 'sum': data[-1], 'buckets': buckets}
+
+
+class ServerMetrics(object):
+    """
+    Metrics for a server and all its workers. Make it before the workers
+    are started, they update it through shared memory.
+    """
+
+    def __init__(self):
+        self.lock = multiprocessing.Lock()
+
+        self.accepts = Counter('accepts', 'Connections accepted.', self.lock)
+        self.rejects = Counter('rejects', 'Connections turned away with 503 Busy.', self.lock)
+        self.requests = Counter('requests', 'Requests handled.', self.lock)
+        self.cache_hits = Counter('cache_hits', 'Results returned from the result cache.', self.lock)
+        self.cache_misses = Counter('cache_misses',
+            'Requests for cached results which ran the command.', self.lock)
+
+        # gauges
+        self.workers = Counter('workers', 'Worker processes.', self.lock)
+        self.busy = Counter('busy_workers', 'Workers serving a connection.', self.lock)
+        self.queued = Counter('queued', 'Accepted connections waiting for a worker.', self.lock)
+
+        self.queue_wait = Histogram('queue_wait_seconds',
+            'Time from accepting a connection until a worker took it.',
+            SECONDS_BUCKETS, self.lock)
+        self.spawn = Histogram('spawn_seconds', 'Time taken to start a command.',
+            SECONDS_BUCKETS, self.lock)
+        self.execution = Histogram('exec_seconds',
+            'Time from starting a command until it exited.',
+            SECONDS_BUCKETS, self.lock)
+        self.bytes_in = Histogram('request_bytes', 'Sizes of request bodies.',
+            BYTES_BUCKETS, self.lock)
+        self.bytes_out = Histogram('response_bytes', 'Sizes of response bodies.',
+            BYTES_BUCKETS, self.lock)
+
+    @property
+    def counters(self):
+        return [self.accepts, self.rejects, self.requests, self.cache_hits,
+            self.cache_misses]
+
+    @property
+    def gauges(self):
+        return [self.workers, self.busy, self.queued]
+
+    @property
+    def histograms(self):
+        return [self.queue_wait, self.spawn, self.execution, self.bytes_in,
+            self.bytes_out]
+
+    def snapshot(self):
+        """
+        Returns every metric by name, plus the number of idle workers.
+        """
+        stats = {}
+
+        for metric in self.counters + self.gauges + self.histograms:
+            stats[metric.name] = metric.snapshot()
+
+        stats['idle_workers'] = max(stats['workers'] - stats['busy_workers'], 0)
+
+        return stats
+
+    def to_prometheus(self, prefix='errand_boy_'):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def header(metric, kind):
+            lines.append('# HELP {}{} {}'.format(prefix, metric.name, metric.help))
+            lines.append('# TYPE {}{} {}'.format(prefix, metric.name, kind))
+
+        for metric in self.counters:
+            header(metric, 'counter')
+            lines.append('{}{}_total {}'.format(prefix, metric.name, metric.value))
+
+        for metric in self.gauges:
+            header(metric, 'gauge')
+            lines.append('{}{} {}'.format(prefix, metric.name, metric.value))
+
+        for metric in self.histograms:
+            header(metric, 'histogram')
+
+            snapshot = metric.snapshot()
+
+            for bound, count in snapshot['buckets']:
+                bound = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}{}_bucket{{le="{}"}} {}'.format(prefix, metric.name, bound, count))
+
+            lines.append('{}{}_sum {!r}'.format(prefix, metric.name, snapshot['sum']))
+            lines.append('{}{}_count {}'.format(prefix, metric.name, snapshot['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.to_prometheus().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve_metrics(metrics, port, host='127.0.0.1'):
+    """
+    Serves metrics to Prometheus over HTTP from a daemon thread, returning
+    the HTTP server.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server.metrics = metrics
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
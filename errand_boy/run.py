@@ -20,9 +20,59 @@ parser.add_argument('--max-accepts', dest='max_accepts', nargs='?', type=int,
 parser.add_argument('--max-child-tasks', dest='max_child_tasks', nargs='?', type=int,
            default=100,
            help='Max number of tasks each child process will handle before being replaced.')
+parser.add_argument('--keepalive-timeout', dest='keepalive_timeout', nargs='?', type=float,
+           default=None,
+           help='Seconds a worker waits for the next request on an idle connection before closing it.')
+parser.add_argument('--prefork', dest='prefork', action='store_true',
+           default=False,
+           help='Have worker processes accept connections themselves instead of the master handing them out.')
+parser.add_argument('--min-workers', dest='min_workers', nargs='?', type=int,
+           default=None,
+           help='Scale the worker pool, keeping at least this many worker processes.')
+parser.add_argument('--max-workers', dest='max_workers', nargs='?', type=int,
+           default=None,
+           help='Scale the worker pool, starting at most this many worker processes.')
+parser.add_argument('--worker-idle-timeout', dest='worker_idle_timeout', nargs='?', type=float,
+           default=60,
+           help='Seconds a scaled pool waits with idle workers before retiring one.')
+parser.add_argument('--max-queue', dest='max_queue', nargs='?', type=int,
+           default=None,
+           help='Most connections allowed to wait for a free worker.')
+parser.add_argument('--overload', dest='overload', choices=['reject', 'block'],
+           default='reject',
+           help='When the queue is full, answer new connections with 503 Busy (reject) or stop accepting (block).')
+parser.add_argument('--handover', dest='handover', action='store_true',
+           default=False,
+           help='After max accepts, hand the listening socket over to a new server process instead of exiting.')
+parser.add_argument('--handover-timeout', dest='handover_timeout', nargs='?', type=float,
+           default=10,
+           help='Seconds the old workers get to take the queued connections during a handover.')
+parser.add_argument('--metrics-port', dest='metrics_port', nargs='?', type=int,
+           default=None,
+           help='Serve metrics to Prometheus over HTTP on this port of localhost.')
+parser.add_argument('--cache-size', dest='cache_size', nargs='?', type=int,
+           default=0,
+           help='Most command results to keep for clients asking for cached results. 0 disables the cache.')
+parser.add_argument('--cache-bytes', dest='cache_bytes', nargs='?', type=int,
+           default=64 * 1024 * 1024,
+           help='Most bytes of output to keep in the result cache.')
+parser.add_argument('--max-session-objects', dest='max_session_objects', nargs='?', type=int,
+           default=1000,
+           help='Most remote objects a session may hold before the least recently used are released. 0 means no limit.')
+parser.add_argument('--host', dest='host', nargs='?',
+           default=None,
+           help='Address a TCP transport listens on or connects to.')
+parser.add_argument('--port', dest='port', nargs='?', type=int,
+           default=None,
+           help='Port a TCP transport listens on or connects to.')
+parser.add_argument('--reuse-port', dest='reuse_port', action='store_true',
+           default=None,
+           help='Let several TCP servers listen on the same port, with the kernel spreading connections between them.')
 parser.add_argument('command', nargs=argparse.REMAINDER)
 parser.add_argument('--version', action='version', version=__version__)
 
+TRANSPORT_OPTIONS = ('host', 'port', 'reuse_port')
+
 class MaxLevelFilter(logging.Filter):
     def __init__(self, level):
         self._level = level
@@ -72,17 +122,40 @@ def main(argv):
 
     mod, klass = parsed_args.transport.rsplit('.', 1)
 
-    transport = getattr(importlib.import_module(mod), klass)()
+    # options only some transports take are passed on when they're given
+    transport_kwargs = dict((name, getattr(parsed_args, name)) for name in TRANSPORT_OPTIONS
+        if getattr(parsed_args, name) is not None)
+
+    transport = getattr(importlib.import_module(mod), klass)(**transport_kwargs)
 
     command = parsed_args.command
 
     if not command:
         logging.config.dictConfig(LOGGING)
 
+        if parsed_args.handover:
+            # the new server is started the same way as this one
+            handover_argv = [sys.executable, '-m', 'errand_boy.run'] + argv[1:]
+        else:
+            handover_argv = None
+
         transport.run_server(
             pool_size=parsed_args.pool_size,
             max_accepts=parsed_args.max_accepts,
-            max_child_tasks=parsed_args.max_child_tasks
+            max_child_tasks=parsed_args.max_child_tasks,
+            keepalive_timeout=parsed_args.keepalive_timeout,
+            prefork=parsed_args.prefork,
+            min_workers=parsed_args.min_workers,
+            max_workers=parsed_args.max_workers,
+            worker_idle_timeout=parsed_args.worker_idle_timeout,
+            max_queue=parsed_args.max_queue,
+            overload=parsed_args.overload,
+            handover_argv=handover_argv,
+            handover_timeout=parsed_args.handover_timeout,
+            metrics_port=parsed_args.metrics_port,
+            cache_size=parsed_args.cache_size,
+            cache_bytes=parsed_args.cache_bytes,
+            max_session_objects=parsed_args.max_session_objects,
         )
     else:
         stdout, stderr, returncode = transport.run_cmd(' '.join(command))
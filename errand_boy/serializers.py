@@ -0,0 +1,293 @@
+"""
+Serializers for request and response bodies.
+
+dumps() returns the body as a list of chunks, so large buffers can be sent
+as they are instead of being copied into one message. Bodies other than
+plain pickles start with a magic byte that no pickle starts with, so
+loads() can tell which serializer made any body.
+"""
+import pickle
+import struct
+
+import six
+
+
+# buffers at least this large are kept out of the pickle, and sent as
+# chunks of their own
+OUT_OF_BAND_SIZE = 65536
+
+PICKLE5_MAGIC = b'\xe5'
+FAST_MAGIC = b'\xef'
+
+PICKLE5_COUNT = struct.Struct('!I')
+PICKLE5_LENGTH = struct.Struct('!Q')
+
+
+class Serializer(object):
+    name = None
+
+    def dumps(self, obj):
+        """
+        Returns obj serialized as a list of chunks. Raises TypeError when
+        obj can't be serialized.
+        """
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class PickleSerializer(Serializer):
+    """
+    Pickles with the default protocol, which every version of errand-boy
+    understands.
+    """
+    name = 'pickle'
+
+    def dumps(self, obj):
+        return [pickle.dumps(obj)]
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class Pickle5Serializer(Serializer):
+    """
+    Pickles with protocol 5, leaving large bytes in lists and tuples out of
+    band so they aren't copied into the pickle. Python 3.8+.
+    """
+    name = 'pickle5'
+
+    def _wrap(self, obj):
+        if isinstance(obj, bytes) and len(obj) >= OUT_OF_BAND_SIZE:
+            return pickle.PickleBuffer(obj)
+
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._wrap(item) for item in obj)
+
+        return obj
+
+    def dumps(self, obj):
+        buffers = []
+
+        data = pickle.dumps(self._wrap(obj), protocol=5, buffer_callback=buffers.append)
+
+        buffers = [buf.raw() for buf in buffers]
+
+        header = [PICKLE5_MAGIC, PICKLE5_COUNT.pack(len(buffers)), PICKLE5_LENGTH.pack(len(data))]
+        header.extend(PICKLE5_LENGTH.pack(len(buf)) for buf in buffers)
+
+        return [b''.join(header), data] + buffers
+
+    def loads(self, data):
+        view = memoryview(data)
+
+        count, = PICKLE5_COUNT.unpack_from(view, 1)
+        pos = 1 + PICKLE5_COUNT.size
+
+        lengths = []
+
+        for i in six.moves.range(count + 1):
+            lengths.append(PICKLE5_LENGTH.unpack_from(view, pos)[0])
+            pos += PICKLE5_LENGTH.size
+
+        pickled = view[pos:pos + lengths[0]]
+        pos += lengths[0]
+
+        buffers = []
+
+        for length in lengths[1:]:
+            buffers.append(bytes(view[pos:pos + length]))
+            pos += length
+
+        return pickle.loads(pickled, buffers=buffers)
+
+
+class FastSerializer(Serializer):
+    """
+    A restricted codec for None, bools, ints, floats, strings, bytes, lists,
+    tuples and dicts, which never runs code when loading. run_cmd() results
+    are packed in one go, and their output isn't copied.
+    """
+    name = 'fast'
+
+    INT = struct.Struct('!q')
+    FLOAT = struct.Struct('!d')
+    LENGTH = struct.Struct('!Q')
+    # a run_cmd() result: the lengths of stdout and stderr, and the return code
+    RESULT = struct.Struct('!QQq')
+
+    def _is_result(self, obj):
+        return (type(obj) is tuple and len(obj) == 3 and type(obj[0]) is bytes
+            and type(obj[1]) is bytes and type(obj[2]) is int)
+
+    def _dump(self, obj, parts):
+        if obj is None:
+            parts.append(b'N')
+        elif obj is True:
+            parts.append(b'T')
+        elif obj is False:
+            parts.append(b'F')
+        elif isinstance(obj, six.integer_types):
+            if not -2 ** 63 <= obj < 2 ** 63:
+                raise TypeError('Integer out of range: {}'.format(obj))
+            parts.append(b'i' + self.INT.pack(obj))
+        elif isinstance(obj, float):
+            parts.append(b'f' + self.FLOAT.pack(obj))
+        elif isinstance(obj, six.text_type):
+            data = obj.encode('utf-8')
+            parts.append(b's' + self.LENGTH.pack(len(data)))
+            parts.append(data)
+        elif isinstance(obj, bytes):
+            parts.append(b'b' + self.LENGTH.pack(len(obj)))
+            parts.append(obj)
+        else:
+            self._dump_container(obj, parts)
+
+    def _dump_container(self, obj, parts):
+        if isinstance(obj, dict):
+            parts.append(b'd' + self.LENGTH.pack(len(obj)))
+            for key, value in obj.items():
+                self._dump(key, parts)
+                self._dump(value, parts)
+        elif isinstance(obj, (list, tuple)):
+            parts.append((b't' if isinstance(obj, tuple) else b'l') + self.LENGTH.pack(len(obj)))
+            for item in obj:
+                self._dump(item, parts)
+        else:
+            raise TypeError('Can\'t serialize {!r}'.format(type(obj)))
+
+    def result_header(self, stdout_length, stderr_length, returncode):
+        """
+        Returns what a run_cmd() result starts with, up to its stdout.
+        """
+        return FAST_MAGIC + b'r' + self.RESULT.pack(stdout_length, stderr_length, returncode)
+
+    def dumps(self, obj):
+        if self._is_result(obj):
+            stdout, stderr, returncode = obj
+            parts = [self.result_header(len(stdout), len(stderr), returncode), stdout, stderr]
+        else:
+            parts = [FAST_MAGIC]
+            self._dump(obj, parts)
+
+        # join the small parts, large ones are sent as they are
+        chunks = []
+        small = []
+
+        for part in parts:
+            if len(part) < OUT_OF_BAND_SIZE:
+                small.append(part)
+                continue
+
+            if small:
+                chunks.append(b''.join(small))
+                small = []
+
+            chunks.append(part)
+
+        if small:
+            chunks.append(b''.join(small))
+
+        return chunks
+
+    def _load(self, view, pos):
+        tag = view[pos:pos + 1].tobytes()
+        pos += 1
+
+        if tag in self.CONSTANTS:
+            return self.CONSTANTS[tag], pos
+
+        if tag == b'i':
+            return self.INT.unpack_from(view, pos)[0], pos + self.INT.size
+
+        if tag == b'f':
+            return self.FLOAT.unpack_from(view, pos)[0], pos + self.FLOAT.size
+
+        length, = self.LENGTH.unpack_from(view, pos)
+        pos += self.LENGTH.size
+
+        if tag in (b's', b'b'):
+            data = view[pos:pos + length].tobytes()
+            return (data.decode('utf-8') if tag == b's' else data), pos + length
+
+        return self._load_container(tag, length, view, pos)
+
+    def _load_container(self, tag, length, view, pos):
+        if tag == b'd':
+            obj = {}
+
+            for i in six.moves.range(length):
+                key, pos = self._load(view, pos)
+                obj[key], pos = self._load(view, pos)
+
+            return obj, pos
+
+        if tag not in (b'l', b't'):
+            raise ValueError('Unknown tag: {!r}'.format(tag))
+
+        items = []
+
+        for i in six.moves.range(length):
+            item, pos = self._load(view, pos)
+            items.append(item)
+
+        return (tuple(items) if tag == b't' else items), pos
+
+    def _load_result(self, view):
+        stdout_length, stderr_length, returncode = self.RESULT.unpack_from(view, 2)
+
+        pos = 2 + self.RESULT.size
+        stdout = view[pos:pos + stdout_length].tobytes()
+
+        pos += stdout_length
+        stderr = view[pos:pos + stderr_length].tobytes()
+
+        return stdout, stderr, returncode
+
+    def loads(self, data):
+        view = memoryview(data)
+
+        if view[1:2].tobytes() == b'r':
+            return self._load_result(view)
+
+        obj, pos = self._load(view, 1)
+        return obj
+
+
+FastSerializer.CONSTANTS = {b'N': None, b'T': True, b'F': False}
+
+# how far into a fast run_cmd() result its stdout starts
+RESULT_OFFSET = len(FAST_MAGIC) + 1 + FastSerializer.RESULT.size
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer(),
+    'fast': FastSerializer(),
+}
+
+if pickle.HIGHEST_PROTOCOL >= 5:
+    SERIALIZERS['pickle5'] = Pickle5Serializer()
+
+MAGICS = {
+    PICKLE5_MAGIC: 'pickle5',
+    FAST_MAGIC: 'fast',
+}
+
+
+def get_serializer(name):
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError('Unknown serializer: {}'.format(name))
+
+
+def detect(data):
+    """
+    Returns the serializer which made data.
+    """
+    return get_serializer(MAGICS.get(bytes(data[:1]), 'pickle'))
+
+
+def loads(data):
+    return detect(data).loads(data)
@@ -0,0 +1,109 @@
+"""
+Shared memory for message bodies too large to be worth copying through a
+socket. The sender puts the body in an anonymous file in memory and passes
+its descriptor over the UNIX socket, and the receiver maps it. Nothing is
+left behind when either end exits.
+"""
+import mmap
+import os
+import tempfile
+
+from . import serializers
+
+
+# largest number of descriptors taken from one read of a socket
+MAX_FDS = 16
+
+# where anonymous files are kept in memory, where memfd_create() is missing
+SHM_DIR = '/dev/shm'
+
+
+class SharedBody(object):
+    """
+    A message body already in the anonymous file fd, sent by passing the
+    descriptor. Sending it closes fd.
+    """
+
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+def create_file():
+    """
+    Returns the descriptor of a new, empty anonymous file in memory.
+    """
+    if hasattr(os, 'memfd_create'):
+        return os.memfd_create('errand-boy', getattr(os, 'MFD_CLOEXEC', 0))
+
+    f = tempfile.TemporaryFile(dir=SHM_DIR if os.path.isdir(SHM_DIR) else None)
+
+    try:
+        return os.dup(f.fileno())
+    finally:
+        f.close()
+
+
+def create(chunks):
+    """
+    Returns chunks as a SharedBody.
+    """
+    fd = create_file()
+    size = 0
+
+    try:
+        for chunk in chunks:
+            view = memoryview(chunk)
+
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+                size += written
+    except Exception:
+        os.close(fd)
+        raise
+
+    return SharedBody(fd, size)
+
+
+def result_body(fd, stderr, returncode, threshold):
+    """
+    Finishes a run_cmd() result whose command wrote its stdout to fd, from
+    serializers.RESULT_OFFSET on, so the output is never copied. Returns it
+    as a SharedBody in the fast serializer's format, or as a plain result
+    when it's smaller than threshold bytes.
+    """
+    offset = serializers.RESULT_OFFSET
+    stdout_length = max(os.fstat(fd).st_size - offset, 0)
+
+    if stdout_length + len(stderr) < threshold:
+        try:
+            return os.pread(fd, stdout_length, offset), stderr, returncode
+        finally:
+            os.close(fd)
+
+    header = serializers.get_serializer('fast').result_header(stdout_length,
+        len(stderr), returncode)
+
+    try:
+        os.pwrite(fd, stderr, offset + stdout_length)
+        os.pwrite(fd, header, 0)
+    except Exception:
+        os.close(fd)
+        raise
+
+    return SharedBody(fd, offset + stdout_length + len(stderr))
+
+
+def open_body(fd, size):
+    """
+    Maps size bytes of the file fd refers to as a message body, taking over
+    the descriptor.
+    """
+    try:
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
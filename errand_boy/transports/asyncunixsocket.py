@@ -0,0 +1,887 @@
+"""
+asyncio version of the UNIX socket transport. Requires Python 3.8 or newer.
+"""
+import asyncio
+import logging
+import os
+import subprocess
+import time
+
+import six
+
+from .base import (DEFAULT_CACHE_BYTES, DEFAULT_MAX_SESSION_OBJECTS,
+    MAX_CONCURRENT_REQUESTS, RELEASE_BATCH, STREAM_CHUNK_SIZE, ConnectionPool,
+    RemoteObjRef, Request, Response, get_header, iter_input, setproctitle)
+from .unixsocket import UNIXSocketTransport
+from .. import constants
+from .. import serializers
+from .. import __version__
+from ..batch import max_parallel_for
+from ..cache import ResultCache, cache_key
+from ..exceptions import (DisconnectedError, ProtocolError, ServerBusyError,
+    SessionClosedError, UnknownMethodError)
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncClientSession(object):
+    def __init__(self, transport, pool=None, negotiate=True):
+        self.transport = transport
+        self.pool = pool
+        self.negotiate = negotiate
+        self.connection = None
+        self._closed = True
+
+        # names of remote objects waiting to be released
+        self._released = []
+        # whether the server has exposed any objects to this session
+        self._exposed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __getattr__(self, name):
+        return AsyncRemoteObjWrapper(self, name)
+
+    async def __aenter__(self):
+        if self.pool is not None:
+            self.connection = await self.pool.acquire()
+        else:
+            self.connection = await self.transport.client_connect(negotiate=self.negotiate)
+
+        self._closed = False
+        return self
+
+    def _release(self, name):
+        if not self._closed:
+            self._released.append(name)
+
+    async def _flush_released(self):
+        if len(self._released) < RELEASE_BATCH:
+            return
+
+        names, self._released = self._released, []
+
+        await self.transport.send_del_request(self.connection, names)
+
+    async def _release_all(self):
+        """
+        Releases every object the session exposed before its connection is
+        reused. Returns whether the connection can be reused.
+        """
+        self._released = []
+
+        if not self._exposed:
+            return True
+
+        try:
+            await self.transport.send_del_request(self.connection, [])
+        except Exception as e:
+            logger.exception(e)
+            return False
+
+        return True
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._closed = True
+
+        # a connection that saw an error may be out of step with the
+        # server, so only clean exits go back to the pool
+        if self.pool is not None and exc_type is None and await self._release_all():
+            self.pool.release(self.connection)
+            return False
+
+        self.transport.forget_connection(self.connection)
+
+        try:
+            self.transport.client_close(self.connection)
+        except Exception as e:
+            logger.exception(e)
+
+        return False
+
+
+class AsyncRemoteObjWrapper(object):
+    """
+    Attribute accesses and calls return coroutines which make the request:
+
+    popen = await session.subprocess.Popen
+    process = await popen(['ls'], stdout=await session.subprocess.PIPE)
+    """
+
+    def __init__(self, session, name, handle=False):
+        self.session = session
+        self.name = name
+        self.handle = handle
+
+    def __del__(self):
+        # missing attributes are remote, so don't look them up
+        if self.__dict__.get('handle'):
+            self.session._release(self.name)
+
+    async def _send(self, method, *args, **kwargs):
+        session = self.session
+
+        if session.closed:
+            raise SessionClosedError()
+
+        if method == 'GET':
+            func = session.transport.send_get_request
+        elif method == 'CALL':
+            func = session.transport.send_call_request
+        else:
+            raise UnknownMethodError(method)
+
+        await session._flush_released()
+
+        ret = await func(session.connection, self.name, *args, **kwargs)
+
+        if isinstance(ret, RemoteObjRef):
+            session._exposed = True
+            ret = AsyncRemoteObjWrapper(session, ret.name, handle=True)
+
+        return ret
+
+    def __getattr__(self, name):
+        return self._send('GET', name)
+
+    def __call__(self, *args, **kwargs):
+        return self._send('CALL', *args, **kwargs)
+
+
+class AsyncConnectionPool(ConnectionPool):
+    async def acquire(self):
+        connection = self._take_idle()
+
+        if connection is None:
+            connection = await self.transport.client_connect()
+
+        return connection
+
+
+class AsyncUNIXSocketTransport(UNIXSocketTransport):
+    """
+    Usage:
+
+    python -m errand_boy.run -t errand_boy.transports.asyncunixsocket.AsyncUNIXSocketTransport
+
+    The server handles every connection in one event loop and runs commands
+    with asyncio subprocesses. pool_size limits how many commands run at
+    once instead of the number of worker processes.
+
+    GET and CALL requests run in a thread, since remote objects block.
+
+    The client side is made of coroutines:
+
+    transport = AsyncUNIXSocketTransport()
+
+    stdout, stderr, returncode = await transport.run_cmd('ls -al')
+    """
+
+    connection_pool_class = AsyncConnectionPool
+
+    # streams can't carry descriptors
+    passes_fds = False
+
+    def __init__(self, socket_path='/tmp/errand-boy', listen_backlog=128, **kwargs):
+        # one process accepts every connection, so bursts need a longer queue
+        super(AsyncUNIXSocketTransport, self).__init__(socket_path=socket_path,
+            listen_backlog=listen_backlog, **kwargs)
+
+    def connection_to_string(self, connection):
+        reader, writer = connection
+
+        return str(writer.get_extra_info('sockname'))
+
+    def server_send(self, connection, data):
+        reader, writer = connection
+
+        writer.write(data)
+
+    def server_close(self, connection):
+        reader, writer = connection
+
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+    async def read_message(self, connection):
+        """
+        Reads one message in either framing.
+
+        Returns the first line (None for binary frames), the binary
+        (method, status, request_id, path) fields (None for text messages),
+        the headers and the body.
+        """
+        reader, writer = connection
+
+        CRLF = constants.CRLF
+
+        try:
+            first = await reader.readexactly(1)
+
+            if first[0] == constants.BINARY_MAGIC:
+                header = first + await reader.readexactly(constants.BINARY_HEADER.size - 1)
+
+                (magic, method, status, request_id, path_length, headers_length,
+                    content_length) = constants.BINARY_HEADER.unpack(header)
+
+                try:
+                    method = constants.BINARY_METHODS[method]
+                except IndexError:
+                    raise UnknownMethodError(method)
+
+                data = await reader.readexactly(path_length + headers_length)
+                body = await reader.readexactly(content_length)
+
+                path = data[:path_length].decode('utf-8')
+                header_data = data[path_length:].decode('utf-8')
+                headers = [line.split(': ', 1) for line in header_data.split('\r\n') if line]
+
+                return None, (method, status, request_id, path), headers, body
+
+            lines = [first + (await reader.readuntil(CRLF))[:-len(CRLF)]]
+
+            content_length = None
+
+            while content_length is None:
+                line = (await reader.readuntil(CRLF))[:-len(CRLF)]
+                lines.append(line)
+
+                if line[:16].lower() == b'content-length: ':
+                    content_length = int(line[16:])
+
+            body = b''
+
+            # messages without a body end after the Content-Length line
+            if content_length:
+                await reader.readuntil(CRLF)
+                body = await reader.readexactly(content_length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            raise DisconnectedError()
+
+        headers = [line.decode('utf-8') for line in lines]
+
+        return headers[0], None, [header.split(': ', 1) for header in headers[1:]], body
+
+    async def get_request(self, connection):
+        first_line, frame, headers, body = await self.read_message(connection)
+
+        # answer in whichever framing the client used
+        if frame is not None:
+            self._binary_connections.add(id(connection))
+
+            method, status, request_id, path = frame
+
+            return Request(method, path, headers, body, request_id)
+
+        self._binary_connections.discard(id(connection))
+
+        method, path = first_line.split(' ', 1)
+
+        return Request(method, path, headers, body)
+
+    async def get_response(self, connection):
+        first_line, frame, headers, body = await self.read_message(connection)
+
+        if frame is not None:
+            method, status, request_id, path = frame
+
+            return Response(status, headers, body, request_id)
+
+        status = int(first_line.split()[0])
+
+        if status == 503:
+            raise ServerBusyError()
+
+        return Response(status, headers, body)
+
+    def _create_subprocess(self, command, env=None, cwd=None, stdin=None):
+        if isinstance(command, six.string_types):
+            return asyncio.create_subprocess_shell(command, stdin=stdin,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=cwd)
+
+        return asyncio.create_subprocess_exec(*command, stdin=stdin,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=cwd)
+
+    async def server_run_cmd(self, command, env=None, cwd=None, timings=None):
+        async with self._children:
+            started = time.time()
+
+            process = await self._create_subprocess(command, env=env, cwd=cwd)
+
+            spawned = time.time()
+
+            stdout, stderr = await process.communicate()
+
+            self.server_command_finished(started, spawned, timings)
+
+        return stdout, stderr, process.returncode
+
+    async def server_run_cmd_input(self, connection, command, env=None, cwd=None,
+            timings=None):
+        """
+        Like the base transport's, with the output read on the loop while
+        the input is written.
+        """
+        async with self._children:
+            started = time.time()
+
+            try:
+                process = await self._create_subprocess(command, env=env, cwd=cwd,
+                    stdin=subprocess.PIPE)
+            except Exception:
+                await self.server_feed_input(connection, None)
+                raise
+
+            spawned = time.time()
+
+            output = asyncio.gather(process.stdout.read(), process.stderr.read())
+
+            try:
+                await self.server_feed_input(connection, process.stdin)
+            except BaseException:
+                process.kill()
+                await process.wait()
+                raise
+
+            stdout, stderr = await output
+            returncode = await process.wait()
+
+            self.server_command_finished(started, spawned, timings)
+
+        return stdout, stderr, returncode
+
+    async def server_feed_input(self, connection, stdin):
+        """
+        Like the base transport's, with stdin the command's StreamWriter,
+        which is closed at the end of the input.
+        """
+        try:
+            while True:
+                request = await self.get_request(connection)
+
+                if request.method != 'INPUT':
+                    raise ProtocolError('Expected INPUT, got {}.'.format(request.method))
+
+                if not request.body:
+                    return
+
+                if stdin is not None and not stdin.transport.is_closing():
+                    await self.write_input(stdin, request.body)
+        finally:
+            if stdin is not None:
+                stdin.close()
+
+    async def write_input(self, stdin, data):
+        stdin.write(data)
+
+        try:
+            await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # the command stopped reading, the rest is dropped
+            stdin.close()
+
+    async def server_cached_run_cmd(self, request, command, env=None, cwd=None):
+        """
+        Like the base transport's, with the cache in this process. Requests
+        for a result which is being produced wait for that command instead
+        of claiming its key.
+        """
+        ttl = self.server_cache_ttl(request)
+
+        if ttl is None:
+            return await self.server_run_cmd(command, env=env, cwd=cwd, timings=request.timings)
+
+        key = cache_key(command, env, cwd)
+
+        result = self.cache.get(key, ttl)
+
+        if result is None and key in self._cache_runs:
+            result = await asyncio.shield(self._cache_runs[key])
+
+        if result is not None:
+            request.cache = 'hit'
+            self.server_count('cache_hits')
+            return result
+
+        request.cache = 'miss'
+        self.server_count('cache_misses')
+
+        run = asyncio.ensure_future(self.server_run_cmd(command, env=env, cwd=cwd,
+            timings=request.timings))
+
+        self._cache_runs[key] = run
+
+        try:
+            result = await run
+        finally:
+            del self._cache_runs[key]
+
+        stdout, stderr, returncode = result
+        self.cache.store(key, result, ttl, len(stdout) + len(stderr))
+
+        return result
+
+    async def server_stream_cmd(self, connection, command, env=None, cwd=None,
+            timings=None, request_id=0):
+        async def forward(pipe, stream):
+            while True:
+                chunk = await pipe.read(STREAM_CHUNK_SIZE)
+
+                if not chunk:
+                    return
+
+                self.send_chunk(connection, stream, chunk, request_id=request_id)
+
+                await self.server_drain(connection)
+
+        async with self._children:
+            started = time.time()
+
+            process = await self._create_subprocess(command, env=env, cwd=cwd)
+
+            spawned = time.time()
+
+            try:
+                await asyncio.gather(
+                    forward(process.stdout, 'stdout'),
+                    forward(process.stderr, 'stderr'),
+                )
+            except BaseException:
+                # the client went away, don't leave the command running
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+                raise
+
+            returncode = await process.wait()
+
+            self.server_command_finished(started, spawned, timings)
+
+            return returncode
+
+    async def server_run_cmds(self, connection, commands, env=None, cwd=None,
+            max_parallel=None, serializer=None, timings=None, request_id=0):
+        """
+        Like the base transport's, with a task per command. The server's
+        pool_size limits them as well.
+        """
+        started = time.time()
+
+        limit = asyncio.Semaphore(max_parallel_for(max_parallel))
+
+        async def run(index, command):
+            async with limit:
+                try:
+                    result = await self.server_run_cmd(command, env=env, cwd=cwd)
+                except Exception as e:
+                    result = e
+
+            self.send_batch_result(connection, index, result, serializer,
+                request_id=request_id)
+
+        await asyncio.gather(*[run(index, command) for index, command in enumerate(commands)])
+
+        if timings is not None:
+            timings['execution'] = time.time() - started
+
+        return len(commands)
+
+    async def server_dispatch(self, connection, exposed_locals, request):
+        """
+        Handles one request, returning the result and whether it was raised.
+        """
+        if request.method == 'RUN':
+            args, kwargs = self.deserialize_body(request.body)
+
+            if get_header(request.headers, 'X-Input'):
+                return await self.server_run_cmd_input(connection, *args,
+                    timings=request.timings, **kwargs), False
+
+            return await self.server_cached_run_cmd(request, *args, **kwargs), False
+
+        if request.method == 'STREAM':
+            args, kwargs = self.deserialize_body(request.body)
+            return await self.server_stream_cmd(connection, *args,
+                timings=request.timings, request_id=request.request_id, **kwargs), False
+
+        if request.method == 'BATCH':
+            args, kwargs = self.deserialize_body(request.body)
+            return await self.server_run_cmds(connection, *args,
+                serializer=serializers.detect(request.body), timings=request.timings,
+                request_id=request.request_id, **kwargs), False
+
+        if request.method in ('GET', 'CALL'):
+            # remote objects may block, keep them off the loop
+            return await asyncio.get_event_loop().run_in_executor(None,
+                self.server_handle_request, connection, exposed_locals, request)
+
+        return self.server_handle_request(connection, exposed_locals, request)
+
+    async def server_handle_client(self, connection):
+        reader, writer = connection
+
+        logger.debug('server_handle_client: {}'.format(self.connection_to_string(connection)))
+
+        exposed_locals = self.server_exposed_locals()
+
+        self._drain_locks[id(connection)] = asyncio.Lock()
+
+        # requests with ids, which the client doesn't wait for one at a time
+        slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        tasks = set()
+
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.get_request(connection),
+                        self.server_keepalive_timeout)
+                except (DisconnectedError, asyncio.TimeoutError):
+                    break
+
+                self.server_record_request(request)
+
+                if not request.request_id:
+                    await self.server_respond(connection, exposed_locals, request)
+                    continue
+
+                await slots.acquire()
+
+                task = asyncio.ensure_future(self.server_respond_concurrently(connection,
+                    exposed_locals, request, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (DisconnectedError, ConnectionError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.wait(tasks)
+
+            del self._drain_locks[id(connection)]
+            self.forget_connection(connection)
+            self.server_close(connection)
+
+    async def server_respond(self, connection, exposed_locals, request):
+        try:
+            obj, raised = await self.server_dispatch(connection, exposed_locals, request)
+        except (DisconnectedError, ConnectionError):
+            raise
+        except Exception as e:
+            obj = e
+            raised = True
+
+        self.send_response(connection, obj, raised=raised, request=request)
+
+        await self.server_drain(connection)
+
+    async def server_respond_concurrently(self, connection, exposed_locals, request, slots):
+        try:
+            await self.server_respond(connection, exposed_locals, request)
+        except Exception as e:
+            logger.debug('Failed to answer request {}: {}'.format(request.request_id, e))
+        finally:
+            slots.release()
+
+    async def server_drain(self, connection):
+        """
+        Waits for what's been written to the connection to be sent. Requests
+        answered at once take turns, a writer can't be drained by several
+        tasks at the same time.
+        """
+        reader, writer = connection
+
+        async with self._drain_locks[id(connection)]:
+            await writer.drain()
+
+    async def serve(self, pool_size=10, max_accepts=5000):
+        loop = asyncio.get_event_loop()
+
+        self._children = asyncio.Semaphore(pool_size)
+
+        # commands running for the result cache, by key
+        self._cache_runs = {}
+
+        # a lock for draining each connection, by id
+        self._drain_locks = {}
+
+        finished = asyncio.Event()
+        handlers = set()
+
+        remaining_accepts = [max_accepts or True]
+
+        def client_connected(reader, writer):
+            connection = reader, writer
+
+            logger.info('Accepted connection from: {}'.format(self.connection_to_string(connection)))
+
+            self.server_count('accepts')
+
+            task = loop.create_task(self.server_handle_client(connection))
+            handlers.add(task)
+            task.add_done_callback(handlers.discard)
+
+            if remaining_accepts[0] is not True:
+                remaining_accepts[0] -= 1
+
+                if not remaining_accepts[0]:
+                    finished.set()
+
+        try:
+            os.remove(self.socket_path)
+        except OSError as e:
+            logger.exception(e)
+
+        server = await asyncio.start_unix_server(client_connected,
+            path=self.socket_path, backlog=self.listen_backlog)
+
+        logger.info('Accepting connections: {}'.format(self.socket_path))
+
+        try:
+            await finished.wait()
+        finally:
+            server.close()
+
+            # let in-flight sessions finish
+            if handlers:
+                await asyncio.wait(handlers)
+
+            await server.wait_closed()
+
+    def run_server(self, pool_size=10, max_accepts=5000, max_child_tasks=100,
+            keepalive_timeout=None, prefork=False, min_workers=None,
+            max_workers=None, worker_idle_timeout=60, max_queue=None,
+            overload='reject', handover_argv=None, handover_timeout=10,
+            metrics_port=None, cache_size=0, cache_bytes=DEFAULT_CACHE_BYTES,
+            max_session_objects=DEFAULT_MAX_SESSION_OBJECTS):
+        if prefork:
+            raise ValueError('The asyncio server runs in a single process.')
+
+        if min_workers is not None or max_workers is not None:
+            raise ValueError('The asyncio server can\'t be scaled.')
+
+        if max_queue is not None:
+            raise ValueError('The asyncio server doesn\'t queue connections.')
+
+        if handover_argv is not None:
+            raise ValueError('The asyncio server can\'t be handed over.')
+
+        setproctitle('errand-boy asyncio process')
+
+        self.server_keepalive_timeout = keepalive_timeout
+        self.server_max_session_objects = max_session_objects
+
+        self.server_start_metrics(metrics_port)
+        self.server_count('workers', 1)
+
+        # the only process using it, so no manager is needed
+        if cache_size:
+            self.cache = ResultCache(cache_size, cache_bytes)
+
+        logger.info('pool_size: {}'.format(pool_size))
+        logger.info('max_accepts: {}'.format(max_accepts))
+        logger.info('keepalive_timeout: {}'.format(keepalive_timeout))
+        logger.info('cache_size: {}'.format(cache_size))
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        try:
+            loop.run_until_complete(self.serve(pool_size=pool_size, max_accepts=max_accepts))
+        except KeyboardInterrupt:
+            logger.info('Received KeyboardInterrupt')
+        finally:
+            loop.close()
+
+    async def client_get_connection(self):
+        if self.fail_fast:
+            # UNIX sockets connect immediately or fail, so the synchronous
+            # fail-fast connect doesn't block the loop
+            clientsocket = super(AsyncUNIXSocketTransport, self).client_get_connection()
+
+            return await asyncio.open_unix_connection(sock=clientsocket)
+
+        return await asyncio.open_unix_connection(self.socket_path)
+
+    async def client_connect(self, negotiate=True):
+        connection = await self.client_get_connection()
+
+        if self.framing == 'binary':
+            self._binary_connections.add(id(connection))
+        elif self.framing == 'auto' and negotiate:
+            await self.client_hello(connection)
+
+        return connection
+
+    async def client_hello(self, connection):
+        hello = await self.send_request(connection, 'HELLO', __version__)
+
+        # servers from before HELLO existed answer unknown methods with None
+        if not isinstance(hello, dict):
+            return {}
+
+        # clients asking for other reasons may have been told to use text
+        if hello.get('framing') == 'binary' and self.framing != 'text':
+            self._binary_connections.add(id(connection))
+
+        if hello.get('input'):
+            self._input_connections.add(id(connection))
+
+        return hello
+
+    async def client_check_input(self, connection):
+        if id(connection) not in self._input_connections:
+            await self.client_hello(connection)
+
+        if id(connection) not in self._input_connections:
+            raise UnknownMethodError('INPUT')
+
+    async def send_input(self, connection, input):
+        for chunk in iter_input(input):
+            if len(chunk):
+                await self.send_request_frame(connection, 'INPUT', 'stdin', body=chunk)
+
+        await self.send_request_frame(connection, 'INPUT', 'stdin')
+
+    def client_send(self, connection, data):
+        reader, writer = connection
+
+        writer.write(data)
+
+    def client_connection_alive(self, connection):
+        reader, writer = connection
+
+        return not reader.at_eof() and not writer.transport.is_closing()
+
+    def client_close(self, connection):
+        reader, writer = connection
+
+        try:
+            writer.close()
+        except Exception as e:
+            logger.exception(e)
+
+    async def send_request_frame(self, connection, method, path, body='', headers=None):
+        reader, writer = connection
+
+        try:
+            self.write_request_frame(connection, method, path, body=body, headers=headers)
+
+            await writer.drain()
+        except ConnectionError:
+            # a busy server may have answered and hung up before the
+            # request was sent. asyncio drops what it hadn't read yet when
+            # the write fails, so this can still end in the ConnectionError
+            try:
+                await self.get_response(connection)
+            except ServerBusyError:
+                raise
+            except Exception:
+                pass
+
+            raise
+
+    async def send_request(self, connection, method, path, body='', headers=None):
+        await self.send_request_frame(connection, method, path, body=body, headers=headers)
+
+        return self.decode_response(await self.get_response(connection))
+
+    async def send_stream_request(self, connection, *args, **kwargs):
+        await self.send_request_frame(connection, 'STREAM', 'subprocess',
+            body=self.encode_args(args, kwargs))
+
+        while True:
+            resp = await self.get_response(connection)
+
+            if resp.status == 206:
+                yield dict(resp.headers)['X-Stream'], resp.body
+                continue
+
+            obj = self.deserialize_body(resp.body)
+
+            if resp.status == 400:
+                raise obj
+
+            # servers from before STREAM existed answer with None
+            if obj is None:
+                raise UnknownMethodError('STREAM')
+
+            yield 'returncode', obj
+            return
+
+    async def send_batch_request(self, connection, *args, **kwargs):
+        await self.send_request_frame(connection, 'BATCH', 'subprocess',
+            body=self.encode_args(args, kwargs))
+
+        while True:
+            resp = await self.get_response(connection)
+
+            if resp.status == 206:
+                yield int(dict(resp.headers)['X-Index']), self.deserialize_body(resp.body)
+                continue
+
+            # servers from before BATCH existed answer with None
+            if self.decode_response(resp) is None:
+                raise UnknownMethodError('BATCH')
+
+            return
+
+    def get_session(self, negotiate=True):
+        return AsyncClientSession(self, pool=self.client_pool, negotiate=negotiate)
+
+    def get_multiplexed_session(self):
+        # tasks already share the loop, give each request a connection of
+        # its own from client_pool instead
+        raise ValueError('Multiplexed sessions are synchronous.')
+
+    async def run_cmd(self, command_string, env=None, cwd=None, timing=False,
+            request_id=None, cache_ttl=None, input=None):
+        body, headers = self.encode_run_cmd(command_string, env, cwd, timing,
+            request_id, cache_ttl)
+
+        if input is not None:
+            headers.append(('X-Input', '1'))
+
+        started = time.time()
+
+        async with self.get_session(negotiate=False) as session:
+            if input is not None:
+                await self.client_check_input(session.connection)
+
+            await self.send_request_frame(session.connection, 'RUN', 'subprocess',
+                body=body, headers=headers)
+
+            if input is not None:
+                await self.send_input(session.connection, input)
+
+            resp = await self.get_response(session.connection)
+
+        return self.decode_run_cmd(resp, timing, started)
+
+    async def get_stats(self):
+        async with self.get_session(negotiate=False) as session:
+            return await self.send_request(session.connection, 'STATS', 'server')
+
+    async def iter_cmds(self, commands, env=None, cwd=None, max_parallel=None):
+        async with self.get_session(negotiate=False) as session:
+            async for item in self.send_batch_request(session.connection, commands,
+                    env=env, cwd=cwd, max_parallel=max_parallel):
+                yield item
+
+    async def run_cmds(self, commands, env=None, cwd=None, max_parallel=None):
+        results = [None] * len(commands)
+
+        async for index, result in self.iter_cmds(commands, env=env, cwd=cwd,
+                max_parallel=max_parallel):
+            results[index] = result
+
+        return results
+
+    async def stream_cmd(self, command_string, env=None, cwd=None):
+        async with self.get_session(negotiate=False) as session:
+            async for item in self.send_stream_request(session.connection,
+                    command_string, env=env, cwd=cwd):
+                yield item
@@ -1,23 +1,88 @@
 import collections
+import errno
+import fcntl
+import itertools
 import logging
 import multiprocessing
 import numbers
-import pickle
+import os
+import select
 import signal
 import subprocess
 import six
 import sys
-import uuid
+import threading
+import time
 
 from .. import constants
+from .. import serializers
+from .. import shm
 from .. import __version__
-from ..exceptions import DisconnectedError, SessionClosedError, UnknownMethodError
+from ..batch import CommandBatch
+from ..cache import cache_key, start_cache
+from ..metrics import ServerMetrics, serve_metrics
+from ..exceptions import (DisconnectedError, ProtocolError, ServerBusyError,
+    SessionClosedError, UnknownMethodError, UnsupportedError)
 
 
 logger = logging.getLogger(__name__)
 
 RAW_TYPES = six.string_types+(six.binary_type, numbers.Number, BaseException)
 
+# methods whose results are plain values, which are never exposed
+PLAIN_METHODS = ('RUN', 'HELLO', 'STREAM', 'STATS', 'DEL', 'BATCH')
+
+STREAM_CHUNK_SIZE = 65536
+
+# body chunks at least this large are sent on their own instead of being
+# copied into the message
+SEND_COPY_LIMIT = 65536
+
+# seconds between checks for pre-forked workers that have exited
+PREFORK_POLL_INTERVAL = 0.5
+
+# seconds between WorkerPool scaling checks
+SCALE_INTERVAL = 0.1
+
+# seconds between queue depth checks while accepting is on hold
+QUEUE_POLL_INTERVAL = 0.01
+
+OVERLOAD_POLICIES = ('reject', 'block')
+
+# a command's standard streams, which clients may give it descriptors for
+STDIO_NAMES = ('stdin', 'stdout', 'stderr')
+
+# response headers reporting where a request's time went, sent when the
+# request has an X-Timing header
+TIMING_HEADERS = (
+    ('queue_wait', 'X-Queue-Wait'),
+    ('spawn', 'X-Spawn'),
+    ('execution', 'X-Exec'),
+    ('serialize', 'X-Serialize'),
+)
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# most objects a session may have exposed at once before the least recently
+# used are evicted
+DEFAULT_MAX_SESSION_OBJECTS = 1000
+
+# remote objects the client has let go of are released once this many are
+# queued, with one DEL request
+RELEASE_BATCH = 32
+
+# most requests with ids a connection may have handled at once, each in a
+# thread of its own
+MAX_CONCURRENT_REQUESTS = 16
+
+# set for the new master when a server hands over its listening socket
+LISTEN_FD_ENV = 'ERRAND_BOY_LISTEN_FD'
+DRAINING_PIDS_ENV = 'ERRAND_BOY_DRAINING_PIDS'
+
+def version_tuple(version):
+    return tuple(int(part) for part in version.split('.')[:3] if part.isdigit())
+
+
 try:
     from setproctitle import setproctitle
 except ImportError:
@@ -25,12 +90,123 @@ except ImportError:
     setproctitle = lambda title: None
 
 
+class ConnectionPool(object):
+    """
+    Keeps idle client connections open so later sessions can reuse them
+    instead of connecting again.
+
+    At most max_size idle connections are kept. Connections idle for longer
+    than idle_timeout seconds are closed, and connections which fail the
+    transport's health check are dropped when they're taken out of the pool.
+    """
+
+    def __init__(self, transport, max_size=10, idle_timeout=30):
+        self.transport = transport
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # idle connections and locks don't survive being sent to another
+        # process
+        return self.transport, self.max_size, self.idle_timeout
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _evict(self, now):
+        # oldest connections are on the left
+        expired = []
+
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+
+        return expired
+
+    def _take_idle(self):
+        now = time.time()
+
+        with self._lock:
+            stale = self._evict(now)
+            connection = None
+
+            while self._idle:
+                candidate = self._idle.pop()[0]
+
+                if self.transport.client_connection_alive(candidate):
+                    connection = candidate
+                    break
+
+                stale.append(candidate)
+
+        for candidate in stale:
+            self.discard(candidate)
+
+        return connection
+
+    def acquire(self):
+        connection = self._take_idle()
+
+        if connection is None:
+            connection = self.transport.client_connect()
+
+        return connection
+
+    def release(self, connection):
+        now = time.time()
+
+        with self._lock:
+            stale = self._evict(now)
+
+            if len(self._idle) < self.max_size:
+                self._idle.append((connection, now))
+            else:
+                stale.append(connection)
+
+        for candidate in stale:
+            self.discard(candidate)
+
+    def discard(self, connection):
+        self.transport.forget_connection(connection)
+
+        try:
+            self.transport.client_close(connection)
+        except Exception as e:
+            logger.exception(e)
+
+    def clear(self):
+        with self._lock:
+            idle = [connection for connection, released in self._idle]
+            self._idle.clear()
+
+        for connection in idle:
+            self.discard(connection)
+
+
 class ClientSession(object):
-    def __init__(self, transport):
+    def __init__(self, transport, pool=None, negotiate=True):
         self.transport = transport
-        self.connection = transport.client_get_connection()
+        self.pool = pool
+
+        if pool is not None:
+            self.connection = pool.acquire()
+        else:
+            self.connection = transport.client_connect(negotiate=negotiate)
+
         self._closed = True
 
+        # names of remote objects waiting to be released
+        self._released = []
+        # whether the server has exposed any objects to this session
+        self._exposed = False
+        # names of the results of pipelined requests
+        self._promise_names = itertools.count(1)
+
     @property
     def closed(self):
         return self._closed
@@ -42,8 +218,53 @@ class ClientSession(object):
         self._closed = False
         return self
 
+    def pipeline(self):
+        return Pipeline(self)
+
+    def _release(self, name):
+        # called from RemoteObjWrapper.__del__, which may run in the middle
+        # of a request, so only queue the name
+        if not self._closed:
+            self._released.append(name)
+
+    def _flush_released(self):
+        if len(self._released) < RELEASE_BATCH:
+            return
+
+        names, self._released = self._released, []
+
+        self.transport.send_del_request(self.connection, names)
+
+    def _release_all(self):
+        """
+        Releases every object the session exposed, which the server would
+        otherwise keep for the next session on the same connection. Returns
+        whether the connection can be reused.
+        """
+        self._released = []
+
+        if not self._exposed:
+            return True
+
+        try:
+            self.transport.send_del_request(self.connection, [])
+        except Exception as e:
+            logger.exception(e)
+            return False
+
+        return True
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._closed = True
+
+        # a connection that saw an error may be out of step with the
+        # server, so only clean exits go back to the pool
+        if self.pool is not None and exc_type is None and self._release_all():
+            self.pool.release(self.connection)
+            return False
+
+        self.transport.forget_connection(self.connection)
+
         try:
             self.transport.client_close(self.connection)
         except Exception as e:
@@ -66,9 +287,14 @@ class RemoteObjRef(object):
 class RemoteObjWrapper(object):
     _patch_functions = ['next', '__next__', '__iter__']
 
-    def __init__(self, session, name):
+    def __init__(self, session, name, handle=False):
+        """
+        handle is true for objects the server exposed to the session, which
+        are released when the wrapper is garbage collected.
+        """
         self.session = session
         self.name = name
+        self.handle = handle
 
         self._property_cache = {}
 
@@ -88,13 +314,21 @@ class RemoteObjWrapper(object):
         else:
             raise UnknownMethodError(method)
 
+        session._flush_released()
+
         ret = func(session.connection, self.name, *args, **kwargs)
 
         if isinstance(ret, RemoteObjRef):
-            ret = RemoteObjWrapper(session, ret.name)
+            session._exposed = True
+            ret = RemoteObjWrapper(session, ret.name, handle=True)
 
         return ret
 
+    def __del__(self):
+        # missing attributes are remote, so don't look them up
+        if self.__dict__.get('handle'):
+            self.session._release(self.name)
+
     def __getattr__(self, name):
         return self._send('GET', name)
 
@@ -121,328 +355,2869 @@ class RemoteObjWrapper(object):
         return self._get_prop('__iter__')
 
 
-class Request(object):
-    def __init__(self, method, path, headers, body):
-        self.method = method
-        self.path = path
-        self.headers = headers
-        self.body = body
+class MultiplexedConnection(object):
+    """
+    A connection carrying requests from several threads at once.
 
+    Each request gets an id, which the server tags its responses with. A
+    thread waiting for a response reads whichever one arrives next and
+    queues it for the thread it's for, so no thread is needed just to read.
+    Servers which can't tell requests apart get them one at a time.
+    """
 
-class Response(object):
-    def __init__(self, status, headers, body):
-        self.status = status
-        self.headers = headers
-        self.body = body
+    def __init__(self, transport):
+        self.transport = transport
+        self.connection = transport.client_connect(negotiate=False)
 
+        hello = {}
 
-def worker_init(*args):
-    name = multiprocessing.current_process().name
-    logger.debug('Worker initialized: {}'.format(name))
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-    setproctitle('errand-boy worker process {}'.format(name.split('-')[1]))
+        if transport.framing != 'text':
+            hello = transport.client_hello(self.connection)
 
+        # only binary frames carry request ids
+        self.multiplexed = (bool(hello.get('multiplex'))
+            and id(self.connection) in transport._binary_connections)
 
-def worker(self, connection):
-    logger.debug('worker connected')
-    self.server_handle_client(connection)
+        transport._send_locks[id(self.connection)] = threading.Lock()
 
+        # set once the connection is broken
+        self.error = None
 
-class BaseTransport(object):
-    """
-    Base class providing functionality common to all transports.
-    """
+        self._ids = itertools.count()
+        # the responses read for each request in flight, by request id
+        self._responses = {}
+        self._reading = False
+        self._changed = threading.Condition()
+        # held by the request in flight when they can't be told apart
+        self._turn = None if self.multiplexed else threading.Lock()
 
-    def __init__(self):
-        pass
+    def _next_id(self):
+        if self._turn is not None:
+            self._turn.acquire()
+            return 0
 
-    def connection_to_string(self, connection):
-        return repr(connection)
+        # ids are 32 bit, and requests without one have 0
+        return next(self._ids) % 0xFFFFFFFF + 1
 
-    def server_get_connection(self):
-        raise NotImplementedError()
+    def _begin(self, method, path, body, headers):
+        request_id = self._next_id()
 
-    def server_recv(self, connection):
-        raise NotImplementedError()
+        with self._changed:
+            self._responses[request_id] = collections.deque()
 
-    def server_send(self, connection, data):
-        raise NotImplementedError()
+        try:
+            self.transport.write_request_frame(self.connection, method, path,
+                body=body, headers=headers, request_id=request_id)
+        except Exception as e:
+            self._fail(e)
+            self._end(request_id, False)
+            raise
 
-    def server_close(self, connection):
-        pass
+        return request_id
 
-    def translate_obj(self, exposed_locals, val):
-        if isinstance(val, RemoteObjRef):
-            val = exposed_locals[val.name]
-        return val
+    def _end(self, request_id, finished):
+        with self._changed:
+            self._responses.pop(request_id, None)
 
-    def server_serialize(self, exposed_locals, obj):
-        if obj is not None and not isinstance(obj, RAW_TYPES):
-            name = six.text_type(uuid.uuid4())
-            exposed_locals[name] = obj
-            obj = RemoteObjRef(name)
-        return obj
+        if self._turn is not None:
+            # the rest of its responses would be taken for the next request's
+            if not finished:
+                self._fail(ProtocolError('Request abandoned before its last response.'))
 
-    def server_handle_client(self, connection):
-        connection = self.server_deserialize_connection(connection)
+            self._turn.release()
 
-        logger.debug('server_handle_client: {}'.format(self.connection_to_string(connection)))
+    def _fail(self, error):
+        with self._changed:
+            if self.error is not None:
+                return
 
-        exposed_locals = {'subprocess': subprocess}
+            self.error = error
+            self._changed.notify_all()
 
-        while True:
-            # need to close connection when client not listening
-            try:
-                 request = self.get_request(connection)
-            except DisconnectedError:
-                 break
+        self.close()
 
-            raised = False
-            obj = None
+    def alive(self):
+        """
+        Returns whether the connection can take more requests. One with
+        none in flight is checked for the server having closed it, as it
+        does once the keepalive timeout passes, and marked broken if so.
+        """
+        with self._changed:
+            if self.error is not None:
+                return False
 
-            if request.method == 'GET':
-                name, attr = request.path.split('.')
-                try:
-                    obj = getattr(exposed_locals[name], attr)
-                except KeyError as e:
-                    obj = e
-                    raised = True
-            elif request.method == 'CALL':
-                name = request.path
-                try:
-                    obj = exposed_locals[name]
-                except KeyError as e:
-                    obj = e
-                    raised = True
+            # a request can't start while the lock is held
+            if self._responses or self.transport.client_connection_alive(self.connection):
+                return True
 
-                args, kwargs = pickle.loads(request.body)
+        self._fail(DisconnectedError())
 
-                args = [self.translate_obj(exposed_locals, arg) for arg in args]
+        return False
 
-                for key in kwargs:
-                    kwargs[key] = self.translate_obj(exposed_locals, kwargs[key])
+    def _wait(self, request_id):
+        """
+        Returns the request's next response once it's been read, or None
+        when the calling thread should read it.
+        """
+        with self._changed:
+            while True:
+                if self.error is not None:
+                    raise DisconnectedError()
 
-                try:
-                    obj = obj(*args, **kwargs)
-                except Exception as e:
-                    obj = e
-                    raised = True
+                responses = self._responses[request_id]
 
-            obj = self.server_serialize(exposed_locals, obj)
+                if responses:
+                    return responses.popleft()
 
-            self.send_response(connection, obj, raised=raised)
+                if not self._reading:
+                    self._reading = True
+                    return None
 
-        self.server_close(connection)
+                self._changed.wait()
 
-    def server_accept(self, serverconnection):
-        raise NotImplementedError()
+    def _read(self):
+        resp = None
 
-    def server_deserialize_connection(self, connection):
-        return connection
+        try:
+            resp = self.transport.get_response(self.connection)
+        except Exception as e:
+            self._fail(e)
+            raise
+        finally:
+            with self._changed:
+                self._reading = False
 
-    def server_serialize_connection(self, connection):
-        return connection
+                # responses to abandoned requests are dropped
+                if resp is not None and resp.request_id in self._responses:
+                    self._responses[resp.request_id].append(resp)
 
-    def run_server(self, pool_size=10, max_accepts=5000, max_child_tasks=100):
-        setproctitle('errand-boy master process')
+                self._changed.notify_all()
 
-        serverconnection = self.server_get_connection()
+    def exchange(self, method, path, body='', headers=None):
+        """
+        Sends a request and yields its responses, up to the first one which
+        isn't 206 Partial.
+        """
+        request_id = self._begin(method, path, body, headers)
+        finished = False
 
-        logger.info('Accepting connections: {}'.format(self.connection_to_string(serverconnection)))
-        logger.info('pool_size: {}'.format(pool_size))
-        logger.info('max_accepts: {}'.format(max_accepts))
-        logger.info('max_child_tasks: {}'.format(max_child_tasks))
+        try:
+            while not finished:
+                resp = self._wait(request_id)
 
-        pool = multiprocessing.Pool(pool_size, worker_init, tuple(), max_child_tasks)
+                if resp is None:
+                    self._read()
+                    continue
 
-        connections = []
+                finished = resp.status != 206
 
-        remaining_accepts = max_accepts
+                yield resp
+        finally:
+            self._end(request_id, finished)
 
-        if not remaining_accepts:
-            remaining_accepts = True
+    def close(self):
+        self.transport.forget_connection(self.connection)
 
         try:
-            while remaining_accepts:
-                connection = self.server_accept(serverconnection)
+            self.transport.client_close(self.connection)
+        except Exception as e:
+            logger.exception(e)
 
-                logger.info('Accepted connection from: {}'.format(self.connection_to_string(connection)))
 
-                result = pool.apply_async(worker, [self, self.server_serialize_connection(connection)])
+class MultiplexedSession(object):
+    """
+    A session which any number of threads can use at once, over a single
+    connection. The connection is replaced when it breaks or the server
+    closes it, or when the session is used in a process forked after it
+    connected.
 
-                connection = None
+    session = transport.get_multiplexed_session()
 
-                if remaining_accepts is not True:
-                    remaining_accepts -= 1
-        except KeyboardInterrupt:
-            logger.info('Received KeyboardInterrupt')
-            pool.terminate()
-        except Exception as e:
-            logger.exception(e)
-            pool.terminate()
-            raise
-        finally:
-            pool.close()
-            pool.join()
+    stdout, stderr, returncode = session.run_cmd('ls -al')
+    """
 
-    def client_get_connection(self):
-        raise NotImplementedError()
+    def __init__(self, transport):
+        self.transport = transport
 
-    def client_recv(self, connection):
-        raise NotImplementedError()
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._closed = False
 
-    def client_send(self, connection, command_string):
-        raise NotImplementedError()
+    @property
+    def closed(self):
+        return self._closed
 
-    def client_close(self, connection):
-        pass
+    def __enter__(self):
+        return self
 
-    def send_algo(self, connection, send_func, first_line, headers=None, body=None):
-        CRLF = constants.CRLF
-        msg = [first_line]
-        msg.append(CRLF)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
 
-        if headers:
-            for name, val in headers:
-                msg.append('{}: {}'.format(name, val))
-                msg.append(CRLF)
+    def _get_connection(self):
+        with self._lock:
+            if self._closed:
+                raise SessionClosedError()
 
-        msg.append('Content-Length: {}'.format(len(body)))
-        msg.append(CRLF)
+            connection = self._connection
 
-        if body:
-            msg.append(CRLF)
-            msg.append(body)
+            if connection is None or self._pid != os.getpid() or not connection.alive():
+                connection = self._connection = MultiplexedConnection(self.transport)
+                self._pid = os.getpid()
 
-        msg = [s.encode('utf-8') if hasattr(s, 'encode') else s for s in msg]
+            return connection
 
-        msg = b''.join(msg)
+    def exchange(self, method, path, body='', headers=None):
+        return self._get_connection().exchange(method, path, body=body, headers=headers)
 
-        return send_func(connection, msg)
+    def request(self, method, path, body='', headers=None):
+        """
+        Sends a request and returns its last response.
+        """
+        for resp in self.exchange(method, path, body=body, headers=headers):
+            pass
 
-    def send_request(self, connection, method, path, body=''):
-        first_line = "{method} {path}".format(method=method, path=path)
-        self.send_algo(connection, self.client_send, first_line, headers=None, body=body)
+        return resp
 
-        resp = self.get_response(connection)
+    def run_cmd(self, command_string, env=None, cwd=None, timing=False,
+            request_id=None, cache_ttl=None):
+        body, headers = self.transport.encode_run_cmd(command_string, env, cwd,
+            timing, request_id, cache_ttl)
 
-        obj = pickle.loads(resp.body)
+        started = time.time()
 
-        if resp.status == 400:
-            raise obj
+        return self.transport.decode_run_cmd(self.request('RUN', 'subprocess',
+            body=body, headers=headers), timing, started)
 
-        return obj
+    def iter_cmds(self, commands, env=None, cwd=None, max_parallel=None):
+        body = self.transport.encode_args((commands,), {'env': env, 'cwd': cwd,
+            'max_parallel': max_parallel})
 
-    def send_get_request(self, connection, prefix, name):
-        return self.send_request(connection, 'GET', prefix+'.'+name)
+        return self.transport.decode_batch(self.exchange('BATCH', 'subprocess', body=body))
 
-    def send_call_request(self, connection, name, *args, **kwargs):
-        kwargs = collections.OrderedDict(sorted(kwargs.items(), key=lambda t: t[0]))
-        body = pickle.dumps([args, kwargs])
+    def run_cmds(self, commands, env=None, cwd=None, max_parallel=None):
+        return in_order(self.iter_cmds(commands, env=env, cwd=cwd,
+            max_parallel=max_parallel), len(commands))
 
-        return self.send_request(connection, 'CALL', name, body=body)
+    def stream_cmd(self, command_string, env=None, cwd=None):
+        body = self.transport.encode_args((command_string,), {'env': env, 'cwd': cwd})
 
-    def recv_algo(self, connection, recv_func):
-        CRLF = constants.CRLF
+        return self.transport.decode_stream(self.exchange('STREAM', 'subprocess', body=body))
 
-        lines = []
-        data = b''
+    def get_stats(self):
+        return self.transport.decode_response(self.request('STATS', 'server'))
 
-        content_length = None
+    def close(self):
+        with self._lock:
+            self._closed = True
+            connection, self._connection = self._connection, None
 
-        while True:
-            new_data = recv_func(connection, 4096)
+        # a connection inherited from the parent process is left to it
+        if connection is not None and self._pid == os.getpid():
+            connection.close()
 
-            if not new_data:
-                raise DisconnectedError()
 
-            data += new_data
+class Pipeline(object):
+    """
+    Queues requests instead of sending them. Attribute accesses and calls
+    return Promises of their results, which later requests can use as
+    their target or arguments:
 
-            if not lines and CRLF in data:
-                try:
-                    headers, body = data.split(CRLF + CRLF, 1)
-                except ValueError:
-                    split_data = data.split(CRLF)
-                    lines.extend(split_data[:-1])
-                    data = split_data[-1]
-                else:
-                    lines.extend((headers + CRLF).split(CRLF))
-                    data = body
-
-            if lines and content_length is None:
-                for line in lines:
-                    try:
-                        header, val = line.split(b': ')
-                        if header.lower() == b'content-length':
-                            content_length = int(val)
-                            break
-                    except ValueError:
-                        pass
-
-            if content_length == 0 and len(lines) > 1:
-                break
+    pipeline = session.pipeline()
+    subprocess = pipeline.subprocess
+    process = subprocess.Popen(['ls'], stdout=subprocess.PIPE)
+    output = process.communicate()
 
-            if len(lines) > 2 and lines[-1] == b'':
-                # needs length of body, minus already fetched data
-                remaining_len = content_length - len(data)
+    stdout, stderr = pipeline.resolve(output)
 
-                if remaining_len:
-                    data += recv_func(connection, remaining_len)
+    resolve() sends every queued request at once and reads all of their
+    responses, so the chain costs one round trip.
+    """
 
-                # only break once all data has been returned
-                if len(data) == content_length:
-                    break
+    def __init__(self, session):
+        self.session = session
 
-        if data:
-            data = CRLF + data
-        data = CRLF.join(lines) + data
+        self._pending = []
+        # (result, raised) of each resolved promise, by name
+        self._results = {}
 
-        try:
-            headers, body = data.split(CRLF+CRLF)
-        except ValueError:
-            headers = data
-            body = b''
+    def __getattr__(self, name):
+        # a root every session starts with, which needs no request
+        return Promise(self, name)
 
-        headers = headers.split(CRLF)
-        headers = [header.decode('utf-8') for header in headers]
-        first_line = headers[0]
-        headers = headers[1:]
+    def _queue(self, method, path, depends, body=''):
+        session = self.session
 
-        headers = [header.split(': ') for header in headers]
-        return first_line, headers, body
+        if session.closed:
+            raise SessionClosedError()
 
-    def get_request(self, connection):
-        first_line, headers, body = self.recv_algo(connection, self.server_recv)
+        promise = Promise(self, 'p{}'.format(next(session._promise_names)), depends)
+        promise._owned = True
 
-        method, path = first_line.split(' ', 1)
+        # the server keeps every result for later requests
+        session._exposed = True
 
-        return Request(method, path, headers, body)
+        self._pending.append((promise, method, path, body))
 
-    def send_response(self, connection, obj, raised=False):
-        body = pickle.dumps(obj)
+        return promise
 
-        first_line = '200 OK' if not raised else '400 Error'
+    def _queue_call(self, target, args, kwargs):
+        depends = [target]
 
-        return self.send_algo(connection, self.server_send, first_line, body=body)
+        def ref(arg):
+            if not isinstance(arg, Promise):
+                return arg
 
-    def get_response(self, connection):
-        first_line, headers, body = self.recv_algo(connection, self.client_recv)
+            depends.append(arg)
+            return RemoteObjRef(arg._name)
 
-        status = int(first_line.split()[0])
+        args = tuple(ref(arg) for arg in args)
+        kwargs = dict((key, ref(value)) for key, value in kwargs.items())
 
-        return Response(status, headers, body)
+        body = self.session.transport.encode_args(args, kwargs)
 
-    def get_session(self):
-        return ClientSession(self)
+        return self._queue('CALL', target._name, depends, body)
 
-    def run_cmd(self, command_string):
-        with self.get_session() as session:
-            subprocess = session.subprocess
+    def _result(self, promise, resp):
+        # a request fails when one it depends on did, report the cause
+        for depend in promise._depends:
+            result = self._results.get(depend._name)
 
-            process = subprocess.Popen(command_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result is not None and result[1]:
+                return result
 
-            stdout, stderr = process.communicate()
+        obj = self.session.transport.deserialize_body(resp.body)
+
+        if resp.status == 400:
+            return obj, True
+
+        if isinstance(obj, RemoteObjRef):
+            # the wrapper releases it from now on
+            promise._owned = False
+            obj = RemoteObjWrapper(self.session, obj.name, handle=True)
+
+        return obj, False
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+
+        if not pending:
+            return
+
+        session = self.session
+        transport = session.transport
+
+        session._flush_released()
+
+        transport.send_request_frames(session.connection, [
+            (method, path, body, [('X-Promise', promise._name)])
+            for promise, method, path, body in pending
+        ])
+
+        for promise, method, path, body in pending:
+            self._results[promise._name] = self._result(promise,
+                transport.get_response(session.connection))
+
+    def resolve(self, promise):
+        """
+        Sends the queued requests and returns the promise's result. Raises
+        what its request raised, or what the first request it depended on
+        raised.
+        """
+        self._flush()
+
+        try:
+            obj, raised = self._results[promise._name]
+        except KeyError:
+            return RemoteObjWrapper(self.session, promise._name)
+
+        if raised:
+            raise obj
+
+        return obj
+
+
+class Promise(object):
+    """
+    The result of a request queued on a Pipeline. Attribute accesses and
+    calls queue more requests.
+    """
+
+    def __init__(self, pipeline, name, depends=()):
+        self._pipeline = pipeline
+        self._name = name
+        # promises the request uses, whose failures it inherits
+        self._depends = depends
+        # whether this promise releases the result when garbage collected
+        self._owned = False
+
+    def __del__(self):
+        if self.__dict__.get('_owned'):
+            self._pipeline.session._release(self._name)
+
+    def __getattr__(self, name):
+        return self._pipeline._queue('GET', self._name + '.' + name, [self])
+
+    def __call__(self, *args, **kwargs):
+        return self._pipeline._queue_call(self, args, kwargs)
+
+
+class ExposedLocals(object):
+    """
+    The objects a session's requests can refer to by name: roots, which
+    every session starts with, and the objects exposed to the client since,
+    named by integer handles.
+
+    Once more than max_size objects are exposed, the least recently used
+    are evicted, and requests referring to them fail with a KeyError.
+    """
+
+    def __init__(self, roots, max_size=DEFAULT_MAX_SESSION_OBJECTS):
+        self.roots = roots
+        self.max_size = max_size
+
+        self._objects = collections.OrderedDict()
+        self._handles = itertools.count(1)
+        # multiplexed requests are handled in threads of their own
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, name):
+        return name in self.roots or name in self._objects
+
+    def __getitem__(self, name):
+        if name in self.roots:
+            return self.roots[name]
+
+        with self._lock:
+            # most recently used last
+            obj = self._objects.pop(name)
+            self._objects[name] = obj
+
+        return obj
+
+    def bind(self, name, obj):
+        with self._lock:
+            self._objects[name] = obj
+
+            while self.max_size and len(self._objects) > self.max_size:
+                self._objects.popitem(last=False)
+
+    def expose(self, obj):
+        """
+        Returns the name obj is exposed under.
+        """
+        name = six.text_type(next(self._handles))
+
+        self.bind(name, obj)
+
+        return name
+
+    def release(self, names):
+        with self._lock:
+            for name in names:
+                self._objects.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+
+class RequestThreads(object):
+    """
+    Handles a connection's requests in threads, at most max_size at once.
+    Starting another waits for one of them to finish.
+    """
+
+    def __init__(self, max_size=MAX_CONCURRENT_REQUESTS):
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    def _run(self, target, args):
+        try:
+            target(*args)
+        finally:
+            with self._lock:
+                self._threads.discard(threading.current_thread())
+
+            self._slots.release()
+
+    def start(self, target, *args):
+        self._slots.acquire()
+
+        thread = threading.Thread(target=self._run, args=(target, args))
+        thread.daemon = True
+
+        with self._lock:
+            self._threads.add(thread)
+
+        thread.start()
+
+    def active(self):
+        with self._lock:
+            return bool(self._threads)
+
+    def join(self):
+        with self._lock:
+            threads = list(self._threads)
+
+        for thread in threads:
+            thread.join()
+
+
+def body_chunks(body):
+    """
+    Returns a message body, which may be a list of chunks, as a list of
+    chunks.
+    """
+    if not body:
+        return []
+
+    if isinstance(body, list):
+        return body
+
+    return [body]
+
+
+def iter_input(input):
+    """
+    Yields the chunks of a command's input, given as bytes, a file or an
+    iterable of chunks.
+    """
+    if isinstance(input, six.binary_type):
+        # slices of a memoryview aren't copies, but Python 2 can't join them
+        # with bytes
+        view = input if six.PY2 else memoryview(input)
+
+        for start in range(0, len(view), STREAM_CHUNK_SIZE):
+            yield view[start:start + STREAM_CHUNK_SIZE]
+    elif hasattr(input, 'read'):
+        while True:
+            chunk = input.read(STREAM_CHUNK_SIZE)
+
+            if not chunk:
+                return
+
+            yield chunk
+    else:
+        for chunk in input:
+            yield chunk
+
+
+def write_input(fd, data):
+    """
+    Writes all of data to fd, returning False when the reader has gone
+    away.
+    """
+    view = memoryview(data)
+
+    try:
+        while view:
+            view = view[os.write(fd, view):]
+    except OSError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        return False
+
+    return True
+
+
+def in_order(results, count):
+    """
+    Returns the results of (index, result) pairs as a list, in the order of
+    their indexes.
+    """
+    ordered = [None] * count
+
+    for index, result in results:
+        ordered[index] = result
+
+    return ordered
+
+
+def get_header(headers, name, default=None):
+    for header in headers:
+        if header[0] == name:
+            return header[1]
+
+    return default
+
+
+class Request(object):
+    def __init__(self, method, path, headers, body, request_id=0):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.request_id = request_id
+
+        # seconds spent on each part of handling the request, by the names
+        # in TIMING_HEADERS
+        self.timings = {}
+
+        # 'hit' or 'miss' when the result cache was asked for the result
+        self.cache = None
+
+
+class Response(object):
+    def __init__(self, status, headers, body, request_id=0):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.request_id = request_id
+
+
+class Timing(object):
+    """
+    Where the time of a request went, in seconds. total is measured by the
+    client, the rest are reported by the server and are None when it didn't.
+
+    cache is 'hit' or 'miss' when the server's result cache was asked for
+    the result.
+    """
+
+    def __init__(self, total, request_id=None, queue_wait=None, spawn=None,
+            execution=None, serialize=None, cache=None):
+        self.total = total
+        self.request_id = request_id
+        self.queue_wait = queue_wait
+        self.spawn = spawn
+        self.execution = execution
+        self.serialize = serialize
+        self.cache = cache
+
+    @classmethod
+    def from_response(cls, response, total):
+        kwargs = {}
+
+        for name, header in TIMING_HEADERS:
+            value = get_header(response.headers, header)
+
+            if value is not None:
+                kwargs[name] = float(value)
+
+        return cls(total, request_id=get_header(response.headers, 'X-Request-Id'),
+            cache=get_header(response.headers, 'X-Cache'), **kwargs)
+
+    def __repr__(self):
+        return '<Timing total={} request_id={} queue_wait={} spawn={} execution={} serialize={} cache={}>'.format(
+            self.total, self.request_id, self.queue_wait, self.spawn,
+            self.execution, self.serialize, self.cache)
+
+
+# metrics and result cache of the server a multiprocessing.Pool worker
+# belongs to, which aren't pickled along with the transport
+pool_metrics = None
+pool_cache = None
+
+
+def worker_init(metrics=None, cache=None):
+    global pool_metrics, pool_cache
+    pool_metrics = metrics
+    pool_cache = cache
+
+    name = multiprocessing.current_process().name
+    logger.debug('Worker initialized: {}'.format(name))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setproctitle('errand-boy worker process {}'.format(name.split('-')[1]))
+
+
+def worker(self, connection, accepted_at=None):
+    logger.debug('worker connected')
+
+    if self.metrics is None:
+        self.metrics = pool_metrics
+    if self.cache is None:
+        self.cache = pool_cache
+
+    self.server_connection_taken(accepted_at)
+
+    try:
+        self.server_handle_client(connection)
+    except Exception as e:
+        logger.exception(e)
+
+
+def pool_worker(self, tasks, pending, busy, max_child_tasks):
+    worker_init()
+
+    handled = 0
+
+    while not max_child_tasks or handled < max_child_tasks:
+        task = tasks.get()
+
+        # the pool is closing or has more workers than it needs
+        if task is None:
+            break
+
+        connection, accepted_at = task
+
+        self.server_connection_taken(accepted_at)
+
+        with busy.get_lock():
+            busy.value += 1
+
+        try:
+            logger.debug('worker connected')
+
+            try:
+                connection = self.server_deserialize_connection(connection)
+            finally:
+                # only taken once the master's part of the hand-off is done
+                with pending.get_lock():
+                    pending.value -= 1
+
+            self.server_handle_connection(connection)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with busy.get_lock():
+                busy.value -= 1
+
+        handled += 1
+
+
+class WorkerPool(object):
+    """
+    Worker processes which grow and shrink with the load, serving the
+    connections the master submits.
+
+    At least min_workers processes are kept running. More are started, up
+    to max_workers, when connections are queued behind busy workers or have
+    been waiting for longer than scale_up_wait seconds. Once some workers
+    have been idle for idle_timeout seconds, one of them is retired, and
+    another one every idle_timeout seconds after that.
+    """
+
+    def __init__(self, transport, min_workers, max_workers, max_child_tasks=100,
+            idle_timeout=60, scale_up_wait=0.1):
+        if min_workers > max_workers:
+            raise ValueError('min_workers is larger than max_workers')
+
+        self.transport = transport
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.max_child_tasks = max_child_tasks
+        self.idle_timeout = idle_timeout
+        self.scale_up_wait = scale_up_wait
+
+        self.tasks = multiprocessing.Queue()
+        self.pending = multiprocessing.Value('i', 0)
+        self.busy = multiprocessing.Value('i', 0)
+
+        self.workers = []
+
+        # workers left by a previous master, finishing their sessions
+        self._adopted = []
+
+        self._queued_at = collections.deque()
+        self._surplus_since = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self):
+        self.scale()
+
+        supervisor = threading.Thread(target=self._supervise)
+        supervisor.daemon = True
+        supervisor.start()
+
+    def _supervise(self):
+        while not self._closed:
+            time.sleep(SCALE_INTERVAL)
+            self.scale()
+
+    def _start_worker(self):
+        process = multiprocessing.Process(target=pool_worker,
+            args=(self.transport, self.tasks, self.pending, self.busy, self.max_child_tasks))
+        process.daemon = True
+        process.start()
+
+        self.workers.append(process)
+        self._record_size()
+
+    def _record_size(self):
+        if self.transport.metrics is not None:
+            self.transport.metrics.workers.set(len(self.workers))
+
+    def submit(self, connection, accepted_at=None):
+        """
+        Queues a connection serialized with server_serialize_connection,
+        accepted at the time accepted_at.
+        """
+        with self._lock:
+            with self.pending.get_lock():
+                self.pending.value += 1
+
+            self._queued_at.append(time.time())
+
+        self.tasks.put((connection, accepted_at))
+
+        self.scale()
+
+    def adopt(self, pids):
+        """
+        Takes on the draining workers of the master this process replaced, so
+        they're reaped once they exit.
+        """
+        self._adopted.extend(pids)
+
+    def _reap(self):
+        for process in list(self.workers):
+            if not process.is_alive():
+                process.join()
+                self.workers.remove(process)
+                self._record_size()
+
+        for pid in list(self._adopted):
+            try:
+                reaped, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                # already gone
+                reaped = pid
+
+            if reaped:
+                self._adopted.remove(pid)
+
+    def _wanted(self, now, pending, size, idle):
+        # connections are taken in order, so only the newest ones are
+        # still queued
+        while len(self._queued_at) > pending:
+            self._queued_at.popleft()
+
+        # replace workers which exited after max_child_tasks
+        wanted = self.min_workers - size
+
+        if pending > idle:
+            wanted = max(wanted, pending - idle)
+        elif pending and now - self._queued_at[0] > self.scale_up_wait:
+            wanted = max(wanted, 1)
+
+        return min(wanted, self.max_workers - size)
+
+    def _retire_idle(self, now, pending, size, idle):
+        if pending or idle <= 0 or size <= self.min_workers:
+            self._surplus_since = None
+        elif self._surplus_since is None:
+            self._surplus_since = now
+        elif now - self._surplus_since >= self.idle_timeout:
+            logger.info('Retiring a worker, workers: {}'.format(size))
+
+            # whichever idle worker takes this exits
+            self.tasks.put(None)
+            self._surplus_since = now
+
+    def scale(self):
+        with self._lock:
+            if self._closed:
+                return
+
+            now = time.time()
+
+            self._reap()
+
+            pending = self.pending.value
+            size = len(self.workers)
+            idle = size - self.busy.value
+
+            wanted = self._wanted(now, pending, size, idle)
+
+            if wanted <= 0:
+                self._retire_idle(now, pending, size, idle)
+                return
+
+            logger.info('Starting {} worker(s), pending: {}, workers: {}'.format(wanted, pending, size))
+
+            for i in six.moves.range(wanted):
+                self._start_worker()
+
+            self._surplus_since = None
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+
+            self._closed = True
+
+            for process in self.workers:
+                self.tasks.put(None)
+
+    def detach(self, timeout=10):
+        """
+        Closes the pool for a handover, returning the pids of the workers,
+        which exit once they've served the queued connections.
+
+        Queued connections can only be taken while this process is around,
+        so extra workers are started for those the idle workers can't take,
+        and this waits up to timeout seconds for them to be taken.
+        """
+        with self._lock:
+            self._closed = True
+
+            extra = self.pending.value - (len(self.workers) - self.busy.value)
+
+            for i in six.moves.range(extra):
+                self._start_worker()
+
+            for process in self.workers:
+                self.tasks.put(None)
+
+        deadline = time.time() + timeout
+
+        while self.pending.value > 0 and time.time() < deadline:
+            time.sleep(QUEUE_POLL_INTERVAL)
+
+        if self.pending.value > 0:
+            logger.warning('Handing over with {} connection(s) still queued'.format(self.pending.value))
+
+        # the workers' sentinels have to be written out before exec
+        self.tasks.close()
+        self.tasks.join_thread()
+
+        return [process.pid for process in self.workers] + self._adopted
+
+    def terminate(self):
+        with self._lock:
+            self._closed = True
+
+            for process in self.workers:
+                process.terminate()
+
+            for pid in self._adopted:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def join(self):
+        for process in self.workers:
+            process.join()
+
+        for pid in self._adopted:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+
+def prefork_worker(self, serverconnection, remaining_accepts, max_child_tasks):
+    """
+    Accepts connections on the inherited listening socket and serves them
+    until max_child_tasks connections have been handled, or the server's
+    remaining accepts run out.
+    """
+    worker_init()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    handled = 0
+
+    while not max_child_tasks or handled < max_child_tasks:
+        if remaining_accepts is not None:
+            with remaining_accepts.get_lock():
+                if remaining_accepts.value <= 0:
+                    break
+                remaining_accepts.value -= 1
+
+        connection = self.server_accept(serverconnection)
+
+        logger.info('Accepted connection from: {}'.format(self.connection_to_string(connection)))
+
+        self.server_count('accepts')
+
+        # a client hanging up mid-response mustn't take the worker down
+        try:
+            self.server_handle_connection(connection)
+        except Exception as e:
+            logger.exception(e)
+
+        handled += 1
+
+
+class BaseTransport(object):
+    """
+    Base class providing functionality common to all transports.
+    """
+
+    connection_pool_class = ConnectionPool
+
+    # whether file descriptors can be passed over connections
+    passes_fds = False
+
+    def __init__(self, client_pool_size=0, client_pool_idle_timeout=30,
+            framing='auto', fail_fast=False, serializer='pickle', shm_threshold=None):
+        """
+        framing is 'auto' to ask the server for binary framing on each new
+        connection that may carry more than one request, 'binary' to use it
+        without asking, or 'text' to always use the text protocol.
+
+        With fail_fast, connecting raises ServerBusyError straight away when
+        the server isn't accepting connections, instead of waiting for it.
+
+        serializer names the serializer requests are sent with, see
+        errand_boy.serializers. Servers answer with the one the request
+        used, and fall back to pickle for what it can't serialize.
+
+        Bodies of at least shm_threshold bytes are passed in shared memory
+        instead of being copied through the connection, both ways, by
+        transports which can pass file descriptors.
+        """
+        if framing not in ('auto', 'binary', 'text'):
+            raise ValueError('Unknown framing: {}'.format(framing))
+
+        if shm_threshold and not self.passes_fds:
+            raise ValueError('{} can\'t pass shared memory.'.format(type(self).__name__))
+
+        self.framing = framing
+        self.fail_fast = fail_fast
+        self.serializer = serializers.get_serializer(serializer)
+        self.shm_threshold = shm_threshold
+
+        self.server_keepalive_timeout = None
+        self.server_max_session_objects = DEFAULT_MAX_SESSION_OBJECTS
+
+        # how long the connection being served waited for this worker
+        self.server_queue_wait = None
+
+        # ServerMetrics while running a server
+        self.metrics = None
+
+        # proxy of the ResultCache shared by the workers, when enabled
+        self.cache = None
+        self._cache_manager = None
+
+        # bytes read past the end of a message, by id(connection)
+        self._recv_buffers = {}
+        # ids of connections using binary framing
+        self._binary_connections = set()
+        # locks keeping whole messages together on connections which several
+        # threads send on, by id(connection)
+        self._send_locks = {}
+        # the smallest body to send in shared memory on each connection
+        # whose other end takes them, by id(connection)
+        self._shm_connections = {}
+        # ids of connections which descriptors may be passed over
+        self._fd_connections = set()
+        # descriptors to pass with the next send, and ones received but not
+        # yet claimed by a message, by id(connection)
+        self._pending_fds = {}
+        self._received_fds = {}
+        # ids of connections whose server runs commands on descriptors
+        # passed with the request
+        self._stdio_connections = set()
+        # ids of connections whose server takes commands' input in INPUT
+        # frames
+        self._input_connections = set()
+
+        if client_pool_size:
+            self.client_pool = self.connection_pool_class(self, client_pool_size,
+                client_pool_idle_timeout)
+        else:
+            self.client_pool = None
+
+    def __getstate__(self):
+        # metrics are in shared memory, which workers can only inherit, and
+        # the cache is handed to them the same way
+        state = self.__dict__.copy()
+        state['metrics'] = None
+        state['cache'] = None
+        state['_cache_manager'] = None
+        state['_send_locks'] = {}
+        state['_pending_fds'] = {}
+        state['_received_fds'] = {}
+        return state
+
+    def connection_to_string(self, connection):
+        return repr(connection)
+
+    def server_get_connection(self):
+        raise NotImplementedError()
+
+    def server_recv(self, connection):
+        raise NotImplementedError()
+
+    def server_send(self, connection, data):
+        raise NotImplementedError()
+
+    def server_recv_into(self, connection, buf):
+        data = self.server_recv(connection, len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def server_close(self, connection):
+        pass
+
+    def server_set_timeout(self, connection, timeout):
+        pass
+
+    def server_wait_readable(self, connection, timeout):
+        return True
+
+    def server_count(self, name, amount=1):
+        if self.metrics is not None:
+            getattr(self.metrics, name).inc(amount)
+
+    def server_observe(self, name, value):
+        if self.metrics is not None:
+            getattr(self.metrics, name).observe(value)
+
+    def server_record_request(self, request):
+        request_id = get_header(request.headers, 'X-Request-Id')
+
+        if request_id is not None:
+            logger.info('Request {}: {} {}'.format(request_id, request.method, request.path))
+
+        # only the first request on a connection waited in the queue
+        if self.server_queue_wait is not None:
+            request.timings['queue_wait'] = self.server_queue_wait
+            self.server_queue_wait = None
+
+        if self.metrics is not None:
+            self.metrics.requests.inc()
+            self.metrics.bytes_in.observe(len(request.body))
+
+    def server_connection_taken(self, accepted_at):
+        """
+        Records how long a connection accepted at accepted_at waited for a
+        worker.
+        """
+        if accepted_at is not None:
+            self.server_queue_wait = time.time() - accepted_at
+
+            self.server_count('queued', -1)
+            self.server_observe('queue_wait', self.server_queue_wait)
+
+    def server_command_finished(self, started, spawned, timings=None):
+        spawn = spawned - started
+        execution = time.time() - spawned
+
+        self.server_observe('spawn', spawn)
+        self.server_observe('execution', execution)
+
+        if timings is not None:
+            timings['spawn'] = spawn
+            timings['execution'] = execution
+
+    def translate_obj(self, exposed_locals, val):
+        if isinstance(val, RemoteObjRef):
+            val = exposed_locals[val.name]
+        return val
+
+    def server_serialize(self, exposed_locals, obj):
+        if obj is not None and not isinstance(obj, RAW_TYPES):
+            obj = RemoteObjRef(exposed_locals.expose(obj))
+        return obj
+
+    def server_bind_promise(self, exposed_locals, name, obj):
+        """
+        Keeps the result of a pipelined request under the name the client
+        gave it, which later requests use before the client has seen it.
+        Returns what to send back.
+        """
+        exposed_locals.bind(name, obj)
+
+        if obj is not None and not isinstance(obj, RAW_TYPES):
+            obj = RemoteObjRef(name)
+
+        return obj
+
+    def server_exposed_locals(self):
+        """
+        Returns the ExposedLocals of a new session.
+        """
+        return ExposedLocals({'subprocess': subprocess}, self.server_max_session_objects)
+
+    def server_popen(self, command, env=None, cwd=None, stdio=None):
+        """
+        Starts the command with pipes for its output. stdio maps the names
+        of its standard streams to descriptors to use instead, which are
+        closed once it's started.
+        """
+        shell = isinstance(command, six.string_types)
+        stdio = stdio or {}
+
+        try:
+            return subprocess.Popen(command, shell=shell, stdin=stdio.get('stdin'),
+                stdout=stdio.get('stdout', subprocess.PIPE),
+                stderr=stdio.get('stderr', subprocess.PIPE), env=env, cwd=cwd)
+        finally:
+            # the command has its own copies
+            for fd in stdio.values():
+                os.close(fd)
+
+    def server_run_cmd(self, command, env=None, cwd=None, timings=None, stdio=None):
+        """
+        See server_popen() for stdio. The output of streams given a
+        descriptor is returned as None.
+        """
+        started = time.time()
+
+        process = self.server_popen(command, env=env, cwd=cwd, stdio=stdio)
+
+        spawned = time.time()
+
+        stdout, stderr = process.communicate()
+
+        self.server_command_finished(started, spawned, timings)
+
+        return stdout, stderr, process.returncode
+
+    def server_run_cmd_input(self, connection, command, env=None, cwd=None,
+            timings=None, stdio=None):
+        """
+        Runs the command like server_run_cmd(), writing the INPUT frames the
+        client sends after the request to its stdin as they arrive.
+
+        Frames are only read as fast as the command reads its input, which
+        in turn stops the client once the connection's buffers fill up.
+        """
+        read_fd, write_fd = os.pipe()
+
+        # Python 2's pipes are inherited, and a command holding the write
+        # end would never see the end of its input
+        fcntl.fcntl(write_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+        started = time.time()
+
+        try:
+            process = self.server_popen(command, env=env, cwd=cwd,
+                stdio=dict(stdio or {}, stdin=read_fd))
+        except Exception:
+            os.close(write_fd)
+            self.server_feed_input(connection, None)
+            raise
+
+        spawned = time.time()
+
+        # the output is read while the input is written, or a command
+        # writing more than a pipe holds would wait for us forever
+        output = []
+        reader = threading.Thread(target=lambda: output.extend(process.communicate()))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            self.server_feed_input(connection, write_fd)
+        except Exception:
+            # the reader is left to finish once the command's gone, which a
+            # shell's children may outlive
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            os.close(write_fd)
+
+        reader.join()
+
+        self.server_command_finished(started, spawned, timings)
+
+        stdout, stderr = output
+
+        return stdout, stderr, process.returncode
+
+    def server_feed_input(self, connection, fd):
+        """
+        Writes the bodies of the INPUT frames following a request to fd, up
+        to the empty one ending them. Once the command stops reading, or
+        without fd, the rest are read and dropped.
+        """
+        while True:
+            request = self.get_request(connection)
+
+            if request.method != 'INPUT':
+                raise ProtocolError('Expected INPUT, got {}.'.format(request.method))
+
+            if not len(request.body):
+                return
+
+            if fd is not None and not write_input(fd, request.body):
+                fd = None
+
+    def server_run_cmd_shared(self, threshold, command, env=None, cwd=None, timings=None):
+        """
+        Runs the command like server_run_cmd(), but with its stdout going
+        straight to shared memory, so the server never copies it. Returns
+        the result as a SharedBody when its output is at least threshold
+        bytes.
+        """
+        shell = isinstance(command, six.string_types)
+
+        fd = shm.create_file()
+
+        try:
+            # leaves room for the start of the result, written once it's known
+            os.lseek(fd, serializers.RESULT_OFFSET, os.SEEK_SET)
+
+            started = time.time()
+
+            process = subprocess.Popen(command, shell=shell, stdout=fd,
+                stderr=subprocess.PIPE, env=env, cwd=cwd)
+
+            spawned = time.time()
+
+            stdout, stderr = process.communicate()
+        except Exception:
+            os.close(fd)
+            raise
+
+        self.server_command_finished(started, spawned, timings)
+
+        return shm.result_body(fd, stderr, process.returncode, threshold)
+
+    def server_stream_cmd(self, connection, command, env=None, cwd=None,
+            timings=None, request_id=0):
+        """
+        Sends the command's output to the client as it's produced, and
+        returns its return code.
+
+        Sending blocks while the client isn't reading, which in turn stops
+        the command once its pipes fill up.
+        """
+        shell = isinstance(command, six.string_types)
+
+        started = time.time()
+
+        process = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, env=env, cwd=cwd)
+
+        spawned = time.time()
+
+        pipes = {
+            process.stdout.fileno(): (process.stdout, 'stdout'),
+            process.stderr.fileno(): (process.stderr, 'stderr'),
+        }
+
+        try:
+            while pipes:
+                readable, writable, exceptional = select.select(list(pipes), [], [])
+
+                for fd in readable:
+                    chunk = os.read(fd, STREAM_CHUNK_SIZE)
+
+                    if not chunk:
+                        pipe, stream = pipes.pop(fd)
+                        pipe.close()
+                        continue
+
+                    self.send_chunk(connection, pipes[fd][1], chunk, request_id)
+        except Exception:
+            # the client went away, don't leave the command running
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            raise
+
+        returncode = process.wait()
+
+        self.server_command_finished(started, spawned, timings)
+
+        return returncode
+
+    def server_run_cmds(self, connection, commands, env=None, cwd=None,
+            max_parallel=None, serializer=None, timings=None, request_id=0):
+        """
+        Runs the commands, up to max_parallel at a time, sending each one's
+        result to the client as soon as it finishes. Returns how many
+        commands there were.
+        """
+        started = time.time()
+
+        def finished(index, result, command_started, spawned):
+            if spawned is not None:
+                self.server_command_finished(command_started, spawned)
+
+            self.send_batch_result(connection, index, result, serializer, request_id)
+
+        CommandBatch(commands, env=env, cwd=cwd, max_parallel=max_parallel).run(finished)
+
+        if timings is not None:
+            timings['execution'] = time.time() - started
+
+        return len(commands)
+
+    def server_hello(self, client_version):
+        if version_tuple(client_version) >= constants.BINARY_FRAMING_VERSION:
+            framing = 'binary'
+        else:
+            framing = 'text'
+
+        # requests are told apart by the ids in binary frames
+        return {'version': __version__, 'framing': framing, 'multiplex': framing == 'binary',
+            'input': True}
+
+    def server_handle_get(self, connection, exposed_locals, request):
+        name, attr = request.path.split('.')
+
+        try:
+            return getattr(exposed_locals[name], attr), False
+        except Exception as e:
+            return e, True
+
+    def server_handle_call(self, connection, exposed_locals, request):
+        try:
+            obj = exposed_locals[request.path]
+        except KeyError as e:
+            return e, True
+
+        args, kwargs = self.deserialize_body(request.body)
+
+        try:
+            # arguments may refer to objects which were released, or to
+            # the results of pipelined requests which failed
+            args = [self.translate_obj(exposed_locals, arg) for arg in args]
+
+            for key in kwargs:
+                kwargs[key] = self.translate_obj(exposed_locals, kwargs[key])
+
+            return obj(*args, **kwargs), False
+        except Exception as e:
+            return e, True
+
+    def server_cache_ttl(self, request):
+        """
+        Returns how many seconds old a cached result the request accepts, or
+        None when it shouldn't use the cache.
+        """
+        ttl = get_header(request.headers, 'X-Cache-TTL')
+
+        if self.cache is None or ttl is None:
+            return None
+
+        return float(ttl)
+
+    def server_claim_result(self, key, ttl):
+        """
+        Returns (result, claimed) like ResultCache.claim(), or (None, False)
+        when the cache can't be reached, which happens once a handed over
+        master's cache is gone.
+        """
+        try:
+            return self.cache.claim(key, ttl)
+        except (EOFError, IOError, OSError) as e:
+            logger.warning('Result cache unavailable: {}'.format(e))
+            return None, False
+
+    def server_cached_run_cmd(self, request, command, env=None, cwd=None):
+        """
+        Runs the command like server_run_cmd(), unless the request accepts a
+        cached result and one is cached. Identical requests arriving while
+        the command runs wait for its result.
+        """
+        ttl = self.server_cache_ttl(request)
+
+        if ttl is None:
+            return self.server_run_cmd(command, env=env, cwd=cwd, timings=request.timings)
+
+        key = cache_key(command, env, cwd)
+
+        result, claimed = self.server_claim_result(key, ttl)
+
+        if result is not None:
+            request.cache = 'hit'
+            self.server_count('cache_hits')
+            return result
+
+        request.cache = 'miss'
+        self.server_count('cache_misses')
+
+        try:
+            result = self.server_run_cmd(command, env=env, cwd=cwd, timings=request.timings)
+        except Exception:
+            if claimed:
+                self.cache.release(key)
+            raise
+
+        if claimed:
+            stdout, stderr, returncode = result
+            self.cache.store(key, result, ttl, len(stdout) + len(stderr))
+
+        return result
+
+    def server_handle_run(self, connection, exposed_locals, request):
+        args, kwargs = self.deserialize_body(request.body)
+
+        threshold = self._shm_connections.get(id(connection))
+
+        try:
+            stdio = self.server_stdio(connection, request)
+
+            if get_header(request.headers, 'X-Input'):
+                return self.server_run_cmd_input(connection, *args,
+                    timings=request.timings, stdio=stdio, **kwargs), False
+
+            if stdio:
+                return self.server_run_cmd(*args, timings=request.timings,
+                    stdio=stdio, **kwargs), False
+
+            # cached results are kept in the server's own memory
+            if threshold and self.server_cache_ttl(request) is None:
+                return self.server_run_cmd_shared(threshold, *args,
+                    timings=request.timings, **kwargs), False
+
+            return self.server_cached_run_cmd(request, *args, **kwargs), False
+        except Exception as e:
+            return e, True
+
+    def server_stdio(self, connection, request):
+        """
+        Returns the descriptors passed with a request for the command's
+        standard streams, by the names its X-Stdio header lists them in.
+        """
+        names = get_header(request.headers, 'X-Stdio')
+
+        if not names:
+            return {}
+
+        names = names.split(',')
+        fds = self._received_fds.get(id(connection))
+
+        if not fds or len(fds) < len(names):
+            raise ProtocolError('Standard streams without descriptors.')
+
+        stdio = dict((name, fds.popleft()) for name in names)
+
+        if not set(stdio) <= set(STDIO_NAMES):
+            for fd in stdio.values():
+                os.close(fd)
+
+            raise ProtocolError('Unknown standard streams: {}'.format(','.join(names)))
+
+        return stdio
+
+    def server_handle_hello(self, connection, exposed_locals, request):
+        hello = self.server_hello(request.path)
+
+        # clients asking to pass descriptors for commands' standard streams
+        if self.passes_fds and get_header(request.headers, 'X-Pass-Fds'):
+            hello['fds'] = True
+            self._fd_connections.add(id(connection))
+
+        # a client taking bodies in shared memory may send them too, once
+        # it's been told it can
+        if id(connection) in self._shm_connections:
+            hello['shm'] = True
+            self._fd_connections.add(id(connection))
+
+        return hello, False
+
+    def server_handle_stats(self, connection, exposed_locals, request):
+        if self.metrics is None:
+            return None, False
+
+        return self.metrics.snapshot(), False
+
+    def server_handle_stream(self, connection, exposed_locals, request):
+        args, kwargs = self.deserialize_body(request.body)
+
+        try:
+            return self.server_stream_cmd(connection, *args, timings=request.timings,
+                request_id=request.request_id, **kwargs), False
+        except Exception as e:
+            return e, True
+
+    def server_handle_batch(self, connection, exposed_locals, request):
+        args, kwargs = self.deserialize_body(request.body)
+
+        try:
+            return self.server_run_cmds(connection, *args, serializer=serializers.detect(request.body),
+                timings=request.timings, request_id=request.request_id, **kwargs), False
+        except Exception as e:
+            return e, True
+
+    def server_handle_del(self, connection, exposed_locals, request):
+        # the path lists the objects to release, or is empty to release all
+        # of them
+        if request.path:
+            exposed_locals.release(request.path.split(','))
+        else:
+            exposed_locals.clear()
+
+        return None, False
+
+    # names of the methods handling each request method
+    request_handlers = {
+        'GET': 'server_handle_get',
+        'CALL': 'server_handle_call',
+        'RUN': 'server_handle_run',
+        'HELLO': 'server_handle_hello',
+        'STREAM': 'server_handle_stream',
+        'STATS': 'server_handle_stats',
+        'DEL': 'server_handle_del',
+        'BATCH': 'server_handle_batch',
+    }
+
+    def server_handle_request(self, connection, exposed_locals, request):
+        """
+        Handles one request, returning the result and whether it was raised.
+        Unknown methods get None.
+        """
+        obj, raised = None, False
+
+        handler = self.request_handlers.get(request.method)
+
+        if handler is not None:
+            obj, raised = getattr(self, handler)(connection, exposed_locals, request)
+
+        promise = get_header(request.headers, 'X-Promise')
+
+        if promise is not None and not raised:
+            obj = self.server_bind_promise(exposed_locals, promise, obj)
+        elif request.method not in PLAIN_METHODS:
+            obj = self.server_serialize(exposed_locals, obj)
+
+        return obj, raised
+
+    def server_handle_client(self, connection):
+        self.server_handle_connection(self.server_deserialize_connection(connection))
+
+    def server_handle_connection(self, connection):
+        logger.debug('server_handle_client: {}'.format(self.connection_to_string(connection)))
+
+        exposed_locals = self.server_exposed_locals()
+
+        # requests with ids, which the client doesn't wait for one at a time
+        threads = RequestThreads()
+
+        self.server_count('busy')
+
+        # keep serving the connection until the client goes away or stays
+        # idle for longer than the keepalive timeout
+        try:
+            while True:
+                if self.server_keepalive_timeout:
+                    self.server_wait_request(connection, threads)
+
+                # need to close connection when client not listening
+                try:
+                    request = self.get_request(connection)
+                except DisconnectedError:
+                    break
+
+                if self.server_keepalive_timeout:
+                    self.server_set_timeout(connection, None)
+
+                self.server_record_request(request)
+
+                if request.request_id:
+                    self._send_locks.setdefault(id(connection), threading.Lock())
+                    threads.start(self.server_respond_concurrently, connection, exposed_locals, request)
+                else:
+                    self.server_respond(connection, exposed_locals, request)
+        finally:
+            # answer the requests already taken before hanging up
+            threads.join()
+
+            self.server_count('busy', -1)
+            self.forget_connection(connection)
+            self.server_close(connection)
+
+    def server_wait_request(self, connection, threads):
+        """
+        Starts the keepalive timeout before the next request is read.
+
+        Only waiting for the next request is limited, a slow reader of a
+        streamed response isn't idle. A connection with requests still
+        being answered from threads isn't idle either, and a timeout on
+        its socket would also limit their responses, so it's waited on
+        without one until they're done.
+        """
+        while threads.active():
+            if self._recv_buffers.get(id(connection)):
+                return
+
+            if self.server_wait_readable(connection, self.server_keepalive_timeout):
+                return
+
+        # only this thread starts requests, so none can start meanwhile
+        self.server_set_timeout(connection, self.server_keepalive_timeout)
+
+    def server_respond(self, connection, exposed_locals, request):
+        obj, raised = self.server_handle_request(connection, exposed_locals, request)
+
+        self.send_response(connection, obj, raised=raised, request=request)
+
+    def server_respond_concurrently(self, connection, exposed_locals, request):
+        # runs in a thread of its own, whose errors would go unseen
+        try:
+            self.server_respond(connection, exposed_locals, request)
+        except Exception as e:
+            logger.debug('Failed to answer request {}: {}'.format(request.request_id, e))
+
+    def server_reject(self, connection):
+        """
+        Turns a connection away with 503 Busy when the queue is full.
+        """
+        try:
+            self.send_algo(connection, self.server_send, '503 Busy', body=b'')
+        except Exception as e:
+            logger.debug('Failed to reject connection: {}'.format(e))
+        finally:
+            self.server_close(connection)
+
+    def server_accept(self, serverconnection):
+        raise NotImplementedError()
+
+    def server_inherit_connection(self, fd):
+        raise NotImplementedError()
+
+    def server_listen_fd(self, serverconnection):
+        raise NotImplementedError()
+
+    def server_listen(self):
+        """
+        Takes over the listening socket handed over by the previous master,
+        or makes a new one.
+        """
+        listen_fd = os.environ.pop(LISTEN_FD_ENV, None)
+
+        if listen_fd is None:
+            return self.server_get_connection()
+
+        return self.server_inherit_connection(int(listen_fd))
+
+    def server_handover(self, serverconnection, pool, argv, timeout=10):
+        """
+        Replaces this master with a new one running argv, which keeps
+        accepting on the same listening socket, so connections made during
+        the restart wait in the listen backlog instead of failing. The
+        current workers exit after finishing their sessions.
+        """
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(self.server_listen_fd(serverconnection))
+        env[DRAINING_PIDS_ENV] = ','.join(str(pid) for pid in pool.detach(timeout))
+
+        # the new master starts a cache of its own, draining workers run
+        # their commands without one
+        self.server_stop_cache()
+
+        logger.info('Handing over to: {}'.format(' '.join(argv)))
+
+        os.execve(argv[0], argv, env)
+
+    def server_deserialize_connection(self, connection):
+        return connection
+
+    def server_serialize_connection(self, connection):
+        return connection
+
+    def server_create_pool(self, pool_size, max_child_tasks, min_workers=None,
+            max_workers=None, worker_idle_timeout=60, handover=False):
+        """
+        Giving min_workers or max_workers returns a WorkerPool which grows
+        and shrinks between them with the load, otherwise a
+        multiprocessing.Pool of pool_size workers.
+
+        With handover a WorkerPool of pool_size workers is used instead of
+        the multiprocessing.Pool, whose workers are fed by threads in the
+        master and so can't finish their connections once it's replaced.
+        """
+        if min_workers is None and max_workers is None:
+            if not handover:
+                self.server_count('workers', pool_size)
+
+                return multiprocessing.Pool(pool_size, worker_init, (self.metrics, self.cache),
+                    max_child_tasks)
+
+            logger.info('Using a fixed size WorkerPool for the handover')
+
+            min_workers = max_workers = pool_size
+
+        if min_workers is None:
+            min_workers = min(pool_size, max_workers)
+        if max_workers is None:
+            max_workers = max(pool_size, min_workers)
+
+        logger.info('min_workers: {}'.format(min_workers))
+        logger.info('max_workers: {}'.format(max_workers))
+
+        pool = WorkerPool(self, min_workers, max_workers, max_child_tasks,
+            idle_timeout=worker_idle_timeout)
+
+        draining_pids = os.environ.pop(DRAINING_PIDS_ENV, None)
+
+        if draining_pids:
+            pool.adopt(int(pid) for pid in draining_pids.split(','))
+
+        pool.start()
+
+        return pool
+
+    def server_queue_full(self, pool, results, pool_size, max_queue):
+        """
+        Whether another connection would leave more than max_queue waiting
+        for a free worker. results are the unfinished results of the
+        connections handed to a multiprocessing.Pool.
+        """
+        if max_queue is None:
+            return False
+
+        if isinstance(pool, WorkerPool):
+            return pool.pending.value + pool.busy.value - pool.max_workers >= max_queue
+
+        results[:] = [result for result in results if not result.ready()]
+
+        return len(results) - pool_size >= max_queue
+
+    def server_accept_loop(self, serverconnection, pool, pool_size, max_accepts,
+            max_queue=None, overload='reject'):
+        # only needed to tell how full a multiprocessing.Pool is
+        track_results = max_queue is not None and not isinstance(pool, WorkerPool)
+        results = []
+
+        remaining_accepts = max_accepts or True
+
+        while remaining_accepts:
+            while overload == 'block' and self.server_queue_full(pool, results, pool_size, max_queue):
+                time.sleep(QUEUE_POLL_INTERVAL)
+
+            connection = self.server_accept(serverconnection)
+            accepted_at = time.time()
+
+            logger.info('Accepted connection from: {}'.format(self.connection_to_string(connection)))
+
+            self.server_count('accepts')
+
+            if overload == 'reject' and self.server_queue_full(pool, results, pool_size, max_queue):
+                logger.warning('Queue is full, rejecting connection')
+                self.server_count('rejects')
+                self.server_reject(connection)
+                continue
+
+            connection = self.server_serialize_connection(connection)
+
+            self.server_count('queued')
+
+            if isinstance(pool, WorkerPool):
+                pool.submit(connection, accepted_at)
+            else:
+                result = pool.apply_async(worker, [self, connection, accepted_at])
+
+                if track_results:
+                    results.append(result)
+
+            if remaining_accepts is not True:
+                remaining_accepts -= 1
+
+    def run_server(self, pool_size=10, max_accepts=5000, max_child_tasks=100,
+            keepalive_timeout=None, prefork=False, min_workers=None,
+            max_workers=None, worker_idle_timeout=60, max_queue=None,
+            overload='reject', handover_argv=None, handover_timeout=10,
+            metrics_port=None, cache_size=0, cache_bytes=DEFAULT_CACHE_BYTES,
+            max_session_objects=DEFAULT_MAX_SESSION_OBJECTS):
+        """
+        Giving min_workers or max_workers makes the worker pool grow and
+        shrink between them with the load, otherwise pool_size workers are
+        kept running.
+
+        max_queue limits how many accepted connections may wait for a free
+        worker. Once it's reached, overload='reject' answers new connections
+        with 503 Busy and overload='block' stops accepting until a worker
+        frees up.
+
+        Giving handover_argv replaces the master with a new one running it
+        after max_accepts connections, instead of exiting. The listening
+        socket is handed over, and the old workers get up to
+        handover_timeout seconds to take the queued connections.
+
+        Metrics from the master and every worker are returned by STATS
+        requests, and served to Prometheus over HTTP on localhost when
+        metrics_port is given.
+
+        A cache_size enables the result cache shared by the workers, which
+        keeps up to cache_size results of up to cache_bytes in total for
+        clients which ask for cached results.
+
+        Each session may have up to max_session_objects remote objects at
+        once, the least recently used are evicted after that. 0 doesn't
+        limit them.
+        """
+        if overload not in OVERLOAD_POLICIES:
+            raise ValueError('Unknown overload policy: {}'.format(overload))
+
+        if prefork:
+            self.server_check_prefork(min_workers, max_workers, max_queue, handover_argv)
+
+        setproctitle('errand-boy master process')
+
+        self.server_keepalive_timeout = keepalive_timeout
+        self.server_max_session_objects = max_session_objects
+
+        # before any workers are forked, so they share them
+        self.server_start_metrics(metrics_port)
+        self.server_start_cache(cache_size, cache_bytes)
+
+        serverconnection = self.server_listen()
+
+        logger.info('Accepting connections: {}'.format(self.connection_to_string(serverconnection)))
+        logger.info('pool_size: {}'.format(pool_size))
+        logger.info('max_accepts: {}'.format(max_accepts))
+        logger.info('max_child_tasks: {}'.format(max_child_tasks))
+        logger.info('keepalive_timeout: {}'.format(keepalive_timeout))
+        logger.info('prefork: {}'.format(prefork))
+        logger.info('worker_idle_timeout: {}'.format(worker_idle_timeout))
+        logger.info('max_queue: {}'.format(max_queue))
+        logger.info('overload: {}'.format(overload))
+        logger.info('handover_argv: {}'.format(handover_argv))
+        logger.info('metrics_port: {}'.format(metrics_port))
+        logger.info('cache_size: {}'.format(cache_size))
+        logger.info('cache_bytes: {}'.format(cache_bytes))
+        logger.info('max_session_objects: {}'.format(max_session_objects))
+
+        try:
+            if prefork:
+                return self.run_prefork_server(serverconnection, pool_size,
+                    max_accepts, max_child_tasks)
+
+            self.server_run_pool(serverconnection, pool_size, max_accepts,
+                max_child_tasks, min_workers, max_workers, worker_idle_timeout,
+                max_queue, overload, handover_argv, handover_timeout)
+        finally:
+            self.server_stop_cache()
+
+    def server_run_pool(self, serverconnection, pool_size, max_accepts,
+            max_child_tasks, min_workers, max_workers, worker_idle_timeout,
+            max_queue, overload, handover_argv, handover_timeout):
+        pool = self.server_create_pool(pool_size, max_child_tasks, min_workers,
+            max_workers, worker_idle_timeout, handover=handover_argv is not None)
+
+        try:
+            self.server_accept_loop(serverconnection, pool, pool_size,
+                max_accepts, max_queue, overload)
+
+            if handover_argv is not None:
+                self.server_handover(serverconnection, pool, handover_argv, handover_timeout)
+        except KeyboardInterrupt:
+            logger.info('Received KeyboardInterrupt')
+            pool.terminate()
+        except Exception as e:
+            logger.exception(e)
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+    def server_start_metrics(self, metrics_port=None):
+        self.metrics = ServerMetrics()
+
+        if metrics_port is not None:
+            serve_metrics(self.metrics, metrics_port)
+
+    def server_start_cache(self, cache_size=0, cache_bytes=DEFAULT_CACHE_BYTES):
+        if cache_size:
+            self._cache_manager, self.cache = start_cache(cache_size, cache_bytes)
+
+    def server_stop_cache(self):
+        if self._cache_manager is not None:
+            self.cache = None
+            self._cache_manager.shutdown()
+            self._cache_manager = None
+
+    def server_check_prefork(self, min_workers, max_workers, max_queue, handover_argv):
+        if min_workers is not None or max_workers is not None:
+            raise ValueError('Pre-forked workers can\'t be scaled.')
+
+        if max_queue is not None:
+            raise ValueError('Pre-forked workers don\'t queue connections.')
+
+        if handover_argv is not None:
+            raise ValueError('Pre-forked workers can\'t be handed over.')
+
+    def server_replace_workers(self, workers, start_worker, remaining_accepts):
+        """
+        Reaps exited pre-forked workers, starting new ones while there are
+        accepts left.
+        """
+        for process in list(workers):
+            if process.is_alive():
+                continue
+
+            process.join()
+            workers.remove(process)
+
+            if remaining_accepts is None or remaining_accepts.value > 0:
+                workers.append(start_worker())
+
+    def run_prefork_server(self, serverconnection, pool_size, max_accepts,
+            max_child_tasks):
+        """
+        Workers accept connections on the listening socket themselves, so
+        the master only restarts them as they exit.
+        """
+        if max_accepts:
+            remaining_accepts = multiprocessing.Value('i', max_accepts)
+        else:
+            remaining_accepts = None
+
+        def start_worker():
+            process = multiprocessing.Process(target=prefork_worker,
+                args=(self, serverconnection, remaining_accepts, max_child_tasks))
+            process.daemon = True
+            process.start()
+            return process
+
+        def terminate(signum, frame):
+            sys.exit(0)
+
+        # workers would otherwise be left blocking in accept()
+        signal.signal(signal.SIGTERM, terminate)
+
+        workers = [start_worker() for i in six.moves.range(pool_size)]
+
+        self.server_count('workers', pool_size)
+
+        try:
+            while workers:
+                time.sleep(PREFORK_POLL_INTERVAL)
+
+                self.server_replace_workers(workers, start_worker, remaining_accepts)
+        except KeyboardInterrupt:
+            logger.info('Received KeyboardInterrupt')
+        except Exception as e:
+            logger.exception(e)
+            raise
+        finally:
+            for process in workers:
+                process.terminate()
+            for process in workers:
+                process.join()
+
+    def client_get_connection(self):
+        raise NotImplementedError()
+
+    def client_connect(self, negotiate=True):
+        """
+        negotiate=False skips asking for binary framing, which costs a round
+        trip, on a connection that will only carry one request.
+        """
+        connection = self.client_get_connection()
+
+        if self.framing == 'binary':
+            self._binary_connections.add(id(connection))
+        elif self.framing == 'auto' and negotiate:
+            self.client_hello(connection)
+
+        return connection
+
+    def client_recv(self, connection):
+        raise NotImplementedError()
+
+    def client_send(self, connection, command_string):
+        raise NotImplementedError()
+
+    def client_recv_into(self, connection, buf):
+        data = self.client_recv(connection, len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def client_close(self, connection):
+        pass
+
+    def client_hello(self, connection, pass_fds=False):
+        """
+        Tells the server the client's version, whether it takes bodies in
+        shared memory and, with pass_fds, that it would pass descriptors for
+        commands' standard streams, switching the connection to what the
+        server agrees to. Returns the server's answer.
+        """
+        hello = self.send_request(connection, 'HELLO', __version__,
+            headers=[('X-Pass-Fds', '1')] if pass_fds else None)
+
+        # servers from before HELLO existed answer unknown methods with None
+        if not isinstance(hello, dict):
+            return {}
+
+        # clients asking for other reasons may have been told to use text
+        if hello.get('framing') == 'binary' and self.framing != 'text':
+            self._binary_connections.add(id(connection))
+
+        if hello.get('shm'):
+            self._shm_connections[id(connection)] = self.shm_threshold
+
+        if hello.get('fds'):
+            self._stdio_connections.add(id(connection))
+
+        if hello.get('input'):
+            self._input_connections.add(id(connection))
+
+        return hello
+
+    def client_stdio(self, stdin=None, stdout=None, stderr=None):
+        """
+        Returns the headers naming the client's files, or descriptors, given
+        for a command's standard streams, and their descriptors.
+        """
+        names = []
+        fds = []
+
+        for name, f in zip(STDIO_NAMES, (stdin, stdout, stderr)):
+            if f is not None:
+                names.append(name)
+                fds.append(f if isinstance(f, numbers.Integral) else f.fileno())
+
+        if not fds:
+            return [], []
+
+        if not self.passes_fds:
+            raise ValueError('{} can\'t pass descriptors.'.format(type(self).__name__))
+
+        return [('X-Stdio', ','.join(names))], fds
+
+    def client_pass_stdio(self, connection, fds):
+        """
+        Returns copies of fds to send with the next request, once the server
+        has agreed to take them on the connection. Sending closes them.
+        """
+        if id(connection) not in self._stdio_connections:
+            self.client_hello(connection, pass_fds=True)
+
+        if id(connection) not in self._stdio_connections:
+            raise UnsupportedError('The server can\'t take descriptors.')
+
+        return [os.dup(fd) for fd in fds]
+
+    def client_check_input(self, connection):
+        """
+        Makes sure the server takes commands' input on the connection, asking
+        it when it hasn't said yet.
+        """
+        if id(connection) not in self._input_connections:
+            self.client_hello(connection)
+
+        if id(connection) not in self._input_connections:
+            raise UnknownMethodError('INPUT')
+
+    def send_input(self, connection, input):
+        """
+        Sends a command's input, see iter_input(), in INPUT frames following
+        its request, and an empty one to end it.
+        """
+        for chunk in iter_input(input):
+            if len(chunk):
+                self.send_request_frame(connection, 'INPUT', 'stdin', body=chunk)
+
+        self.send_request_frame(connection, 'INPUT', 'stdin')
+
+    def client_shm_headers(self, connection):
+        """
+        Returns the headers offering to take response bodies of at least
+        shm_threshold bytes in shared memory, which every request has when
+        the client can.
+        """
+        if not self.shm_threshold:
+            return []
+
+        # their descriptors may come with any response from now on
+        self._fd_connections.add(id(connection))
+
+        return [('X-Accept-Shm', self.shm_threshold)]
+
+    def client_connection_alive(self, connection):
+        return True
+
+    def send_chunks(self, connection, send_func, chunks, fds=()):
+        """
+        Sends chunks, joining the small ones and sending large ones as they
+        are, so they aren't copied. fds are passed along with them, by
+        transports which can.
+        """
+        lock = self._send_locks.get(id(connection))
+
+        if lock is None:
+            return self._send_chunks(connection, send_func, chunks, fds)
+
+        with lock:
+            return self._send_chunks(connection, send_func, chunks, fds)
+
+    def _send_chunks(self, connection, send_func, chunks, fds):
+        if fds:
+            # taken by the next send on the connection
+            self._pending_fds.setdefault(id(connection), []).extend(fds)
+
+        small = []
+
+        for chunk in chunks:
+            if len(chunk) < SEND_COPY_LIMIT:
+                small.append(chunk)
+                continue
+
+            if small:
+                send_func(connection, b''.join(small))
+                small = []
+
+            send_func(connection, chunk)
+
+        if small:
+            return send_func(connection, b''.join(small))
+
+    def send_algo(self, connection, send_func, first_line, headers=None, body=None, fds=()):
+        """
+        Sends a message, whose body may be a list of chunks, passing fds
+        along with it.
+        """
+        CRLF = constants.CRLF
+        msg = [first_line]
+        msg.append(CRLF)
+
+        headers, chunks, shm_fds = self.shm_chunks(connection, headers, body)
+
+        # the body's come first, since it's claimed while reading the message
+        fds = tuple(shm_fds) + tuple(fds)
+
+        if headers:
+            for name, val in headers:
+                msg.append('{}: {}'.format(name, val))
+                msg.append(CRLF)
+
+        msg.append('Content-Length: {}'.format(sum(len(chunk) for chunk in chunks)))
+        msg.append(CRLF)
+
+        if chunks:
+            msg.append(CRLF)
+            msg.extend(chunks)
+
+        msg = [s.encode('utf-8') if hasattr(s, 'encode') else s for s in msg]
+
+        return self.send_chunks(connection, send_func, msg, fds)
+
+    def send_binary_algo(self, connection, send_func, method='', status=0,
+            path='', headers=None, body=None, request_id=0, fds=()):
+        path = path.encode('utf-8')
+
+        headers, chunks, shm_fds = self.shm_chunks(connection, headers, body)
+
+        fds = tuple(shm_fds) + tuple(fds)
+
+        if headers:
+            header_data = ''.join(['{}: {}\r\n'.format(name, val) for name, val in headers])
+            header_data = header_data.encode('utf-8')
+        else:
+            header_data = b''
+
+        header = constants.BINARY_HEADER.pack(
+            constants.BINARY_MAGIC,
+            constants.BINARY_METHOD_CODES[method],
+            status,
+            request_id,
+            len(path),
+            len(header_data),
+            sum(len(chunk) for chunk in chunks),
+        )
+
+        return self.send_chunks(connection, send_func, [header, path, header_data] + chunks, fds)
+
+    def shm_chunks(self, connection, headers, body):
+        """
+        Moves a body of at least the threshold the other end asked for into
+        shared memory, unless it's a SharedBody already. Returns the headers
+        and chunks to send in its place, and the descriptors to pass along
+        with them.
+        """
+        if not isinstance(body, shm.SharedBody):
+            chunks = body_chunks(body)
+            threshold = self._shm_connections.get(id(connection))
+
+            if not threshold or sum(len(chunk) for chunk in chunks) < threshold:
+                return headers, chunks, ()
+
+            body = shm.create(chunks)
+
+        return list(headers or []) + [('X-Shm', body.size)], [], (body.fd,)
+
+    def recv_shm_body(self, connection, headers, body):
+        """
+        Returns the body of a message, mapping it when it was sent in shared
+        memory.
+        """
+        size = get_header(headers, 'X-Shm')
+
+        if size is None:
+            return body
+
+        fds = self._received_fds.get(id(connection))
+
+        if not fds:
+            raise ProtocolError('Shared memory body without a descriptor.')
+
+        return shm.open_body(fds.popleft(), int(size))
+
+    def write_request_frame(self, connection, method, path, body='', headers=None,
+            send_func=None, request_id=0, fds=()):
+        send_func = send_func or self.client_send
+
+        headers = list(headers or []) + self.client_shm_headers(connection)
+
+        if id(connection) in self._binary_connections:
+            self.send_binary_algo(connection, send_func, method=method,
+                path=path, headers=headers, body=body, request_id=request_id, fds=fds)
+        else:
+            first_line = "{method} {path}".format(method=method, path=path)
+            self.send_algo(connection, send_func, first_line, headers=headers, body=body, fds=fds)
+
+    def send_request_frames(self, connection, frames):
+        """
+        Sends several requests, each given as (method, path, body, headers),
+        in one write without waiting for their responses.
+        """
+        chunks = []
+
+        for method, path, body, headers in frames:
+            self.write_request_frame(connection, method, path, body=body,
+                headers=headers, send_func=lambda connection, data: chunks.append(data))
+
+        self.send_chunks(connection, self.client_send, chunks)
+
+    def send_request_frame(self, connection, method, path, body='', headers=None, fds=()):
+        try:
+            self.write_request_frame(connection, method, path, body=body, headers=headers, fds=fds)
+        except DisconnectedError:
+            exc_info = sys.exc_info()
+
+            # a busy server may have answered and hung up before the
+            # request was sent
+            try:
+                self.get_response(connection)
+            except ServerBusyError:
+                raise
+            except Exception:
+                pass
+
+            six.reraise(*exc_info)
+
+    def client_request_headers(self, timing=False, request_id=None, cache_ttl=None):
+        headers = []
+
+        if cache_ttl is not None:
+            headers.append(('X-Cache-TTL', repr(float(cache_ttl))))
+
+        if request_id is not None:
+            headers.append(('X-Request-Id', request_id))
+
+        if timing:
+            headers.append(('X-Timing', '1'))
+
+        return headers
+
+    def serialize_body(self, obj, serializer=None):
+        """
+        Returns obj serialized with serializer, or this transport's, as a
+        list of chunks. Objects it can't serialize are pickled.
+        """
+        serializer = serializer or self.serializer
+
+        try:
+            return serializer.dumps(obj)
+        except TypeError:
+            return serializers.get_serializer('pickle').dumps(obj)
+
+    def deserialize_body(self, data):
+        return serializers.loads(data)
+
+    def encode_args(self, args, kwargs):
+        kwargs = collections.OrderedDict(sorted(kwargs.items(), key=lambda t: t[0]))
+
+        return self.serialize_body([args, kwargs])
+
+    def decode_response(self, resp):
+        obj = self.deserialize_body(resp.body)
+
+        if resp.status == 400:
+            raise obj
+
+        return obj
+
+    def send_request(self, connection, method, path, body='', headers=None):
+        self.send_request_frame(connection, method, path, body=body, headers=headers)
+
+        return self.decode_response(self.get_response(connection))
+
+    def send_get_request(self, connection, prefix, name):
+        return self.send_request(connection, 'GET', prefix+'.'+name)
+
+    def send_call_request(self, connection, name, *args, **kwargs):
+        return self.send_request(connection, 'CALL', name, body=self.encode_args(args, kwargs))
+
+    def send_del_request(self, connection, names):
+        """
+        Releases the named remote objects, or all of them when names is
+        empty.
+        """
+        return self.send_request(connection, 'DEL', ','.join(names))
+
+    def send_run_request(self, connection, *args, **kwargs):
+        return self.send_request(connection, 'RUN', 'subprocess', body=self.encode_args(args, kwargs))
+
+    def iter_responses(self, connection, method, path, body='', headers=None):
+        """
+        Sends a request and yields its responses, up to the first one which
+        isn't 206 Partial.
+        """
+        self.send_request_frame(connection, method, path, body=body, headers=headers)
+
+        while True:
+            resp = self.get_response(connection)
+
+            yield resp
+
+            if resp.status != 206:
+                return
+
+    def decode_stream(self, responses):
+        """
+        Yields (stream, chunk) pairs from a STREAM request's responses, then
+        ('returncode', returncode).
+        """
+        for resp in responses:
+            if resp.status == 206:
+                yield dict(resp.headers)['X-Stream'], bytes(resp.body)
+                continue
+
+            returncode = self.decode_response(resp)
+
+            # servers from before STREAM existed answer with None
+            if returncode is None:
+                raise UnknownMethodError('STREAM')
+
+            yield 'returncode', returncode
+
+    def decode_batch(self, responses):
+        """
+        Yields (index, result) pairs from a BATCH request's responses.
+        """
+        for resp in responses:
+            if resp.status == 206:
+                yield int(dict(resp.headers)['X-Index']), self.deserialize_body(resp.body)
+            # servers from before BATCH existed answer with None
+            elif self.decode_response(resp) is None:
+                raise UnknownMethodError('BATCH')
+
+    def send_stream_request(self, connection, *args, **kwargs):
+        """
+        Yields (stream, chunk) pairs as the command produces output, then
+        ('returncode', returncode).
+        """
+        return self.decode_stream(self.iter_responses(connection, 'STREAM', 'subprocess',
+            body=self.encode_args(args, kwargs)))
+
+    def send_batch_request(self, connection, *args, **kwargs):
+        """
+        Yields (index, result) pairs as the commands finish.
+        """
+        return self.decode_batch(self.iter_responses(connection, 'BATCH', 'subprocess',
+            body=self.encode_args(args, kwargs)))
+
+    def recv_algo(self, connection, recv_func, recv_into_func=None):
+        """
+        Reads one message from connection.
+
+        Header lines are parsed once as they arrive. The body is read
+        straight into a buffer of its final size, using recv_into_func when
+        given. Bytes received past the end of the message are kept for the
+        next call.
+        """
+        CRLF = constants.CRLF
+
+        data = self._recv_buffers.pop(id(connection), None) or bytearray()
+
+        lines = []
+        pos = 0
+        scan = 0
+
+        content_length = None
+
+        while True:
+            end = data.find(CRLF, scan)
+
+            if end == -1:
+                new_data = recv_func(connection, 4096)
+
+                if not new_data:
+                    raise DisconnectedError()
+
+                # a CRLF may straddle the old and new data
+                scan = max(pos, len(data) - 1)
+                data += new_data
+                continue
+
+            line = bytes(data[pos:end])
+            pos = scan = end + len(CRLF)
+
+            if content_length is not None:
+                # blank line between the headers and the body
+                break
+
+            lines.append(line)
+
+            if line[:16].lower() == b'content-length: ':
+                content_length = int(line[16:])
+
+                # messages without a body end after the Content-Length line
+                if content_length == 0:
+                    break
+
+        body = self._recv_body(connection, data, pos, content_length,
+            recv_func, recv_into_func)
+
+        headers = [line.decode('utf-8') for line in lines]
+        first_line = headers[0]
+        headers = [header.split(': ', 1) for header in headers[1:]]
+
+        return first_line, headers, body
+
+    def recv_binary_algo(self, connection, recv_func, recv_into_func=None):
+        """
+        Reads one binary frame from connection.
+
+        Returns the method, status, request id, path, headers and body.
+        """
+        header = constants.BINARY_HEADER
+
+        data = self._recv_buffers.pop(id(connection), None) or bytearray()
+
+        self._fill(connection, data, header.size, recv_func)
+
+        (magic, method, status, request_id, path_length, headers_length,
+            content_length) = header.unpack_from(data)
+
+        if magic != constants.BINARY_MAGIC:
+            raise ProtocolError('Not a binary frame.')
+
+        try:
+            method = constants.BINARY_METHODS[method]
+        except IndexError:
+            raise UnknownMethodError(method)
+
+        pos = header.size + path_length + headers_length
+
+        self._fill(connection, data, pos, recv_func)
+
+        path = bytes(data[header.size:header.size + path_length]).decode('utf-8')
+
+        headers = []
+
+        if headers_length:
+            header_data = bytes(data[header.size + path_length:pos]).decode('utf-8')
+            headers = [line.split(': ', 1) for line in header_data.split('\r\n') if line]
+
+        body = self._recv_body(connection, data, pos, content_length,
+            recv_func, recv_into_func)
+
+        return method, status, request_id, path, headers, body
+
+    def _fill(self, connection, data, size, recv_func):
+        while len(data) < size:
+            new_data = recv_func(connection, max(size - len(data), 4096))
+
+            if not new_data:
+                raise DisconnectedError()
+
+            data += new_data
+
+    def _recv_body(self, connection, data, pos, content_length, recv_func,
+            recv_into_func):
+        # read straight into a buffer of the final size, starting with any
+        # body bytes that were received along with the headers
+        body = bytearray(content_length)
+
+        if content_length:
+            view = memoryview(body)
+
+            received = min(len(data) - pos, content_length)
+            view[:received] = data[pos:pos + received]
+            pos += received
+
+            while received < content_length:
+                if recv_into_func is not None:
+                    count = recv_into_func(connection, view[received:])
+                else:
+                    new_data = recv_func(connection, content_length - received)
+                    count = len(new_data)
+                    view[received:received + count] = new_data
+
+                if not count:
+                    raise DisconnectedError()
+
+                received += count
+
+        if pos < len(data):
+            self._recv_buffers[id(connection)] = data[pos:]
+
+        if six.PY2:
+            body = bytes(body)
+
+        return body
+
+    def _next_is_binary(self, connection, recv_func):
+        data = self._recv_buffers.get(id(connection))
+
+        if not data:
+            new_data = recv_func(connection, 4096)
+
+            if not new_data:
+                raise DisconnectedError()
+
+            data = self._recv_buffers[id(connection)] = bytearray(new_data)
+
+        return data[0] == constants.BINARY_MAGIC
+
+    def forget_connection(self, connection):
+        self._recv_buffers.pop(id(connection), None)
+        self._binary_connections.discard(id(connection))
+        self._send_locks.pop(id(connection), None)
+        self._shm_connections.pop(id(connection), None)
+        self._fd_connections.discard(id(connection))
+        self._stdio_connections.discard(id(connection))
+        self._input_connections.discard(id(connection))
+
+        # descriptors of bodies which were never sent or read
+        for fd in itertools.chain(self._pending_fds.pop(id(connection), ()),
+                self._received_fds.pop(id(connection), ())):
+            os.close(fd)
+
+    def get_request(self, connection):
+        # answer in whichever framing the client used
+        if self._next_is_binary(connection, self.server_recv):
+            self._binary_connections.add(id(connection))
+
+            method, status, request_id, path, headers, body = self.recv_binary_algo(
+                connection, self.server_recv, self.server_recv_into)
+        else:
+            self._binary_connections.discard(id(connection))
+
+            first_line, headers, body = self.recv_algo(connection, self.server_recv, self.server_recv_into)
+
+            method, path = first_line.split(' ', 1)
+            request_id = 0
+
+        body = self.recv_shm_body(connection, headers, body)
+
+        threshold = get_header(headers, 'X-Accept-Shm')
+
+        if threshold is not None and self.passes_fds:
+            self._shm_connections[id(connection)] = int(threshold)
+
+        return Request(method, path, headers, body, request_id)
+
+    def server_response_headers(self, request):
+        """
+        Echoes the request's X-Request-Id, reports its timings when it asked
+        for them and whether its result came from the cache.
+        """
+        headers = []
+
+        request_id = get_header(request.headers, 'X-Request-Id')
+
+        if request_id is not None:
+            headers.append(('X-Request-Id', request_id))
+
+        if get_header(request.headers, 'X-Timing'):
+            for name, header in TIMING_HEADERS:
+                if name in request.timings:
+                    headers.append((header, '{:.6f}'.format(request.timings[name])))
+
+        if request.cache is not None:
+            headers.append(('X-Cache', request.cache))
+
+        return headers
+
+    def send_response(self, connection, obj, raised=False, request=None):
+        """
+        Sends obj serialized with the serializer the request's body was, or
+        this transport's for requests without a body.
+        """
+        started = time.time()
+
+        serializer = None
+
+        if request is not None and request.body:
+            serializer = serializers.detect(request.body)
+
+        # results already in shared memory are sent as they are
+        if isinstance(obj, shm.SharedBody):
+            body = obj
+        else:
+            body = self.serialize_body(obj, serializer)
+
+        headers = None
+
+        if request is not None:
+            request.timings['serialize'] = time.time() - started
+            headers = self.server_response_headers(request)
+
+        self.server_observe('bytes_out', len(body) if isinstance(body, shm.SharedBody)
+            else sum(len(chunk) for chunk in body))
+
+        if id(connection) in self._binary_connections:
+            status = 400 if raised else 200
+            request_id = request.request_id if request is not None else 0
+
+            return self.send_binary_algo(connection, self.server_send, status=status,
+                headers=headers, body=body, request_id=request_id)
+
+        first_line = '200 OK' if not raised else '400 Error'
+
+        return self.send_algo(connection, self.server_send, first_line, headers=headers, body=body)
+
+    def send_partial(self, connection, headers, body, request_id=0):
+        """
+        Sends one of several responses to a request, ahead of the last one.
+        """
+        self.server_observe('bytes_out', sum(len(chunk) for chunk in body_chunks(body)))
+
+        if id(connection) in self._binary_connections:
+            return self.send_binary_algo(connection, self.server_send, status=206,
+                headers=headers, body=body, request_id=request_id)
+
+        return self.send_algo(connection, self.server_send, '206 Partial',
+            headers=headers, body=body)
+
+    def send_chunk(self, connection, stream, chunk, request_id=0):
+        return self.send_partial(connection, [('X-Stream', stream)], chunk, request_id)
+
+    def send_batch_result(self, connection, index, result, serializer=None, request_id=0):
+        return self.send_partial(connection, [('X-Index', index)],
+            self.serialize_body(result, serializer), request_id)
+
+    def get_response(self, connection):
+        # 503 Busy is always sent as text, before the server has read anything
+        if id(connection) in self._binary_connections and self._next_is_binary(connection, self.client_recv):
+            method, status, request_id, path, headers, body = self.recv_binary_algo(
+                connection, self.client_recv, self.client_recv_into)
+
+            return Response(status, headers, self.recv_shm_body(connection, headers, body),
+                request_id)
+
+        first_line, headers, body = self.recv_algo(connection, self.client_recv, self.client_recv_into)
+
+        status = int(first_line.split()[0])
+
+        if status == 503:
+            raise ServerBusyError()
+
+        return Response(status, headers, self.recv_shm_body(connection, headers, body))
+
+    def get_session(self, negotiate=True):
+        return ClientSession(self, pool=self.client_pool, negotiate=negotiate)
+
+    def get_multiplexed_session(self):
+        return MultiplexedSession(self)
+
+    def run_cmd(self, command_string, env=None, cwd=None, timing=False,
+            request_id=None, cache_ttl=None, stdin=None, stdout=None, stderr=None,
+            input=None):
+        """
+        Runs a command on the server in a single round trip.
 
-            returncode = process.returncode
+        command_string is run through the shell; a list of arguments is
+        executed directly.
 
-        return stdout, stderr, returncode
+        request_id is sent along for the server's logs and echoed back. With
+        timing, a Timing is returned after the return code.
+
+        With cache_ttl, a result of the same command, env and cwd up to
+        cache_ttl seconds old may be returned instead of running it again,
+        when the server has a result cache.
+
+        stdin, stdout and stderr may be the client's own files, or their
+        descriptors, which are passed to the server for the command to use
+        directly, by transports which can. Its output then never passes
+        through the server, and is returned as None. Such commands aren't
+        cached.
+
+        input is sent to the command's stdin as it's read, see iter_input().
+        Sending waits while the command isn't reading, so input larger than
+        memory can be piped through. Such commands aren't cached either.
+        """
+        if input is not None and stdin is not None:
+            raise ValueError('stdin and input can\'t both be given.')
+
+        body, headers = self.encode_run_cmd(command_string, env, cwd, timing,
+            request_id, cache_ttl)
+
+        stdio_headers, fds = self.client_stdio(stdin, stdout, stderr)
+
+        if input is not None:
+            stdio_headers.append(('X-Input', '1'))
+
+        started = time.time()
+
+        with self.get_session(negotiate=False) as session:
+            if fds:
+                fds = self.client_pass_stdio(session.connection, fds)
+
+            if input is not None:
+                self.client_check_input(session.connection)
+
+            self.send_request_frame(session.connection, 'RUN', 'subprocess',
+                body=body, headers=headers + stdio_headers, fds=fds)
+
+            if input is not None:
+                self.send_input(session.connection, input)
+
+            resp = self.get_response(session.connection)
+
+        return self.decode_run_cmd(resp, timing, started)
+
+    def encode_run_cmd(self, command_string, env=None, cwd=None, timing=False,
+            request_id=None, cache_ttl=None):
+        """
+        Returns the body and headers of a RUN request.
+        """
+        return (self.encode_args((command_string,), {'env': env, 'cwd': cwd}),
+            self.client_request_headers(timing, request_id, cache_ttl))
+
+    def decode_run_cmd(self, resp, timing=False, started=None):
+        result = self.decode_response(resp)
+
+        # servers from before RUN existed answer with None
+        if result is None:
+            raise UnknownMethodError('RUN')
+
+        stdout, stderr, returncode = result
+
+        if not timing:
+            return stdout, stderr, returncode
+
+        return stdout, stderr, returncode, Timing.from_response(resp, time.time() - started)
+
+    def get_stats(self):
+        """
+        Returns the server's metrics, or None when it doesn't collect any.
+        """
+        with self.get_session(negotiate=False) as session:
+            return self.send_request(session.connection, 'STATS', 'server')
+
+    def iter_cmds(self, commands, env=None, cwd=None, max_parallel=None):
+        """
+        Runs the commands on the server in one request, up to max_parallel
+        at a time, and yields (index, result) pairs in the order they
+        finish. result is (stdout, stderr, returncode), or the exception
+        raised when the command couldn't be started.
+        """
+        with self.get_session(negotiate=False) as session:
+            for item in self.send_batch_request(session.connection, commands,
+                    env=env, cwd=cwd, max_parallel=max_parallel):
+                yield item
+
+    def run_cmds(self, commands, env=None, cwd=None, max_parallel=None):
+        """
+        Like iter_cmds(), returning the results in the order of the commands
+        once they've all finished.
+        """
+        return in_order(self.iter_cmds(commands, env=env, cwd=cwd,
+            max_parallel=max_parallel), len(commands))
+
+    def stream_cmd(self, command_string, env=None, cwd=None):
+        """
+        Runs a command on the server, yielding ('stdout', chunk) and
+        ('stderr', chunk) pairs as it produces output and finally
+        ('returncode', returncode).
+        """
+        with self.get_session(negotiate=False) as session:
+            for item in self.send_stream_request(session.connection,
+                    command_string, env=env, cwd=cwd):
+                yield item
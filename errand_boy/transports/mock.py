@@ -49,15 +49,19 @@ class MockTransport(BaseTransport):
     def client_recv(self, connection, l):
         in_conn, out_conn = connection
 
+        # let the server send any further responses, e.g. streamed output
+        if not out_conn:
+            eventlet.sleep(0)
+
         try:
             return out_conn.pop(0)
         except IndexError:
             return b''
 
-    def get_session(self):
+    def get_session(self, negotiate=True):
         connection = self.server_accept(None)
 
         greenthread = eventlet.spawn(self.server_handle_client, connection)
 
-        return super(MockTransport, self).get_session()
+        return super(MockTransport, self).get_session(negotiate=negotiate)
 
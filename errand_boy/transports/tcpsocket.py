@@ -0,0 +1,136 @@
+"""
+TCP version of the UNIX socket transport, for clients which can't reach the
+server's filesystem, such as sidecars in another container of the same
+network namespace.
+
+Anyone who can connect can run commands, so only listen on an address
+untrusted hosts can't reach.
+"""
+import logging
+import os
+import socket
+
+from .unixsocket import UNIXSocketTransport, socket_timeout
+from ..exceptions import ServerBusyError
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 4747
+
+LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+
+
+class TCPSocketTransport(UNIXSocketTransport):
+    """
+    Usage:
+
+    transport = TCPSocketTransport(host='127.0.0.1', port=4747)
+
+    stdout, stderr, returncode = transport.run_cmd('ls -al')
+
+    Nagle's algorithm is turned off, since every message is written in one go
+    and then waited on. With reuse_port=True several servers can listen on
+    the same port, and the kernel spreads the connections between them.
+    send_buffer_size and recv_buffer_size set the socket buffers, in bytes,
+    of both ends.
+    """
+
+    # only UNIX sockets carry descriptors
+    passes_fds = False
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, reuse_port=False,
+            send_buffer_size=None, recv_buffer_size=None, connect_timeout=1, **kwargs):
+        super(TCPSocketTransport, self).__init__(**kwargs)
+
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT isn\'t supported on this platform.')
+
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.send_buffer_size = send_buffer_size
+        self.recv_buffer_size = recv_buffer_size
+        # seconds fail_fast clients wait for the server to take a connection
+        self.connect_timeout = connect_timeout
+
+    def get_address(self):
+        """
+        Returns the address family and the address to connect or bind to.
+        """
+        family, type, proto, canonname, address = socket.getaddrinfo(self.host, self.port,
+            0, socket.SOCK_STREAM)[0]
+
+        return family, address
+
+    def configure_socket(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # set before connecting or listening, so the window is scaled to fit
+        if self.send_buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+
+        if self.recv_buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
+
+    def server_get_connection(self):
+        family, address = self.get_address()
+
+        serversocket = socket.socket(family, socket.SOCK_STREAM)
+        serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if self.reuse_port:
+            serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        self.configure_socket(serversocket)
+
+        serversocket.bind(address)
+        serversocket.listen(self.listen_backlog)
+
+        if self.host not in LOOPBACK_HOSTS:
+            logger.warning('Listening on {}, anyone who can connect can run commands.'.format(address))
+
+        return serversocket
+
+    def server_inherit_connection(self, fd):
+        family, address = self.get_address()
+
+        serversocket = socket.fromfd(fd, family, socket.SOCK_STREAM)
+
+        # fromfd() duplicates the descriptor
+        os.close(fd)
+
+        return serversocket
+
+    def server_accept(self, connection):
+        clientsocket, address = connection.accept()
+
+        # not every platform passes it on from the listening socket
+        clientsocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return clientsocket, address
+
+    def client_get_connection(self):
+        family, address = self.get_address()
+
+        clientsocket = socket.socket(family, socket.SOCK_STREAM)
+
+        self.configure_socket(clientsocket)
+
+        # a full listen backlog drops connection attempts instead of refusing
+        # them, so fail_fast clients only wait connect_timeout for one
+        if self.fail_fast:
+            clientsocket.settimeout(self.connect_timeout)
+
+        try:
+            clientsocket.connect(address)
+        except socket_timeout:
+            clientsocket.close()
+            raise ServerBusyError()
+        except Exception:
+            clientsocket.close()
+            raise
+
+        clientsocket.settimeout(None)
+
+        return clientsocket
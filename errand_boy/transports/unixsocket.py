@@ -1,10 +1,16 @@
+import array
+import collections
+import errno
 import logging
 from multiprocessing import reduction
 import os
+import select
 import socket
 
 from .base import BaseTransport
 from .. import constants
+from .. import shm
+from ..exceptions import DisconnectedError, ProtocolError, ServerBusyError
 
 
 logger = logging.getLogger(__name__)
@@ -17,6 +23,15 @@ except AttributeError:
     rebuild_socket = reduction._rebuild_socket
     reduce_socket = reduction._reduce_socket
 
+socket_error = socket.error
+socket_timeout = socket.timeout
+
+# room for the most descriptors taken from one read
+if hasattr(socket, 'CMSG_SPACE'):
+    FDS_SPACE = socket.CMSG_SPACE(shm.MAX_FDS * array.array('i').itemsize)
+else:
+    FDS_SPACE = None
+
 
 class UNIXSocketTransport(BaseTransport):
     """
@@ -27,12 +42,73 @@ class UNIXSocketTransport(BaseTransport):
     process, stdout, stderr = transport.run_cmd('ls -al')
     """
 
+    # descriptors are passed as SCM_RIGHTS messages (Python 3.3+)
+    passes_fds = FDS_SPACE is not None
+
     def __init__(self, socket_path='/tmp/errand-boy', listen_backlog=5, **kwargs):
         super(UNIXSocketTransport, self).__init__(**kwargs)
 
         self.socket_path = socket_path
         self.listen_backlog = listen_backlog
 
+    def socket_sendall(self, connection, sock, data):
+        """
+        Sends data, passing any descriptors waiting to be sent with it.
+        """
+        fds = self._pending_fds.pop(id(connection), None)
+
+        if not fds:
+            return sock.sendall(data)
+
+        try:
+            sent = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+        finally:
+            # the other end has copies of its own
+            for fd in fds:
+                os.close(fd)
+
+        if sent < len(data):
+            sock.sendall(memoryview(data)[sent:])
+
+    def socket_recv(self, connection, sock, length):
+        if id(connection) not in self._fd_connections:
+            return sock.recv(length)
+
+        data, ancdata, flags, address = sock.recvmsg(length, FDS_SPACE)
+
+        self.keep_fds(connection, ancdata, flags)
+
+        return data
+
+    def socket_recv_into(self, connection, sock, buf):
+        if id(connection) not in self._fd_connections:
+            return sock.recv_into(buf)
+
+        count, ancdata, flags, address = sock.recvmsg_into([buf], FDS_SPACE)
+
+        self.keep_fds(connection, ancdata, flags)
+
+        return count
+
+    def keep_fds(self, connection, ancdata, flags):
+        """
+        Keeps the descriptors which came with a read, until the messages
+        they belong to claim them.
+        """
+        fds = array.array('i')
+
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+
+        if fds:
+            self._received_fds.setdefault(id(connection), collections.deque()).extend(fds)
+
+        # the ones which didn't fit were closed, so messages can't be
+        # matched with their descriptors anymore
+        if flags & socket.MSG_CTRUNC:
+            raise ProtocolError('Too many descriptors passed at once.')
+
     def connection_to_string(self, connection):
         if isinstance(connection, tuple):
             return str((connection[0].getsockname(), connection[1],))
@@ -51,15 +127,44 @@ class UNIXSocketTransport(BaseTransport):
 
         return serversocket
 
+    def server_inherit_connection(self, fd):
+        serversocket = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # fromfd() duplicates the descriptor
+        os.close(fd)
+
+        return serversocket
+
+    def server_listen_fd(self, serverconnection):
+        fd = serverconnection.fileno()
+
+        # Python 3 doesn't let exec'd programs inherit sockets by default
+        if hasattr(os, 'set_inheritable'):
+            os.set_inheritable(fd, True)
+
+        return fd
+
     def server_recv(self, connection, length):
         clientsocket, address = connection
 
-        return clientsocket.recv(length)
+        try:
+            return self.socket_recv(connection, clientsocket, length)
+        except socket_timeout:
+            # keepalive timeout expired, treat it like a disconnect
+            return b''
+
+    def server_recv_into(self, connection, buf):
+        clientsocket, address = connection
+
+        try:
+            return self.socket_recv_into(connection, clientsocket, buf)
+        except socket_timeout:
+            return 0
 
     def server_send(self, connection, data):
         clientsocket, address = connection
 
-        clientsocket.sendall(data)
+        self.socket_sendall(connection, clientsocket, data)
 
     def server_close(self, connection):
         clientsocket, address = connection
@@ -68,6 +173,18 @@ class UNIXSocketTransport(BaseTransport):
         except:
             pass
 
+    def server_set_timeout(self, connection, timeout):
+        clientsocket, address = connection
+
+        clientsocket.settimeout(timeout)
+
+    def server_wait_readable(self, connection, timeout):
+        clientsocket, address = connection
+
+        readable, writable, exceptional = select.select([clientsocket], [], [], timeout)
+
+        return bool(readable)
+
     def server_accept(self, connection):
         return connection.accept()
 
@@ -80,15 +197,51 @@ class UNIXSocketTransport(BaseTransport):
     def client_get_connection(self):
         clientsocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
-        clientsocket.connect(self.socket_path)
+        if not self.fail_fast:
+            clientsocket.connect(self.socket_path)
+
+            return clientsocket
+
+        # UNIX sockets connect immediately or fail with EAGAIN when the
+        # listen backlog is full
+        clientsocket.setblocking(False)
+
+        try:
+            clientsocket.connect(self.socket_path)
+        except socket_error as e:
+            clientsocket.close()
+
+            if e.errno == errno.EAGAIN:
+                raise ServerBusyError()
+            raise
+
+        clientsocket.setblocking(True)
 
         return clientsocket
 
     def client_send(self, connection, data):
-        connection.sendall(data)
+        try:
+            self.socket_sendall(connection, connection, data)
+        except socket_error as e:
+            if e.errno in (errno.EPIPE, errno.ECONNRESET):
+                raise DisconnectedError()
+            raise
 
     def client_recv(self, connection, length):
-        return connection.recv(length)
+        return self.socket_recv(connection, connection, length)
+
+    def client_connection_alive(self, connection):
+        try:
+            connection.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except socket_error as e:
+            return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+        # an idle connection has nothing to read, so either the server hung
+        # up or the connection is out of step
+        return False
+
+    def client_recv_into(self, connection, buf):
+        return self.socket_recv_into(connection, connection, buf)
 
     def client_close(self, connection):
         try:
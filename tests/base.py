@@ -13,7 +13,6 @@ class BaseTestCase(unittest.TestCase):
     multiprocessing_patcher = mock.patch.object(base, 'multiprocessing',
         autospec=True)
     sys_patcher = mock.patch.object(run, 'sys', autospec=True)
-    uuid_patcher = mock.patch.object(base.uuid, 'uuid4', autospec=True)
 
     UNIXSocketTransport_patcher = mock.patch.object(unixsocket,
         'UNIXSocketTransport', autospec=True)
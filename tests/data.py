@@ -3,6 +3,7 @@ import pickle
 import six
 import subprocess
 
+import errand_boy
 from errand_boy import constants
 from errand_boy.transports import base
 
@@ -36,29 +37,29 @@ def get_command_data(cmd):
         get_req('GET', 'subprocess.Popen'),
         get_req('GET', 'subprocess.PIPE'),
         get_req('GET', 'subprocess.PIPE'),
-        get_req('CALL', 'obj1', [(cmd,), {'shell': True, 'stderr': subprocess.PIPE, 'stdout': subprocess.PIPE}]),
-        get_req('GET', 'obj2.communicate'),
-        get_req('CALL', 'obj3', [tuple(), {}]),
-        get_req('GET', 'obj4.__iter__'),
-        get_req('CALL', 'obj5', [tuple(), {}]),
-        get_req('GET', 'obj6.next' if six.PY2 else 'obj6.__next__'),
-        get_req('CALL', 'obj7', [tuple(), {}]),
-        get_req('CALL', 'obj7', [tuple(), {}]),
-        get_req('CALL', 'obj7', [tuple(), {}]),
-        get_req('GET', 'obj2.returncode'),
+        get_req('CALL', '1', [(cmd,), {'shell': True, 'stderr': subprocess.PIPE, 'stdout': subprocess.PIPE}]),
+        get_req('GET', '2.communicate'),
+        get_req('CALL', '3', [tuple(), {}]),
+        get_req('GET', '4.__iter__'),
+        get_req('CALL', '5', [tuple(), {}]),
+        get_req('GET', '6.next' if six.PY2 else '6.__next__'),
+        get_req('CALL', '7', [tuple(), {}]),
+        get_req('CALL', '7', [tuple(), {}]),
+        get_req('CALL', '7', [tuple(), {}]),
+        get_req('GET', '2.returncode'),
         b'',
     ]
 
     responses = [
-        get_resp('200 OK', base.RemoteObjRef('obj1')),
+        get_resp('200 OK', base.RemoteObjRef('1')),
         get_resp('200 OK', subprocess.PIPE),
         get_resp('200 OK', subprocess.PIPE),
-        get_resp('200 OK', base.RemoteObjRef('obj2')),
-        get_resp('200 OK', base.RemoteObjRef('obj3')),
-        get_resp('200 OK', base.RemoteObjRef('obj4')),
-        get_resp('200 OK', base.RemoteObjRef('obj5')),
-        get_resp('200 OK', base.RemoteObjRef('obj6')),
-        get_resp('200 OK', base.RemoteObjRef('obj7')),
+        get_resp('200 OK', base.RemoteObjRef('2')),
+        get_resp('200 OK', base.RemoteObjRef('3')),
+        get_resp('200 OK', base.RemoteObjRef('4')),
+        get_resp('200 OK', base.RemoteObjRef('5')),
+        get_resp('200 OK', base.RemoteObjRef('6')),
+        get_resp('200 OK', base.RemoteObjRef('7')),
         get_resp('200 OK', stdout),
         get_resp('200 OK', stderr),
         get_resp('400 Error', StopIteration()),
@@ -67,6 +68,26 @@ def get_command_data(cmd):
 
     return cmd, stdout, stderr, returncode, requests, responses
 
+def get_run_command_data(cmd):
+    result = commands[cmd]
+
+    stdout, stderr = zip(*result[0])
+    stdout = ''.join(stdout)
+    stderr = ''.join(stderr)
+
+    returncode = result[1]
+
+    requests = [
+        get_req('RUN', 'subprocess', [(cmd,), {'cwd': None, 'env': None}]),
+        b'',
+    ]
+
+    responses = [
+        get_resp('200 OK', (stdout, stderr, returncode)),
+    ]
+
+    return cmd, stdout, stderr, returncode, requests, responses
+
 def get_req(method, path, obj=None):
     if obj is not None:
         try:
@@ -93,6 +114,75 @@ def get_resp(status, obj=None):
     else:
         return ("%s\r\nContent-Length: 0\r\n" % (status,)).encode('utf-8')
 
+def _sorted_obj(obj):
+    try:
+        obj[1] = collections.OrderedDict(sorted(obj[1].items(), key=lambda t: t[0]))
+    except:
+        pass
+
+    return pickle.dumps(obj)
+
+def get_binary_req(method, path, obj=None, request_id=0):
+    body = _sorted_obj(obj) if obj is not None else b''
+    path = path.encode('utf-8')
+
+    header = constants.BINARY_HEADER.pack(constants.BINARY_MAGIC,
+        constants.BINARY_METHOD_CODES[method], 0, request_id, len(path), 0, len(body))
+
+    return header + path + body
+
+def get_binary_resp(status, obj=None, request_id=0):
+    body = _sorted_obj(obj) if obj is not None else b''
+
+    header = constants.BINARY_HEADER.pack(constants.BINARY_MAGIC, 0, status,
+        request_id, 0, 0, len(body))
+
+    return header + body
+
+def get_binary_run_command_data(cmd):
+    cmd, stdout, stderr, returncode, requests, responses = get_run_command_data(cmd)
+
+    requests = [
+        get_binary_req('RUN', 'subprocess', [(cmd,), {'cwd': None, 'env': None}]),
+        b'',
+    ]
+
+    responses = [
+        get_binary_resp(200, (stdout, stderr, returncode)),
+    ]
+
+    return cmd, stdout, stderr, returncode, requests, responses
+
+def get_stream_command_data(cmd):
+    cmd, stdout, stderr, returncode, requests, responses = get_run_command_data(cmd)
+
+    requests = [
+        get_req('STREAM', 'subprocess', [(cmd,), {'cwd': None, 'env': None}]),
+        b'',
+    ]
+
+    stdout = stdout.encode('utf-8')
+
+    responses = [
+        ("206 Partial\r\nX-Stream: stdout\r\nContent-Length: %s\r\n\r\n" % len(stdout)).encode('utf-8') + stdout,
+        get_resp('200 OK', returncode),
+    ]
+
+    return cmd, stdout, stderr, returncode, requests, responses
+
+def get_hello_data(server_framing='binary'):
+    request = get_req('HELLO', errand_boy.__version__)
+
+    if server_framing is None:
+        # servers from before HELLO existed answer with None
+        body = pickle.dumps(None)
+        response = ("200 OK\r\nContent-Length: %s\r\n\r\n" % len(body)).encode('utf-8') + body
+    else:
+        response = get_resp('200 OK', {'version': errand_boy.__version__, 'framing': server_framing,
+            'multiplex': server_framing == 'binary', 'input': True})
+
+    return request, response
+
 data = {
     'ls -al': ('ls -al', get_command_data('ls -al')),
 }
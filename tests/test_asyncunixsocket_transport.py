@@ -0,0 +1,513 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from errand_boy.exceptions import ServerBusyError, SessionClosedError
+from errand_boy.transports import base, unixsocket
+
+from .base import mock
+
+try:
+    if sys.version_info < (3, 8):
+        raise ImportError('asyncio transport needs Python 3.8+')
+
+    import asyncio
+
+    from errand_boy.transports import asyncunixsocket
+except (ImportError, SyntaxError):
+    asyncunixsocket = None
+
+
+@unittest.skipIf(asyncunixsocket is None, 'asyncio transport needs Python 3.8+')
+class AsyncUNIXSocketTransportServerTestCase(unittest.TestCase):
+    server_class = property(lambda self: asyncunixsocket.AsyncUNIXSocketTransport)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'errand-boy')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def start_server(self, max_accepts, **kwargs):
+        server = self.server_class(socket_path=self.socket_path)
+
+        self.server_thread = threading.Thread(target=server.run_server,
+            kwargs=dict(max_accepts=max_accepts, **kwargs))
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        while not os.path.exists(self.socket_path):
+            time.sleep(0.01)
+
+        return server
+
+    def join_server(self):
+        self.server_thread.join(10)
+        self.assertFalse(self.server_thread.is_alive())
+
+    def test_run_cmd(self):
+        self.start_server(max_accepts=2)
+
+        for framing in ('auto', 'text'):
+            transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path, framing=framing)
+
+            result = transport.run_cmd('echo $FOO; echo bar >&2; exit 3', env={'FOO': 'foo'})
+
+            self.assertEqual(result, (b'foo\n', b'bar\n', 3))
+
+        self.join_server()
+
+    def test_run_cmd_input(self):
+        self.start_server(max_accepts=4)
+
+        data = b'foo\n' * 250000
+
+        for framing in ('auto', 'text'):
+            transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path, framing=framing)
+
+            self.assertEqual(transport.run_cmd('cat', input=data), (data, b'', 0))
+
+            # what the command doesn't read is dropped
+            self.assertEqual(transport.run_cmd('head -c 3', input=[b'foo'] * 10000), (b'foo', b'', 0))
+
+        self.join_server()
+
+    def test_shm_threshold(self):
+        with self.assertRaises(ValueError):
+            self.server_class(shm_threshold=65536)
+
+    def test_run_server_prefork(self):
+        with self.assertRaises(ValueError):
+            self.server_class(socket_path=self.socket_path).run_server(prefork=True)
+
+    def test_run_server_workers(self):
+        with self.assertRaises(ValueError):
+            self.server_class(socket_path=self.socket_path).run_server(min_workers=2)
+
+        with self.assertRaises(ValueError):
+            self.server_class(socket_path=self.socket_path).run_server(max_workers=4)
+
+    def test_run_server_max_queue(self):
+        with self.assertRaises(ValueError):
+            self.server_class(socket_path=self.socket_path).run_server(max_queue=10)
+
+    def test_run_server_handover(self):
+        with self.assertRaises(ValueError):
+            self.server_class(socket_path=self.socket_path).run_server(handover_argv=['errand-boy'])
+
+    def test_run_cmd_cache(self):
+        server = self.start_server(max_accepts=4, cache_size=10)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        results = []
+
+        def run():
+            results.append(transport.run_cmd('sleep 0.3; date +%s%N', cache_ttl=60))
+
+        threads = [threading.Thread(target=run) for i in range(3)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stdout, stderr, returncode, timing = transport.run_cmd('sleep 0.3; date +%s%N',
+            cache_ttl=60, timing=True)
+
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(stdout, results[0][0])
+        self.assertEqual(timing.cache, 'hit')
+
+        self.join_server()
+
+        stats = server.metrics.snapshot()
+
+        self.assertEqual(stats['exec_seconds']['count'], 1)
+        self.assertEqual(stats['cache_hits'], 3)
+
+    def test_run_cmd_args(self):
+        self.start_server(max_accepts=1)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        self.assertEqual(transport.run_cmd(['pwd'], cwd='/'), (b'/\n', b'', 0))
+
+        self.join_server()
+
+    def test_run_cmd_error(self):
+        self.start_server(max_accepts=1)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        with self.assertRaises(OSError):
+            transport.run_cmd(['/nonexistent/command'])
+
+        self.join_server()
+
+    def test_stats(self):
+        self.start_server(max_accepts=2)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        transport.run_cmd('echo foo')
+
+        stats = transport.get_stats()
+
+        self.assertEqual(stats['accepts'], 2)
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['exec_seconds']['count'], 1)
+
+        self.join_server()
+
+    def test_stream_cmd(self):
+        self.start_server(max_accepts=1)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        result = list(transport.stream_cmd('head -c 200000 /dev/zero'))
+
+        self.assertEqual(b''.join(chunk for stream, chunk in result[:-1]), b'\0' * 200000)
+        self.assertEqual(result[-1], ('returncode', 0))
+
+        self.join_server()
+
+    def test_session(self):
+        self.start_server(max_accepts=1)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        with transport.get_session() as session:
+            subprocess = session.subprocess
+
+            process = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            stdout, stderr = process.communicate(b'foo')
+
+        self.assertEqual(stdout, b'foo')
+
+        self.join_server()
+
+    def test_run_cmds(self):
+        self.start_server(max_accepts=1, pool_size=4)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        results = list(transport.iter_cmds(['sleep 0.3; echo 0', 'echo 1', ['/nonexistent']]))
+
+        self.assertEqual(sorted(index for index, result in results), [0, 1, 2])
+        self.assertEqual(dict(results)[0], (b'0\n', b'', 0))
+        self.assertEqual(results[-1], (0, (b'0\n', b'', 0)))
+        self.assertIsInstance(dict(results)[2], OSError)
+
+        self.join_server()
+
+    def test_session_release(self):
+        self.start_server(max_accepts=1)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        with mock.patch.object(base.ExposedLocals, 'release', autospec=True,
+                side_effect=base.ExposedLocals.release) as release:
+            with transport.get_session() as session:
+                subprocess = session.subprocess
+
+                for i in range(base.RELEASE_BATCH + 1):
+                    subprocess.Popen
+
+        self.assertEqual(release.call_count, 1)
+        self.assertEqual(len(release.call_args_list[0][0][1]), base.RELEASE_BATCH)
+
+        self.join_server()
+
+    def test_concurrent_clients(self):
+        count = 20
+
+        self.start_server(max_accepts=count, pool_size=count)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        results = []
+
+        def run():
+            results.append(transport.run_cmd('sleep 0.5; echo done'))
+
+        threads = [threading.Thread(target=run) for i in range(count)]
+
+        start = time.time()
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # all of the sleeps ran at once
+        self.assertTrue(time.time() - start < 0.5 * count / 2)
+        self.assertEqual(results, [(b'done\n', b'', 0)] * count)
+
+        self.join_server()
+
+    def test_multiplexed_session(self):
+        count = 10
+
+        self.start_server(max_accepts=1, pool_size=count)
+
+        transport = unixsocket.UNIXSocketTransport(socket_path=self.socket_path)
+
+        results = {}
+
+        with transport.get_multiplexed_session() as session:
+            def run(i):
+                results[i] = session.run_cmd('sleep 0.5; echo {}'.format(i))
+
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+
+            start = time.time()
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # they ran at once, over one connection
+            self.assertTrue(time.time() - start < 0.5 * count / 2)
+
+            chunks = list(session.stream_cmd('echo foo'))
+
+            self.assertEqual(chunks, [('stdout', b'foo\n'), ('returncode', 0)])
+            self.assertEqual(session.run_cmds(['echo 1']), [(b'1\n', b'', 0)])
+
+        self.assertEqual(results, dict((i, (str(i).encode('utf-8') + b'\n', b'', 0))
+            for i in range(count)))
+
+        self.join_server()
+
+
+class AsyncUNIXSocketTransportClientTestCase(AsyncUNIXSocketTransportServerTestCase):
+    def setUp(self):
+        super(AsyncUNIXSocketTransportClientTestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        # let closed connections finish closing
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(AsyncUNIXSocketTransportClientTestCase, self).tearDown()
+
+    def run_until_complete(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def get_transport(self, **kwargs):
+        return asyncunixsocket.AsyncUNIXSocketTransport(socket_path=self.socket_path, **kwargs)
+
+    def test_get_multiplexed_session(self):
+        with self.assertRaises(ValueError):
+            self.get_transport().get_multiplexed_session()
+
+    def test_async_run_cmd(self):
+        self.start_server(max_accepts=2)
+
+        for framing in ('auto', 'text'):
+            transport = self.get_transport(framing=framing)
+
+            result = self.run_until_complete(transport.run_cmd('echo foo; exit 3'))
+
+            self.assertEqual(result, (b'foo\n', b'', 3))
+
+        self.join_server()
+
+    def test_async_run_cmd_input(self):
+        self.start_server(max_accepts=1)
+
+        transport = self.get_transport()
+
+        data = b'foo\n' * 250000
+
+        result = self.run_until_complete(transport.run_cmd('cat', input=data))
+
+        self.assertEqual(result, (data, b'', 0))
+
+        self.join_server()
+
+    def test_async_run_cmd_pooled(self):
+        self.start_server(max_accepts=1)
+
+        transport = self.get_transport(client_pool_size=1)
+
+        for i in range(3):
+            result = self.run_until_complete(transport.run_cmd(['echo', str(i)]))
+            self.assertEqual(result, (str(i).encode('utf-8') + b'\n', b'', 0))
+
+        transport.client_pool.clear()
+        self.run_until_complete(asyncio.sleep(0))
+
+        self.join_server()
+
+    def test_async_run_cmd_timing(self):
+        self.start_server(max_accepts=1)
+
+        transport = self.get_transport()
+
+        stdout, stderr, returncode, timing = self.run_until_complete(
+            transport.run_cmd('echo foo', timing=True, request_id='abc'))
+
+        self.assertEqual(stdout, b'foo\n')
+        self.assertEqual(timing.request_id, 'abc')
+        self.assertGreater(timing.execution, 0)
+        self.assertIsNone(timing.queue_wait)
+
+        self.join_server()
+
+    def test_async_stream_cmd(self):
+        self.start_server(max_accepts=1)
+
+        transport = self.get_transport()
+
+        stream = transport.stream_cmd('head -c 200000 /dev/zero')
+        result = []
+
+        while True:
+            try:
+                result.append(self.run_until_complete(stream.__anext__()))
+            except StopAsyncIteration:
+                break
+
+        self.assertEqual(b''.join(chunk for name, chunk in result[:-1]), b'\0' * 200000)
+        self.assertEqual(result[-1], ('returncode', 0))
+
+        self.join_server()
+
+    def test_async_session(self):
+        self.start_server(max_accepts=1)
+
+        transport = self.get_transport()
+
+        session = self.run_until_complete(transport.get_session().__aenter__())
+
+        popen = self.run_until_complete(session.subprocess.Popen)
+        process = self.run_until_complete(popen(['sh', '-c', 'exit 3']))
+        wait = self.run_until_complete(process.wait)
+        returncode = self.run_until_complete(wait())
+
+        self.run_until_complete(session.__aexit__(None, None, None))
+        self.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(returncode, 3)
+
+        with self.assertRaises(SessionClosedError):
+            self.run_until_complete(process.returncode)
+
+        self.join_server()
+
+    def test_async_run_cmds(self):
+        self.start_server(max_accepts=1)
+
+        transport = self.get_transport()
+
+        results = self.run_until_complete(transport.run_cmds(['echo 0', ['sh', '-c', 'exit 3']],
+            max_parallel=2))
+
+        self.assertEqual(results, [(b'0\n', b'', 0), (b'', b'', 3)])
+
+        self.join_server()
+
+    def test_async_session_pooled(self):
+        self.start_server(max_accepts=1)
+
+        transport = self.get_transport(client_pool_size=1)
+
+        with mock.patch.object(base.ExposedLocals, 'clear', autospec=True,
+                side_effect=base.ExposedLocals.clear) as clear:
+            for i in range(2):
+                session = self.run_until_complete(transport.get_session().__aenter__())
+
+                # exposes an object in the session
+                self.run_until_complete(session.subprocess.Popen)
+
+                self.run_until_complete(session.__aexit__(None, None, None))
+
+        # each session's objects were released before the connection went
+        # back to the pool
+        self.assertEqual(clear.call_count, 2)
+        self.assertEqual(len(transport.client_pool), 1)
+
+        transport.client_pool.clear()
+        self.run_until_complete(asyncio.sleep(0))
+
+        self.join_server()
+
+    def test_async_concurrent(self):
+        count = 50
+
+        self.start_server(max_accepts=count, pool_size=count)
+
+        transport = self.get_transport()
+
+        start = time.time()
+
+        results = self.run_until_complete(asyncio.gather(
+            *[transport.run_cmd('sleep 0.5; echo done') for i in range(count)]))
+
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(results, [(b'done\n', b'', 0)] * count)
+
+        self.join_server()
+
+    def test_async_fail_fast(self):
+        serversocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        serversocket.bind(self.socket_path)
+        serversocket.listen(0)
+
+        # fill the listen backlog of a server that never accepts
+        clientsockets = []
+
+        while True:
+            clientsocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            clientsocket.setblocking(False)
+            clientsockets.append(clientsocket)
+
+            try:
+                clientsocket.connect(self.socket_path)
+            except (BlockingIOError, ConnectionRefusedError):
+                break
+
+        transport = self.get_transport(fail_fast=True)
+
+        with self.assertRaises(ServerBusyError):
+            self.run_until_complete(transport.run_cmd('true'))
+
+        for clientsocket in clientsockets:
+            clientsocket.close()
+        serversocket.close()
+
+    def test_async_busy(self):
+        serversocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        serversocket.bind(self.socket_path)
+        serversocket.listen(1)
+
+        def reject():
+            clientsocket, address = serversocket.accept()
+            # hanging up before the request arrives makes asyncio drop the
+            # buffered response along with the connection
+            clientsocket.recv(1024)
+            clientsocket.sendall(b'503 Busy\r\nContent-Length: 0\r\n')
+            clientsocket.close()
+
+        thread = threading.Thread(target=reject)
+        thread.start()
+
+        transport = self.get_transport(framing='text')
+
+        with self.assertRaises(ServerBusyError):
+            self.run_until_complete(transport.run_cmd('true'))
+
+        thread.join()
+        serversocket.close()
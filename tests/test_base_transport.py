@@ -1,7 +1,14 @@
+import collections
+import multiprocessing as real_multiprocessing
+import os
+import pickle
 import six
+import threading
 
 import errand_boy
-from errand_boy.exceptions import SessionClosedError, UnknownMethodError
+from errand_boy import cache, constants, metrics, serializers, shm
+from errand_boy.exceptions import (DisconnectedError, ProtocolError, SessionClosedError,
+    UnknownMethodError, UnsupportedError)
 from errand_boy.transports import base
 
 from .base import mock, BaseTestCase
@@ -21,6 +28,46 @@ class WorkerInitTestCase(BaseTestCase):
         self.assertEqual(mock_setproctitle.call_args_list[0][0][0], 'errand-boy worker process 1')
 
 
+class PoolWorkerTestCase(BaseTestCase):
+    def test_hand_off(self):
+        transport = mock.Mock()
+        transport.server_deserialize_connection.return_value = 'connection'
+
+        tasks = mock.Mock()
+        tasks.get.side_effect = [('serialized', 100), None]
+
+        pending = real_multiprocessing.Value('i', 1)
+        busy = real_multiprocessing.Value('i', 0)
+
+        counts = []
+
+        transport.server_handle_connection.side_effect = lambda connection: \
+            counts.append((pending.value, busy.value))
+
+        with mock.patch.object(base, 'worker_init'):
+            base.pool_worker(transport, tasks, pending, busy, 0)
+
+        # the connection only counts as taken once it's been rebuilt
+        self.assertEqual(counts, [(0, 1)])
+
+        self.assertEqual(transport.server_deserialize_connection.call_args_list[0][0][0], 'serialized')
+        self.assertEqual(transport.server_handle_connection.call_args_list[0][0][0], 'connection')
+        self.assertEqual(busy.value, 0)
+        self.assertEqual(transport.server_connection_taken.call_args_list[0][0][0], 100)
+
+
+class PreforkWorkerTestCase(BaseTestCase):
+    def test_connection_error(self):
+        transport = mock.Mock()
+        transport.server_handle_connection.side_effect = [IOError(32, 'Broken pipe'), None]
+
+        with mock.patch.object(base, 'worker_init'),\
+                mock.patch.object(base, 'signal'):
+            base.prefork_worker(transport, mock.Mock(), None, 2)
+
+        self.assertEqual(transport.server_handle_connection.call_count, 2)
+
+
 class RemoteObjWrapperTestCase(BaseTestCase):
     def test__send_unknown_method(self):
         session = mock.Mock()
@@ -40,6 +87,348 @@ class RemoteObjWrapperTestCase(BaseTestCase):
         with self.assertRaises(SessionClosedError):
             row._send('GET')
 
+    def test_release(self):
+        transport = mock.Mock()
+        transport.send_get_request.side_effect = lambda connection, prefix, name: base.RemoteObjRef(name)
+
+        with base.ClientSession(transport) as session:
+            # roots aren't released
+            root = session.subprocess
+            del root
+
+            for i in six.moves.range(base.RELEASE_BATCH):
+                getattr(session.subprocess, 'attr{}'.format(i))
+
+            self.assertEqual(transport.send_del_request.call_count, 0)
+
+            session.subprocess.foo
+
+        self.assertEqual(transport.send_del_request.call_count, 1)
+        self.assertEqual(transport.send_del_request.call_args_list[0][0][1],
+            ['attr{}'.format(i) for i in six.moves.range(base.RELEASE_BATCH)])
+
+    def test_release_after_close(self):
+        transport = mock.Mock()
+        transport.send_get_request.return_value = base.RemoteObjRef('1')
+
+        with base.ClientSession(transport) as session:
+            process = session.subprocess.Popen
+
+        del process
+
+        self.assertEqual(session._released, [])
+
+    def test_release_all_pooled(self):
+        transport = mock.Mock()
+        transport.send_get_request.return_value = base.RemoteObjRef('1')
+        pool = mock.Mock()
+
+        with base.ClientSession(transport, pool=pool) as session:
+            session.subprocess.Popen
+
+        transport.send_del_request.assert_called_once_with(pool.acquire.return_value, [])
+        pool.release.assert_called_once_with(pool.acquire.return_value)
+
+    def test_release_all_pooled_error(self):
+        transport = mock.Mock()
+        transport.send_get_request.return_value = base.RemoteObjRef('1')
+        transport.send_del_request.side_effect = DisconnectedError()
+        pool = mock.Mock()
+
+        with base.ClientSession(transport, pool=pool) as session:
+            session.subprocess.Popen
+
+        self.assertEqual(pool.release.call_count, 0)
+        transport.client_close.assert_called_once_with(pool.acquire.return_value)
+
+    def test_nothing_exposed_pooled(self):
+        transport = mock.Mock()
+        pool = mock.Mock()
+
+        with base.ClientSession(transport, pool=pool):
+            pass
+
+        self.assertEqual(transport.send_del_request.call_count, 0)
+        self.assertEqual(pool.release.call_count, 1)
+
+
+class PipelineTestCase(BaseTestCase):
+    def setUp(self):
+        super(PipelineTestCase, self).setUp()
+        self.transport = mock.Mock()
+        self.transport.encode_args.side_effect = lambda args, kwargs: [args, kwargs]
+        self.transport.deserialize_body.side_effect = lambda body: body
+
+    def responses(self, *responses):
+        self.transport.get_response.side_effect = [base.Response(status, [], body)
+            for status, body in responses]
+
+    def test_resolve(self):
+        self.responses((200, base.RemoteObjRef('p1')), (200, -1), (200, base.RemoteObjRef('p3')))
+
+        with base.ClientSession(self.transport) as session:
+            pipeline = session.pipeline()
+            subprocess = pipeline.subprocess
+
+            process = subprocess.Popen(['ls'], stdout=subprocess.PIPE)
+
+            self.assertEqual(self.transport.send_request_frames.call_count, 0)
+
+            result = pipeline.resolve(process)
+
+        # one write for the whole chain
+        self.assertEqual(self.transport.send_request_frames.call_count, 1)
+
+        connection, frames = self.transport.send_request_frames.call_args_list[0][0]
+
+        self.assertEqual(frames, [
+            ('GET', 'subprocess.Popen', '', [('X-Promise', 'p1')]),
+            ('GET', 'subprocess.PIPE', '', [('X-Promise', 'p2')]),
+            ('CALL', 'p1', [(['ls'],), {'stdout': mock.ANY}], [('X-Promise', 'p3')]),
+        ])
+        self.assertEqual(frames[2][2][1]['stdout'].name, 'p2')
+
+        self.assertIsInstance(result, base.RemoteObjWrapper)
+        self.assertEqual(result.name, 'p3')
+        self.assertTrue(result.handle)
+
+    def test_dependency_failed(self):
+        error = AttributeError('nope')
+
+        self.responses((400, error), (400, KeyError('p1')))
+
+        with base.ClientSession(self.transport) as session:
+            pipeline = session.pipeline()
+
+            result = pipeline.subprocess.nope()
+
+            with self.assertRaises(AttributeError):
+                pipeline.resolve(result)
+
+    def test_release(self):
+        self.responses((200, -1))
+
+        with base.ClientSession(self.transport) as session:
+            pipeline = session.pipeline()
+
+            pipe = pipeline.subprocess.PIPE
+
+            self.assertEqual(pipeline.resolve(pipe), -1)
+
+            del pipe
+
+            self.assertEqual(session._released, ['p1'])
+
+    def test_session_closed(self):
+        with base.ClientSession(self.transport) as session:
+            pipeline = session.pipeline()
+
+        with self.assertRaises(SessionClosedError):
+            pipeline.subprocess.Popen
+
+
+class ExposedLocalsTestCase(BaseTestCase):
+    def setUp(self):
+        super(ExposedLocalsTestCase, self).setUp()
+        self.root = object()
+        self.exposed_locals = base.ExposedLocals({'root': self.root}, max_size=2)
+
+    def test_expose(self):
+        obj = object()
+
+        self.assertEqual(self.exposed_locals.expose(obj), '1')
+        self.assertEqual(self.exposed_locals.expose(object()), '2')
+
+        self.assertIs(self.exposed_locals['1'], obj)
+        self.assertIs(self.exposed_locals['root'], self.root)
+        self.assertIn('root', self.exposed_locals)
+        self.assertEqual(len(self.exposed_locals), 2)
+
+    def test_evict_least_recently_used(self):
+        first = self.exposed_locals.expose(object())
+        second = self.exposed_locals.expose(object())
+
+        # first is now the most recently used
+        self.exposed_locals[first]
+
+        self.exposed_locals.expose(object())
+
+        self.assertIn(first, self.exposed_locals)
+        self.assertNotIn(second, self.exposed_locals)
+        self.assertIn('root', self.exposed_locals)
+
+        with self.assertRaises(KeyError):
+            self.exposed_locals[second]
+
+    def test_unlimited(self):
+        self.exposed_locals.max_size = 0
+
+        for i in six.moves.range(5):
+            self.exposed_locals.expose(object())
+
+        self.assertEqual(len(self.exposed_locals), 5)
+
+    def test_release(self):
+        name = self.exposed_locals.expose(object())
+        self.exposed_locals.expose(object())
+
+        self.exposed_locals.release([name, 'unknown'])
+
+        self.assertNotIn(name, self.exposed_locals)
+        self.assertEqual(len(self.exposed_locals), 1)
+
+        self.exposed_locals.clear()
+
+        self.assertEqual(len(self.exposed_locals), 0)
+        self.assertIn('root', self.exposed_locals)
+
+
+class RequestThreadsTestCase(BaseTestCase):
+    def test_start(self):
+        threads = base.RequestThreads(max_size=2)
+        started = []
+        release = threading.Event()
+
+        def target(i):
+            started.append(i)
+            release.wait()
+
+        threads.start(target, 0)
+        threads.start(target, 1)
+
+        # a third waits for a free slot
+        third = threading.Thread(target=threads.start, args=(target, 2))
+        third.start()
+        third.join(0.1)
+
+        self.assertTrue(third.is_alive())
+
+        release.set()
+        third.join()
+        threads.join()
+
+        self.assertEqual(sorted(started), [0, 1, 2])
+        self.assertEqual(threads._threads, set())
+
+
+class MultiplexedConnectionTestCase(BaseTestCase):
+    def setUp(self):
+        super(MultiplexedConnectionTestCase, self).setUp()
+        self.transport = base.BaseTransport()
+        self.transport.client_connect = mock.Mock(return_value=mock.sentinel.connection)
+        self.transport.client_close = mock.Mock()
+        self.transport.send_request = mock.Mock(return_value={'framing': 'binary', 'multiplex': True})
+        self.transport.write_request_frame = mock.Mock()
+
+    def test_exchange(self):
+        connection = base.MultiplexedConnection(self.transport)
+
+        self.assertTrue(connection.multiplexed)
+        self.assertIn(id(mock.sentinel.connection), self.transport._send_locks)
+
+        # another thread's request, waiting for its response
+        other_id = connection._begin('CALL', '1', '', None)
+
+        self.transport.get_response = mock.Mock(side_effect=[
+            base.Response(206, [], b'a', 2),
+            base.Response(200, [], b'b', other_id),
+            base.Response(200, [], b'c', 99),
+            base.Response(200, [], b'd', 2),
+        ])
+
+        responses = list(connection.exchange('RUN', 'subprocess'))
+
+        self.assertEqual([resp.body for resp in responses], [b'a', b'd'])
+        self.assertEqual(self.transport.write_request_frame.call_args[1]['request_id'], 2)
+
+        # the other thread's response was kept for it, the unknown one dropped
+        self.assertEqual(connection._wait(other_id).body, b'b')
+        self.assertEqual(list(connection._responses), [other_id])
+
+    def test_text_framing(self):
+        self.transport.send_request.return_value = None
+
+        connection = base.MultiplexedConnection(self.transport)
+
+        self.assertFalse(connection.multiplexed)
+
+        self.transport.get_response = mock.Mock(return_value=base.Response(206, [], b'a'))
+
+        exchange = connection.exchange('STREAM', 'subprocess')
+        next(exchange)
+
+        self.assertEqual(self.transport.write_request_frame.call_args[1]['request_id'], 0)
+
+        # the rest of its responses can't be told from the next request's
+        exchange.close()
+
+        self.assertIsInstance(connection.error, ProtocolError)
+        self.assertEqual(self.transport.client_close.call_count, 1)
+
+        with self.assertRaises(DisconnectedError):
+            list(connection.exchange('RUN', 'subprocess'))
+
+    def test_read_error(self):
+        connection = base.MultiplexedConnection(self.transport)
+        other_id = connection._begin('RUN', 'subprocess', '', None)
+
+        self.transport.get_response = mock.Mock(side_effect=DisconnectedError())
+
+        with self.assertRaises(DisconnectedError):
+            list(connection.exchange('RUN', 'subprocess'))
+
+        # threads waiting on it give up too
+        with self.assertRaises(DisconnectedError):
+            connection._wait(other_id)
+
+        self.assertNotIn(id(mock.sentinel.connection), self.transport._send_locks)
+
+    def test_alive(self):
+        connection = base.MultiplexedConnection(self.transport)
+        self.transport.client_connection_alive = mock.Mock(return_value=False)
+
+        # requests in flight account for anything there is to read
+        request_id = connection._begin('RUN', 'subprocess', '', None)
+
+        self.assertTrue(connection.alive())
+        self.assertEqual(self.transport.client_connection_alive.call_count, 0)
+
+        connection._end(request_id, True)
+
+        # the server hung up on the idle connection
+        self.assertFalse(connection.alive())
+        self.assertIsInstance(connection.error, DisconnectedError)
+        self.assertEqual(self.transport.client_close.call_count, 1)
+
+        self.assertFalse(connection.alive())
+        self.assertEqual(self.transport.client_connection_alive.call_count, 1)
+
+
+class MultiplexedSessionTestCase(BaseTestCase):
+    def test_reconnect(self):
+        transport = base.BaseTransport()
+
+        with mock.patch.object(base, 'MultiplexedConnection') as MultiplexedConnection:
+            MultiplexedConnection.return_value.alive.return_value = True
+
+            session = transport.get_multiplexed_session()
+
+            self.assertIs(session._get_connection(), session._get_connection())
+            self.assertEqual(MultiplexedConnection.call_count, 1)
+
+            MultiplexedConnection.return_value.alive.return_value = False
+
+            session._get_connection()
+            self.assertEqual(MultiplexedConnection.call_count, 2)
+
+            with session:
+                pass
+
+        self.assertEqual(MultiplexedConnection.return_value.close.call_count, 1)
+
+        with self.assertRaises(SessionClosedError):
+            session.run_cmd('true')
+
 
 class RemoteObjRefTestCase(BaseTestCase):
     def test___init___binary(self):
@@ -56,6 +445,224 @@ class RemoteObjRefTestCase(BaseTestCase):
 
         self.assertEqual(ref.name, name)
 
+
+class ConnectionPoolTestCase(BaseTestCase):
+    def setUp(self):
+        super(ConnectionPoolTestCase, self).setUp()
+        self.transport = mock.Mock()
+        self.transport.client_connect.side_effect = lambda: mock.Mock()
+        self.transport.client_connection_alive.return_value = True
+        self.pool = base.ConnectionPool(self.transport, max_size=2, idle_timeout=30)
+
+    def test_reuse(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+
+        self.assertEqual(len(self.pool), 1)
+        self.assertIs(self.pool.acquire(), connection)
+        self.assertEqual(self.transport.client_connect.call_count, 1)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_max_size(self):
+        connections = [self.pool.acquire() for i in range(3)]
+
+        for connection in connections:
+            self.pool.release(connection)
+
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(self.transport.client_close.call_count, 1)
+        self.assertIs(self.transport.client_close.call_args_list[0][0][0], connections[2])
+
+    def test_idle_timeout(self):
+        with mock.patch.object(base, 'time') as mock_time:
+            mock_time.time.return_value = 100
+            connection = self.pool.acquire()
+            self.pool.release(connection)
+
+            mock_time.time.return_value = 131
+            new_connection = self.pool.acquire()
+
+        self.assertIsNot(new_connection, connection)
+        self.assertEqual(self.transport.client_close.call_count, 1)
+        self.assertIs(self.transport.client_close.call_args_list[0][0][0], connection)
+
+    def test_health_check(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+
+        self.transport.client_connection_alive.return_value = False
+
+        new_connection = self.pool.acquire()
+
+        self.assertIsNot(new_connection, connection)
+        self.assertIs(self.transport.client_close.call_args_list[0][0][0], connection)
+
+    def test_clear(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+
+        self.pool.clear()
+
+        self.assertEqual(len(self.pool), 0)
+        self.assertIs(self.transport.client_close.call_args_list[0][0][0], connection)
+
+    def test_session_error_discards_connection(self):
+        with self.assertRaises(ValueError):
+            with base.ClientSession(self.transport, pool=self.pool):
+                raise ValueError()
+
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.transport.client_close.call_count, 1)
+
+
+class WorkerPoolTestCase(BaseTestCase):
+    def setUp(self):
+        super(WorkerPoolTestCase, self).setUp()
+        self.process_patcher = mock.patch.object(base.multiprocessing, 'Process')
+        self.Process = self.process_patcher.start()
+        self.Process.side_effect = lambda **kwargs: mock.Mock()
+        self.addCleanup(self.process_patcher.stop)
+
+        self.pool = base.WorkerPool(mock.Mock(), 1, 3, idle_timeout=30)
+        self.pool.tasks = mock.Mock()
+
+    def test_min_workers(self):
+        self.pool.scale()
+
+        self.assertEqual(len(self.pool.workers), 1)
+        self.assertEqual(self.pool.workers[0].start.call_count, 1)
+
+    def test_replace_exited_worker(self):
+        self.pool.scale()
+        self.pool.workers[0].is_alive.return_value = False
+        self.pool.scale()
+
+        self.assertEqual(len(self.pool.workers), 1)
+        self.assertEqual(self.Process.call_count, 2)
+
+    def test_grow_with_queue_depth(self):
+        self.pool.scale()
+        self.pool.busy.value = 1
+
+        for i in range(5):
+            self.pool.submit('foo')
+
+        self.assertEqual(self.pool.tasks.put.call_args_list[0][0][0], ('foo', None))
+        self.assertEqual(len(self.pool.workers), 3)
+
+    def test_grow_with_wait_time(self):
+        with mock.patch.object(base, 'time') as mock_time:
+            mock_time.time.return_value = 100
+            self.pool.scale()
+            self.pool.submit('foo')
+
+            self.assertEqual(len(self.pool.workers), 1)
+
+            mock_time.time.return_value = 101
+            self.pool.scale()
+
+        self.assertEqual(len(self.pool.workers), 2)
+
+    def test_shrink_after_idle_timeout(self):
+        with mock.patch.object(base, 'time') as mock_time:
+            mock_time.time.return_value = 100
+            self.pool.scale()
+            self.pool.busy.value = 1
+
+            for i in range(2):
+                self.pool.submit('foo')
+
+            self.pool.pending.value = 0
+            self.pool.busy.value = 0
+
+            self.pool.scale()
+            mock_time.time.return_value = 120
+            self.pool.scale()
+
+            self.assertNotIn(mock.call(None), self.pool.tasks.put.call_args_list)
+
+            mock_time.time.return_value = 131
+            self.pool.scale()
+
+        self.assertEqual(self.pool.tasks.put.call_args_list[-1], mock.call(None))
+
+    def test_min_larger_than_max(self):
+        with self.assertRaises(ValueError):
+            base.WorkerPool(mock.Mock(), 4, 2)
+
+    def test_detach(self):
+        self.pool.scale()
+        self.pool.busy.value = 1
+        self.pool.pending.value = 2
+
+        with mock.patch.object(base, 'logger') as logger:
+            pids = self.pool.detach(timeout=0)
+
+        # the busy worker can't take the queued connections
+        self.assertEqual(len(self.pool.workers), 3)
+        self.assertEqual(pids, [process.pid for process in self.pool.workers])
+        self.assertEqual(self.pool.tasks.put.call_args_list, [mock.call(None)] * 3)
+        self.assertEqual(self.pool.tasks.join_thread.call_count, 1)
+        self.assertEqual(logger.warning.call_count, 1)
+
+    def test_detach_waits_for_queue(self):
+        self.pool.scale()
+        self.pool.pending.value = 1
+
+        def take(seconds):
+            self.pool.pending.value = 0
+
+        with mock.patch.object(base.time, 'sleep', side_effect=take) as sleep, \
+                mock.patch.object(base, 'logger') as logger:
+            self.pool.detach()
+
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(len(self.pool.workers), 1)
+        self.assertEqual(logger.warning.call_count, 0)
+
+    def test_adopt(self):
+        self.pool.adopt([41])
+
+        with mock.patch.object(base.os, 'waitpid') as waitpid:
+            waitpid.return_value = 0, 0
+            self.pool.scale()
+
+            self.assertEqual(self.pool._adopted, [41])
+
+            waitpid.return_value = 41, 0
+            self.pool.scale()
+
+        self.assertEqual(waitpid.call_args_list[0], mock.call(41, base.os.WNOHANG))
+        self.assertEqual(self.pool._adopted, [])
+
+
+class TimingTestCase(BaseTestCase):
+    def test_from_response(self):
+        response = base.Response(200, [['X-Request-Id', 'abc'], ['X-Spawn', '0.001000'],
+            ['X-Exec', '0.500000']], b'')
+
+        timing = base.Timing.from_response(response, 0.75)
+
+        self.assertEqual(timing.total, 0.75)
+        self.assertEqual(timing.request_id, 'abc')
+        self.assertEqual(timing.spawn, 0.001)
+        self.assertEqual(timing.execution, 0.5)
+        self.assertIsNone(timing.queue_wait)
+        self.assertIsNone(timing.serialize)
+        self.assertIsNone(timing.cache)
+
+    def test_from_response_cache(self):
+        response = base.Response(200, [['X-Cache', 'hit']], b'')
+
+        self.assertEqual(base.Timing.from_response(response, 0.75).cache, 'hit')
+
+
+class VersionTupleTestCase(BaseTestCase):
+    def test(self):
+        self.assertEqual(base.version_tuple('0.3.9'), (0, 3, 9))
+        self.assertEqual(base.version_tuple('1.0'), (1, 0))
+
+
 class BaseTransportTestCase(BaseTestCase):
     def setUp(self):
         super(BaseTransportTestCase, self).setUp()
@@ -95,3 +702,876 @@ class BaseTransportTestCase(BaseTestCase):
     def test_client_close(self):
         self.transport.client_close(None)
 
+    def test_client_connection_alive(self):
+        self.assertTrue(self.transport.client_connection_alive(None))
+
+    def test_unknown_framing(self):
+        with self.assertRaises(ValueError):
+            base.BaseTransport(framing='foo')
+
+    def test_server_hello(self):
+        hello = self.transport.server_hello(errand_boy.__version__)
+
+        self.assertEqual(hello, {'version': errand_boy.__version__, 'framing': 'binary', 'multiplex': True,
+            'input': True})
+
+    def test_server_hello_old_client(self):
+        hello = self.transport.server_hello('0.3.8')
+
+        self.assertEqual(hello['framing'], 'text')
+        self.assertFalse(hello['multiplex'])
+
+    def test_server_handle_connection_keepalive_timeout(self):
+        self.transport.server_keepalive_timeout = 5
+
+        with mock.patch.object(self.transport, 'get_request') as get_request, \
+                mock.patch.object(self.transport, 'server_handle_request') as server_handle_request, \
+                mock.patch.object(self.transport, 'send_response'), \
+                mock.patch.object(self.transport, 'server_set_timeout') as server_set_timeout:
+            get_request.side_effect = [base.Request('RUN', 'subprocess', [], b''), DisconnectedError()]
+            server_handle_request.return_value = None, False
+
+            self.transport.server_handle_connection(None)
+
+        # the timeout is lifted while the request is handled
+        self.assertEqual([call[0][1] for call in server_set_timeout.call_args_list], [5, None, 5])
+
+    def test_server_wait_request_in_flight(self):
+        self.transport.server_keepalive_timeout = 5
+
+        threads = base.RequestThreads()
+        done = threading.Event()
+
+        threads.start(done.wait, 5)
+
+        def server_wait_readable(connection, timeout):
+            # nothing to read until the request in flight is answered
+            done.set()
+            threads.join()
+
+            return False
+
+        with mock.patch.object(self.transport, 'server_wait_readable', side_effect=server_wait_readable), \
+                mock.patch.object(self.transport, 'server_set_timeout') as server_set_timeout:
+            self.transport.server_wait_request(None, threads)
+
+        # the socket only gets a timeout once nothing else is using it
+        server_set_timeout.assert_called_once_with(None, 5)
+
+    def test_server_handle_connection_concurrent(self):
+        answered = []
+        fast_answered = threading.Event()
+
+        def server_handle_request(connection, exposed_locals, request):
+            # the slow request is still running when the fast one is answered
+            if request.request_id == 1:
+                fast_answered.wait(5)
+
+            return request.request_id, False
+
+        def send_response(connection, obj, raised=False, request=None):
+            answered.append(obj)
+
+            if obj == 2:
+                fast_answered.set()
+
+        with mock.patch.object(self.transport, 'get_request') as get_request,\
+                mock.patch.object(self.transport, 'server_handle_request', side_effect=server_handle_request),\
+                mock.patch.object(self.transport, 'send_response', side_effect=send_response),\
+                mock.patch.object(self.transport, 'server_close'):
+            get_request.side_effect = [
+                base.Request('RUN', 'subprocess', [], b'', 1),
+                base.Request('RUN', 'subprocess', [], b'', 2),
+                DisconnectedError(),
+            ]
+
+            self.transport.server_handle_connection(None)
+
+        self.assertEqual(answered, [2, 1])
+        self.assertEqual(self.transport._send_locks, {})
+
+    def test_server_handle_connection_error(self):
+        self.transport._recv_buffers[id(None)] = bytearray(b'foo')
+
+        with mock.patch.object(self.transport, 'get_request') as get_request, \
+                mock.patch.object(self.transport, 'server_close') as server_close:
+            get_request.side_effect = ProtocolError()
+
+            with self.assertRaises(ProtocolError):
+                self.transport.server_handle_connection(None)
+
+        self.assertEqual(server_close.call_count, 1)
+        self.assertEqual(self.transport._recv_buffers, {})
+
+    def test_server_bind_promise(self):
+        transport = base.BaseTransport()
+        exposed_locals = transport.server_exposed_locals()
+
+        result, raised = transport.server_handle_request(None, exposed_locals,
+            base.Request('GET', 'subprocess.PIPE', [('X-Promise', 'p1')], b''))
+
+        # plain values are sent back and kept for later requests
+        self.assertEqual(result, base.subprocess.PIPE)
+        self.assertEqual(exposed_locals['p1'], base.subprocess.PIPE)
+
+        result, raised = transport.server_handle_request(None, exposed_locals,
+            base.Request('GET', 'subprocess.Popen', [('X-Promise', 'p2')], b''))
+
+        self.assertEqual(result.name, 'p2')
+        self.assertIs(exposed_locals['p2'], base.subprocess.Popen)
+        self.assertEqual(len(exposed_locals), 2)
+
+    def test_server_handle_get_error(self):
+        transport = base.BaseTransport()
+
+        result, raised = transport.server_handle_request(None, transport.server_exposed_locals(),
+            base.Request('GET', 'subprocess.nope', [], b''))
+
+        self.assertIsInstance(result, AttributeError)
+        self.assertTrue(raised)
+
+    def test_server_handle_del(self):
+        transport = base.BaseTransport()
+        exposed_locals = transport.server_exposed_locals()
+
+        names = [exposed_locals.expose(object()) for i in six.moves.range(3)]
+
+        result = transport.server_handle_request(None, exposed_locals,
+            base.Request('DEL', ','.join(names[:2]), [], b''))
+
+        self.assertEqual(result, (None, False))
+        self.assertEqual(len(exposed_locals), 1)
+
+        transport.server_handle_request(None, exposed_locals, base.Request('DEL', '', [], b''))
+
+        self.assertEqual(len(exposed_locals), 0)
+        self.assertIn('subprocess', exposed_locals)
+
+    def test_server_handle_stats(self):
+        request = base.Request('STATS', 'server', [], b'')
+
+        self.assertEqual(self.transport.server_handle_request(None, {}, request), (None, False))
+
+        self.transport.metrics = metrics.ServerMetrics()
+        self.transport.metrics.accepts.inc()
+
+        stats, raised = self.transport.server_handle_request(None, {}, request)
+
+        self.assertEqual(stats['accepts'], 1)
+
+    def test_server_handle_connection_metrics(self):
+        self.transport.metrics = metrics.ServerMetrics()
+
+        busy = []
+
+        with mock.patch.object(self.transport, 'get_request') as get_request,\
+                mock.patch.object(self.transport, 'server_handle_request') as server_handle_request,\
+                mock.patch.object(self.transport, 'send_response'):
+            get_request.side_effect = [base.Request('RUN', 'subprocess', [], b'foo'), DisconnectedError()]
+            server_handle_request.side_effect = lambda *args: \
+                busy.append(self.transport.metrics.busy.value) or (None, False)
+
+            self.transport.server_handle_connection(None)
+
+        stats = self.transport.metrics.snapshot()
+
+        self.assertEqual(busy, [1])
+        self.assertEqual(stats['busy_workers'], 0)
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['request_bytes']['sum'], 3)
+
+    def test_server_connection_taken(self):
+        self.transport.metrics = metrics.ServerMetrics()
+        self.transport.metrics.queued.inc()
+
+        with mock.patch.object(base.time, 'time', return_value=102):
+            self.transport.server_connection_taken(100)
+
+        stats = self.transport.metrics.snapshot()
+
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['queue_wait_seconds']['sum'], 2)
+
+    def test_server_run_cmd_metrics(self):
+        self.transport.metrics = metrics.ServerMetrics()
+
+        with self.subprocess_patcher as mock_subprocess:
+            process = mock_subprocess.Popen.return_value
+            process.communicate.return_value = b'', b''
+            process.returncode = 0
+
+            self.transport.server_run_cmd('true')
+
+        stats = self.transport.metrics.snapshot()
+
+        self.assertEqual(stats['spawn_seconds']['count'], 1)
+        self.assertEqual(stats['exec_seconds']['count'], 1)
+
+    def test_server_response_headers(self):
+        request = base.Request('RUN', 'subprocess', [['X-Request-Id', 'abc']], b'')
+        request.timings = {'spawn': 0.25, 'execution': 1}
+
+        self.assertEqual(self.transport.server_response_headers(request), [('X-Request-Id', 'abc')])
+
+        request.headers.append(['X-Timing', '1'])
+
+        self.assertEqual(self.transport.server_response_headers(request), [
+            ('X-Request-Id', 'abc'),
+            ('X-Spawn', '0.250000'),
+            ('X-Exec', '1.000000'),
+        ])
+
+    def test_queue_wait_timing(self):
+        self.transport.server_queue_wait = 2
+
+        first = base.Request('RUN', 'subprocess', [], b'')
+        second = base.Request('RUN', 'subprocess', [], b'')
+
+        self.transport.server_record_request(first)
+        self.transport.server_record_request(second)
+
+        # only the first request on a connection waited for a worker
+        self.assertEqual(first.timings, {'queue_wait': 2})
+        self.assertEqual(second.timings, {})
+
+    def test_send_response_timing(self):
+        request = base.Request('RUN', 'subprocess', [['X-Timing', '1']], b'')
+
+        with mock.patch.object(self.transport, 'send_algo') as send_algo:
+            self.transport.send_response(None, 'foo', request=request)
+
+        headers = send_algo.call_args_list[0][1]['headers']
+
+        self.assertEqual([name for name, value in headers], ['X-Serialize'])
+
+    def test_pickle_without_metrics(self):
+        self.transport.metrics = metrics.ServerMetrics()
+
+        transport = pickle.loads(pickle.dumps(self.transport))
+
+        self.assertIsNone(transport.metrics)
+
+    def test_send_chunks(self):
+        send_func = mock.Mock()
+        large = b'a' * base.SEND_COPY_LIMIT
+
+        self.transport.send_chunks(None, send_func, [b'foo', b'bar', large, b'baz'])
+
+        self.assertEqual(send_func.call_args_list, [
+            mock.call(None, b'foobar'),
+            mock.call(None, large),
+            mock.call(None, b'baz'),
+        ])
+        self.assertIs(send_func.call_args_list[1][0][1], large)
+
+    def test_send_request_frames(self):
+        sent = []
+        self.transport.client_send = lambda connection, data: sent.append(data)
+
+        self.transport.send_request_frames(None, [
+            ('GET', 'subprocess.PIPE', '', [('X-Promise', 'p1')]),
+            ('DEL', 'p1', '', None),
+        ])
+
+        self.assertEqual(sent, [b'GET subprocess.PIPE\r\nX-Promise: p1\r\nContent-Length: 0\r\n'
+            b'DEL p1\r\nContent-Length: 0\r\n'])
+
+    def test_send_algo_chunks(self):
+        sent = []
+
+        self.transport.send_algo(None, lambda connection, data: sent.append(data),
+            '200 OK', body=[b'foo', b'bar'])
+
+        self.assertEqual(sent, [b'200 OK\r\nContent-Length: 6\r\n\r\nfoobar'])
+
+    def test_serialize_body_fallback(self):
+        transport = base.BaseTransport(serializer='fast')
+
+        body = transport.serialize_body(ValueError('foo'))
+
+        self.assertIs(serializers.detect(body[0]), serializers.get_serializer('pickle'))
+
+    def test_unknown_serializer(self):
+        with self.assertRaises(ValueError):
+            base.BaseTransport(serializer='foo')
+
+    def test_send_response_serializer(self):
+        body = b''.join(serializers.get_serializer('fast').dumps([['ls'], {}]))
+        request = base.Request('RUN', 'subprocess', [], body)
+
+        with mock.patch.object(self.transport, 'send_algo') as send_algo:
+            self.transport.send_response(None, (b'foo', b'', 0), request=request)
+
+        chunks = send_algo.call_args_list[0][1]['body']
+
+        self.assertEqual(chunks[0][:1], serializers.FAST_MAGIC)
+        self.assertEqual(serializers.loads(b''.join(chunks)), (b'foo', b'', 0))
+
+    def test_pickle_without_cache(self):
+        self.transport.cache = cache.ResultCache()
+
+        transport = pickle.loads(pickle.dumps(self.transport))
+
+        self.assertIsNone(transport.cache)
+
+    def test_decode_run_cmd_old_server(self):
+        with self.assertRaises(UnknownMethodError):
+            self.transport.decode_run_cmd(base.Response(200, [], pickle.dumps(None)))
+
+    def test_send_stream_request_old_server(self):
+        self.transport.send_request_frame = mock.Mock()
+        self.transport.get_response = mock.Mock(return_value=base.Response(200, [], pickle.dumps(None)))
+
+        with self.assertRaises(UnknownMethodError):
+            list(self.transport.send_stream_request(None, 'echo foo'))
+
+    def test_send_batch_request_old_server(self):
+        self.transport.send_request_frame = mock.Mock()
+        self.transport.get_response = mock.Mock(return_value=base.Response(200, [], pickle.dumps(None)))
+
+        with self.assertRaises(UnknownMethodError):
+            list(self.transport.send_batch_request(None, ['true']))
+
+    def test_send_batch_request(self):
+        self.transport.send_request_frame = mock.Mock()
+        self.transport.get_response = mock.Mock(side_effect=[
+            base.Response(206, [('X-Index', '1')], pickle.dumps((b'', b'', 0))),
+            base.Response(206, [('X-Index', '0')], pickle.dumps(OSError())),
+            base.Response(200, [], pickle.dumps(2)),
+        ])
+
+        results = list(self.transport.send_batch_request(None, ['true', ['/nonexistent']]))
+
+        self.assertEqual(results[0], (1, (b'', b'', 0)))
+        self.assertEqual(results[1][0], 0)
+        self.assertIsInstance(results[1][1], OSError)
+
+    def test_client_request_headers_cache_ttl(self):
+        self.assertEqual(self.transport.client_request_headers(cache_ttl=5), [('X-Cache-TTL', '5.0')])
+
+    def test_cached_run_cmd(self):
+        self.transport.cache = cache.ResultCache()
+        self.transport.metrics = metrics.ServerMetrics()
+
+        requests = [base.Request('RUN', 'subprocess', [['X-Cache-TTL', '5']], b'') for i in range(2)]
+
+        with mock.patch.object(self.transport, 'server_run_cmd') as server_run_cmd:
+            server_run_cmd.return_value = b'foo', b'', 0
+
+            results = [self.transport.server_cached_run_cmd(request, 'ls', cwd='/tmp')
+                for request in requests]
+
+        self.assertEqual(results, [(b'foo', b'', 0)] * 2)
+        self.assertEqual(len(server_run_cmd.call_args_list), 1)
+        self.assertEqual([request.cache for request in requests], ['miss', 'hit'])
+        self.assertEqual(self.transport.server_response_headers(requests[1]), [('X-Cache', 'hit')])
+
+        stats = self.transport.metrics.snapshot()
+
+        self.assertEqual(stats['cache_hits'], 1)
+        self.assertEqual(stats['cache_misses'], 1)
+
+    def test_cached_run_cmd_without_ttl(self):
+        self.transport.cache = cache.ResultCache()
+
+        request = base.Request('RUN', 'subprocess', [], b'')
+
+        with mock.patch.object(self.transport, 'server_run_cmd') as server_run_cmd:
+            server_run_cmd.return_value = b'foo', b'', 0
+
+            self.transport.server_cached_run_cmd(request, 'ls')
+            self.transport.server_cached_run_cmd(request, 'ls')
+
+        self.assertEqual(len(server_run_cmd.call_args_list), 2)
+        self.assertIsNone(request.cache)
+        self.assertEqual(len(self.transport.cache), 0)
+
+    def test_cached_run_cmd_error(self):
+        self.transport.cache = cache.ResultCache()
+
+        request = base.Request('RUN', 'subprocess', [['X-Cache-TTL', '5']], b'')
+
+        with mock.patch.object(self.transport, 'server_run_cmd') as server_run_cmd:
+            server_run_cmd.side_effect = OSError()
+
+            with self.assertRaises(OSError):
+                self.transport.server_cached_run_cmd(request, 'ls')
+
+        # the next request runs the command instead of waiting
+        self.assertEqual(self.transport.cache.claim(cache.cache_key('ls'), 5), (None, True))
+
+    def test_cached_run_cmd_cache_gone(self):
+        self.transport.cache = mock.Mock()
+        self.transport.cache.claim.side_effect = EOFError()
+
+        request = base.Request('RUN', 'subprocess', [['X-Cache-TTL', '5']], b'')
+
+        with mock.patch.object(self.transport, 'server_run_cmd') as server_run_cmd:
+            server_run_cmd.return_value = b'foo', b'', 0
+
+            self.assertEqual(self.transport.server_cached_run_cmd(request, 'ls'), (b'foo', b'', 0))
+
+        self.assertEqual(self.transport.cache.store.call_args_list, [])
+
+    def test_no_client_pool(self):
+        self.assertIsNone(self.transport.client_pool)
+
+    def test_client_pool(self):
+        transport = base.BaseTransport(client_pool_size=3, client_pool_idle_timeout=5)
+
+        self.assertEqual(transport.client_pool.max_size, 3)
+        self.assertEqual(transport.client_pool.idle_timeout, 5)
+
+
+
+class RecvTestCase(BaseTestCase):
+    def setUp(self):
+        super(RecvTestCase, self).setUp()
+        self.transport = base.BaseTransport()
+        self.connection = object()
+
+    def recv_from(self, chunks):
+        chunks = list(chunks)
+        calls = []
+
+        def recv(connection, length):
+            calls.append(length)
+            if not chunks:
+                return b''
+            chunk = chunks.pop(0)
+            if len(chunk) > length:
+                chunks.insert(0, chunk[length:])
+                chunk = chunk[:length]
+            return chunk
+
+        return recv, calls
+
+
+class RecvAlgoTestCase(RecvTestCase):
+    def test_split_headers(self):
+        msg = b'200 OK\r\nX-Foo: bar\r\nContent-Length: 3\r\n\r\nabc'
+        # split inside a CRLF and inside the body
+        recv, calls = self.recv_from([msg[:7], msg[7:35], msg[35:]])
+
+        first_line, headers, body = self.transport.recv_algo(self.connection, recv)
+
+        self.assertEqual(first_line, '200 OK')
+        self.assertEqual(headers, [['X-Foo', 'bar'], ['Content-Length', '3']])
+        self.assertEqual(bytes(body), b'abc')
+
+    def test_no_body(self):
+        recv, calls = self.recv_from([b'GET foo.bar\r\nContent-Length: 0\r\n'])
+
+        first_line, headers, body = self.transport.recv_algo(self.connection, recv)
+
+        self.assertEqual(first_line, 'GET foo.bar')
+        self.assertEqual(bytes(body), b'')
+
+    def test_body_recv_into(self):
+        payload = b'x' * 100000
+        msg = b'200 OK\r\nContent-Length: 100000\r\n\r\n' + payload
+        recv, calls = self.recv_from([msg])
+
+        def recv_into(connection, buf):
+            data = recv(connection, len(buf))
+            buf[:len(data)] = data
+            return len(data)
+
+        recv_into = mock.Mock(side_effect=recv_into)
+
+        first_line, headers, body = self.transport.recv_algo(self.connection, recv, recv_into)
+
+        self.assertEqual(bytes(body), payload)
+        self.assertEqual(calls[0], 4096)
+        self.assertTrue(recv_into.call_count > 0)
+
+    def test_pipelined_messages(self):
+        msg1 = b'200 OK\r\nContent-Length: 3\r\n\r\nabc'
+        msg2 = b'400 Error\r\nContent-Length: 0\r\n'
+        recv, calls = self.recv_from([msg1 + msg2])
+
+        self.assertEqual(bytes(self.transport.recv_algo(self.connection, recv)[2]), b'abc')
+        self.assertEqual(self.transport.recv_algo(self.connection, recv)[0], '400 Error')
+        self.assertEqual(len(calls), 1)
+
+    def test_forget_connection(self):
+        recv, calls = self.recv_from([b'200 OK\r\nContent-Length: 0\r\n200'])
+
+        self.transport.recv_algo(self.connection, recv)
+        self.transport.forget_connection(self.connection)
+
+        self.assertEqual(self.transport._recv_buffers, {})
+
+    def test_disconnected_in_body(self):
+        recv, calls = self.recv_from([b'200 OK\r\nContent-Length: 10\r\n\r\nabc'])
+
+        with self.assertRaises(DisconnectedError):
+            self.transport.recv_algo(self.connection, recv)
+
+
+class RecvBinaryAlgoTestCase(RecvTestCase):
+    def pack(self, method='', status=0, path=b'', headers=b'', body=b'', request_id=0):
+        return constants.BINARY_HEADER.pack(constants.BINARY_MAGIC,
+            constants.BINARY_METHOD_CODES[method], status, request_id,
+            len(path), len(headers), len(body)) + path + headers + body
+
+    def test_split_frame(self):
+        msg = self.pack('CALL', path=b'obj1', headers=b'X-Foo: bar\r\n', body=b'abc', request_id=7)
+        recv, calls = self.recv_from([msg[:3], msg[3:25], msg[25:]])
+
+        frame = self.transport.recv_binary_algo(self.connection, recv)
+
+        self.assertEqual(frame[:5], ('CALL', 0, 7, 'obj1', [['X-Foo', 'bar']]))
+        self.assertEqual(bytes(frame[5]), b'abc')
+
+    def test_pipelined_frames(self):
+        recv, calls = self.recv_from([self.pack(status=200, body=b'abc') + self.pack(status=400)])
+
+        self.assertEqual(bytes(self.transport.recv_binary_algo(self.connection, recv)[5]), b'abc')
+        self.assertEqual(self.transport.recv_binary_algo(self.connection, recv)[1], 400)
+        self.assertEqual(len(calls), 1)
+
+    def test_bad_magic(self):
+        recv, calls = self.recv_from([b'GET foo.bar\r\nContent-Length: 0\r\n' + b' ' * 20])
+
+        with self.assertRaises(ProtocolError):
+            self.transport.recv_binary_algo(self.connection, recv)
+
+    def test_send_binary_algo(self):
+        sent = []
+
+        self.transport.send_binary_algo(self.connection, lambda connection, data: sent.append(data),
+            method='CALL', path='obj1', headers=[('X-Foo', 'bar')], body=b'abc', request_id=7)
+
+        self.assertEqual(sent, [self.pack('CALL', path=b'obj1', headers=b'X-Foo: bar\r\n', body=b'abc', request_id=7)])
+
+
+class SharedMemoryTestCase(RecvTestCase):
+    def setUp(self):
+        super(SharedMemoryTestCase, self).setUp()
+        self.transport._shm_connections[id(self.connection)] = 4
+
+    def test_needs_fds(self):
+        with self.assertRaises(ValueError):
+            base.BaseTransport(shm_threshold=4)
+
+    def test_shm_chunks_small(self):
+        headers, chunks, fds = self.transport.shm_chunks(self.connection, [('X-Foo', 'bar')], b'abc')
+
+        self.assertEqual((headers, chunks, fds), ([('X-Foo', 'bar')], [b'abc'], ()))
+
+    def test_shm_chunks(self):
+        headers, chunks, fds = self.transport.shm_chunks(self.connection, None, [b'abc', b'def'])
+
+        self.assertEqual((headers, chunks), ([('X-Shm', 6)], []))
+        self.assertEqual(bytes(shm.open_body(fds[0], 6)[:]), b'abcdef')
+
+    def test_shm_chunks_shared_body(self):
+        body = shm.SharedBody(5, 3)
+
+        headers, chunks, fds = self.transport.shm_chunks(object(), None, body)
+
+        self.assertEqual((headers, chunks, fds), ([('X-Shm', 3)], [], (5,)))
+
+    def test_send_binary_algo(self):
+        sent = []
+
+        self.transport.send_binary_algo(self.connection, lambda connection, data: sent.append(data),
+            status=200, body=b'abcdef')
+
+        fds = self.transport._pending_fds.pop(id(self.connection))
+
+        self.assertEqual(len(fds), 1)
+        self.assertIn(b'X-Shm: 6\r\n', sent[0])
+        self.assertEqual(bytes(shm.open_body(fds[0], 6)[:]), b'abcdef')
+
+    def test_recv_shm_body(self):
+        body = shm.create([b'abcdef'])
+        self.transport._received_fds[id(self.connection)] = collections.deque([body.fd])
+
+        data = self.transport.recv_shm_body(self.connection, [['X-Shm', '6']], b'')
+
+        self.assertEqual(bytes(data[:]), b'abcdef')
+        self.assertFalse(self.transport._received_fds[id(self.connection)])
+
+    def test_recv_shm_body_plain(self):
+        self.assertEqual(self.transport.recv_shm_body(self.connection, [], b'abc'), b'abc')
+
+    def test_recv_shm_body_no_fd(self):
+        with self.assertRaises(ProtocolError):
+            self.transport.recv_shm_body(self.connection, [['X-Shm', '6']], b'')
+
+    def test_forget_connection(self):
+        read_fd, write_fd = os.pipe()
+        self.transport._received_fds[id(self.connection)] = collections.deque([read_fd])
+        self.transport._pending_fds[id(self.connection)] = [write_fd]
+
+        self.transport.forget_connection(self.connection)
+
+        for fd in (read_fd, write_fd):
+            with self.assertRaises(OSError):
+                os.fstat(fd)
+
+        self.assertNotIn(id(self.connection), self.transport._shm_connections)
+
+
+class StdioTestCase(BaseTestCase):
+    def setUp(self):
+        super(StdioTestCase, self).setUp()
+        self.transport = base.BaseTransport()
+        self.transport.passes_fds = True
+        self.connection = object()
+
+    def pass_fds(self, *fds):
+        self.transport._received_fds[id(self.connection)] = collections.deque(fds)
+
+    def assertClosed(self, fd):
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_server_run_cmd(self):
+        read_fd, write_fd = os.pipe()
+
+        result = self.transport.server_run_cmd('echo foo; echo bar >&2', stdio={'stdout': write_fd})
+
+        self.assertEqual(result, (None, b'bar\n', 0))
+        self.assertClosed(write_fd)
+        self.assertEqual(os.read(read_fd, 16), b'foo\n')
+
+        os.close(read_fd)
+
+    def test_server_handle_run(self):
+        read_fd, write_fd = os.pipe()
+        self.pass_fds(write_fd)
+
+        request = base.Request('RUN', 'subprocess', [['X-Stdio', 'stderr']],
+            pickle.dumps([['echo foo >&2'], {}]))
+
+        result = self.transport.server_handle_run(self.connection, {}, request)
+
+        self.assertEqual(result, ((b'', None, 0), False))
+        self.assertEqual(os.read(read_fd, 16), b'foo\n')
+
+        os.close(read_fd)
+
+    def test_server_stdio(self):
+        self.pass_fds(3, 4)
+
+        request = base.Request('RUN', 'subprocess', [['X-Stdio', 'stdin,stderr']], b'')
+
+        self.assertEqual(self.transport.server_stdio(self.connection, request), {'stdin': 3, 'stderr': 4})
+
+    def test_server_stdio_none(self):
+        request = base.Request('RUN', 'subprocess', [], b'')
+
+        self.assertEqual(self.transport.server_stdio(self.connection, request), {})
+
+    def test_server_stdio_without_fds(self):
+        self.pass_fds(3)
+
+        request = base.Request('RUN', 'subprocess', [['X-Stdio', 'stdin,stderr']], b'')
+
+        with self.assertRaises(ProtocolError):
+            self.transport.server_stdio(self.connection, request)
+
+    def test_server_stdio_unknown(self):
+        read_fd, write_fd = os.pipe()
+        self.pass_fds(write_fd)
+
+        request = base.Request('RUN', 'subprocess', [['X-Stdio', 'stdfoo']], b'')
+
+        with self.assertRaises(ProtocolError):
+            self.transport.server_stdio(self.connection, request)
+
+        self.assertClosed(write_fd)
+
+        os.close(read_fd)
+
+    def test_server_handle_hello(self):
+        request = base.Request('HELLO', errand_boy.__version__, [['X-Pass-Fds', '1']], b'')
+
+        hello, raised = self.transport.server_handle_hello(self.connection, {}, request)
+
+        self.assertTrue(hello['fds'])
+        self.assertIn(id(self.connection), self.transport._fd_connections)
+
+    def test_server_handle_hello_no_fds(self):
+        self.transport.passes_fds = False
+
+        request = base.Request('HELLO', errand_boy.__version__, [['X-Pass-Fds', '1']], b'')
+
+        hello, raised = self.transport.server_handle_hello(self.connection, {}, request)
+
+        self.assertNotIn('fds', hello)
+        self.assertNotIn(id(self.connection), self.transport._fd_connections)
+
+    def test_client_stdio(self):
+        f = mock.Mock()
+        f.fileno.return_value = 7
+
+        self.assertEqual(self.transport.client_stdio(stdout=f, stderr=2),
+            ([('X-Stdio', 'stdout,stderr')], [7, 2]))
+        self.assertEqual(self.transport.client_stdio(), ([], []))
+
+    def test_client_stdio_no_fds(self):
+        with self.assertRaises(ValueError):
+            base.BaseTransport().client_stdio(stdin=0)
+
+    def test_client_pass_stdio(self):
+        read_fd, write_fd = os.pipe()
+
+        with mock.patch.object(self.transport, 'send_request', return_value={'fds': True}) as send_request:
+            fds = self.transport.client_pass_stdio(self.connection, [write_fd])
+            self.transport.client_pass_stdio(self.connection, [])
+
+        self.assertEqual(send_request.call_count, 1)
+        self.assertEqual(send_request.call_args[1]['headers'], [('X-Pass-Fds', '1')])
+        self.assertNotEqual(fds, [write_fd])
+
+        for fd in fds + [read_fd, write_fd]:
+            os.close(fd)
+
+    def test_client_pass_stdio_old_server(self):
+        with mock.patch.object(self.transport, 'send_request', return_value={'version': '0.3.9'}):
+            with self.assertRaises(UnsupportedError):
+                self.transport.client_pass_stdio(self.connection, [1])
+
+    def test_send_algo_fds(self):
+        self.transport._shm_connections[id(self.connection)] = 4
+
+        self.transport.send_algo(self.connection, lambda connection, data: None, 'RUN subprocess',
+            body=b'abcdef', fds=(7,))
+
+        fds = self.transport._pending_fds.pop(id(self.connection))
+
+        # the body's descriptor comes first
+        self.assertEqual(fds[1:], [7])
+        os.close(fds[0])
+
+
+class InputTestCase(BaseTestCase):
+    def setUp(self):
+        super(InputTestCase, self).setUp()
+        self.transport = base.BaseTransport()
+        self.connection = object()
+
+    def input_frames(self, *chunks):
+        return [base.Request('INPUT', 'stdin', [], chunk) for chunk in chunks + (b'',)]
+
+    def test_iter_input(self):
+        data = b'a' * (base.STREAM_CHUNK_SIZE + 1)
+
+        self.assertEqual([bytes(chunk) for chunk in base.iter_input(data)],
+            [data[:base.STREAM_CHUNK_SIZE], b'a'])
+        self.assertEqual(list(base.iter_input(six.BytesIO(data))), [data[:base.STREAM_CHUNK_SIZE], b'a'])
+        self.assertEqual(list(base.iter_input(iter([b'foo', b'bar']))), [b'foo', b'bar'])
+        self.assertEqual(list(base.iter_input(b'')), [])
+
+    def test_write_input_reader_gone(self):
+        read_fd, write_fd = os.pipe()
+        os.close(read_fd)
+
+        self.assertFalse(base.write_input(write_fd, b'foo'))
+
+        os.close(write_fd)
+
+    def test_server_feed_input(self):
+        read_fd, write_fd = os.pipe()
+
+        with mock.patch.object(self.transport, 'get_request') as get_request:
+            get_request.side_effect = self.input_frames(b'foo', b'bar')
+
+            self.transport.server_feed_input(self.connection, write_fd)
+
+        os.close(write_fd)
+
+        self.assertEqual(os.read(read_fd, 16), b'foobar')
+
+        os.close(read_fd)
+
+    def test_server_feed_input_unexpected(self):
+        with mock.patch.object(self.transport, 'get_request') as get_request:
+            get_request.return_value = base.Request('RUN', 'subprocess', [], b'')
+
+            with self.assertRaises(ProtocolError):
+                self.transport.server_feed_input(self.connection, None)
+
+    def test_server_run_cmd_input(self):
+        with mock.patch.object(self.transport, 'get_request') as get_request:
+            get_request.side_effect = self.input_frames(b'foo', b'bar')
+
+            result = self.transport.server_run_cmd_input(self.connection, 'cat; echo baz >&2')
+
+        self.assertEqual(result, (b'foobar', b'baz\n', 0))
+
+    def test_server_run_cmd_input_not_started(self):
+        with mock.patch.object(self.transport, 'get_request') as get_request:
+            get_request.side_effect = self.input_frames(b'foo', b'bar')
+
+            with self.assertRaises(OSError):
+                self.transport.server_run_cmd_input(self.connection, ['/nonexistent'])
+
+        # the input was read all the same
+        self.assertEqual(get_request.call_count, 3)
+
+    def test_server_run_cmd_input_disconnected(self):
+        with mock.patch.object(self.transport, 'get_request') as get_request:
+            get_request.side_effect = [base.Request('INPUT', 'stdin', [], b'foo'), DisconnectedError()]
+
+            with self.assertRaises(DisconnectedError):
+                self.transport.server_run_cmd_input(self.connection, ['sleep', '10'])
+
+    def test_server_handle_run(self):
+        request = base.Request('RUN', 'subprocess', [['X-Input', '1']], pickle.dumps([['cat'], {}]))
+
+        with mock.patch.object(self.transport, 'get_request') as get_request:
+            get_request.side_effect = self.input_frames(b'foo')
+
+            result = self.transport.server_handle_run(self.connection, {}, request)
+
+        self.assertEqual(result, ((b'foo', b'', 0), False))
+
+    def test_send_input(self):
+        with mock.patch.object(self.transport, 'send_request_frame') as send_request_frame:
+            self.transport.send_input(self.connection, [b'foo', b'', b'bar'])
+
+        self.assertEqual(send_request_frame.call_args_list, [
+            mock.call(self.connection, 'INPUT', 'stdin', body=b'foo'),
+            mock.call(self.connection, 'INPUT', 'stdin', body=b'bar'),
+            mock.call(self.connection, 'INPUT', 'stdin'),
+        ])
+
+    def test_send_input_bytes(self):
+        sent = []
+        data = b'a' * (base.STREAM_CHUNK_SIZE + 3)
+
+        with mock.patch.object(self.transport, 'client_send', side_effect=lambda connection, data: sent.append(data)):
+            self.transport.send_input(self.connection, data)
+
+        # the short last chunk is joined with its frame's header
+        self.assertTrue(sent[-2].endswith(b'aaa'))
+        self.assertEqual(sum(bytes(chunk).count(b'a') for chunk in sent), len(data))
+
+    def test_run_cmd_stdin_and_input(self):
+        with self.assertRaises(ValueError):
+            self.transport.run_cmd('cat', stdin=0, input=b'foo')
+
+    def test_client_check_input(self):
+        with mock.patch.object(self.transport, 'send_request', return_value={'input': True}) as send_request:
+            self.transport.client_check_input(self.connection)
+            self.transport.client_check_input(self.connection)
+
+        self.assertEqual(send_request.call_count, 1)
+
+    def test_client_check_input_old_server(self):
+        with mock.patch.object(self.transport, 'send_request', return_value={'framing': 'binary'}):
+            with self.assertRaises(UnknownMethodError):
+                self.transport.client_check_input(self.connection)
+
+    def test_client_hello_text_framing(self):
+        self.transport.framing = 'text'
+
+        with mock.patch.object(self.transport, 'send_request', return_value={'framing': 'binary', 'input': True}):
+            self.transport.client_hello(self.connection)
+
+        self.assertNotIn(id(self.connection), self.transport._binary_connections)
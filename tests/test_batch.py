@@ -0,0 +1,66 @@
+import time
+
+from errand_boy import batch
+
+from .base import mock, BaseTestCase
+
+
+class MaxParallelTestCase(BaseTestCase):
+    def test_max_parallel_for(self):
+        self.assertEqual(batch.max_parallel_for(None), batch.DEFAULT_MAX_PARALLEL)
+        self.assertEqual(batch.max_parallel_for(0), batch.DEFAULT_MAX_PARALLEL)
+        self.assertEqual(batch.max_parallel_for(-1), 1)
+        self.assertEqual(batch.max_parallel_for(1000), batch.MAX_PARALLEL)
+
+
+class CommandBatchTestCase(BaseTestCase):
+    def run_batch(self, commands, **kwargs):
+        finished = []
+
+        batch.CommandBatch(commands, **kwargs).run(
+            lambda index, result, started, spawned: finished.append((index, result)))
+
+        return finished
+
+    def test_run(self):
+        finished = self.run_batch(['sleep 0.2; echo foo', ['sh', '-c', 'echo bar >&2; exit 3']])
+
+        # in the order they finished
+        self.assertEqual(finished, [
+            (1, (b'', b'bar\n', 3)),
+            (0, (b'foo\n', b'', 0)),
+        ])
+
+    def test_env_cwd(self):
+        finished = self.run_batch(['echo $FOO; pwd'], env={'FOO': 'foo'}, cwd='/')
+
+        self.assertEqual(finished, [(0, (b'foo\n/\n', b'', 0))])
+
+    def test_large_output(self):
+        finished = self.run_batch(['head -c 1000000 /dev/zero'] * 3)
+
+        self.assertEqual([result[0] for index, result in finished], [b'\0' * 1000000] * 3)
+
+    def test_max_parallel(self):
+        started = time.time()
+
+        self.run_batch(['sleep 0.2'] * 4, max_parallel=2)
+
+        self.assertGreaterEqual(time.time() - started, 0.4)
+
+    def test_spawn_error(self):
+        finished = self.run_batch([['/nonexistent'], 'echo foo'])
+
+        self.assertEqual(finished[0][0], 0)
+        self.assertIsInstance(finished[0][1], OSError)
+        self.assertEqual(finished[1], (1, (b'foo\n', b'', 0)))
+
+    def test_kill_on_error(self):
+        command_batch = batch.CommandBatch(['sleep 10', 'true'])
+
+        finished = mock.Mock(side_effect=IOError())
+
+        with self.assertRaises(IOError):
+            command_batch.run(finished)
+
+        self.assertEqual(command_batch._pipes, {})
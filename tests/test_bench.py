@@ -0,0 +1,144 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from errand_boy import bench
+
+from .base import BaseTestCase, mock
+
+
+class PercentileTestCase(BaseTestCase):
+    def test_percentile(self):
+        samples = list(range(1, 101))
+
+        self.assertEqual(bench.percentile(samples, 0.5), 50)
+        self.assertEqual(bench.percentile(samples, 0.99), 99)
+        self.assertEqual(bench.percentile(samples, 1), 100)
+        self.assertEqual(bench.percentile(samples, 0), 1)
+
+    def test_empty(self):
+        self.assertIsNone(bench.percentile([], 0.5))
+
+    def test_summarize(self):
+        summary = bench.summarize([0.3, 0.1, 0.2, 0.4], 2.0)
+
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['ops_per_sec'], 2.0)
+        self.assertAlmostEqual(summary['mean'], 0.25)
+        self.assertEqual(summary['min'], 0.1)
+        self.assertEqual(summary['p50'], 0.2)
+        self.assertEqual(summary['max'], 0.4)
+
+
+class BenchTestCase(BaseTestCase):
+    def setUp(self):
+        super(BenchTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(BenchTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_framing(self):
+        results = bench.bench_framing(3, [0, 10])
+
+        self.assertEqual(len(results), 8)
+        self.assertEqual(set((r['name'], r['framing'], r['size']) for r in results),
+            set((name, framing, size) for name in ('send', 'recv')
+                for framing in ('text', 'binary') for size in (0, 10)))
+        self.assertTrue(all(r['count'] == 3 for r in results))
+
+    def test_main_output(self):
+        path = os.path.join(self.tmpdir, 'results.json')
+
+        with mock.patch.object(bench.sys, 'stdout') as stdout:
+            bench.main(['bench', '--suite=framing', '--iterations=2', '--sizes=1',
+                '--output={}'.format(path)])
+
+        self.assertIn('ops_per_sec', stdout.write.call_args[0][0])
+
+        with open(path) as f:
+            data = json.load(f)
+
+        self.assertEqual(data['environment']['errand_boy'], bench.__version__)
+        self.assertEqual(len(data['results']), 4)
+
+    def test_run_concurrently(self):
+        calls = []
+
+        samples, elapsed = bench.run_concurrently(lambda: calls.append(1), 3, 4)
+
+        self.assertEqual(len(samples), 12)
+        self.assertEqual(len(calls), 12)
+
+    def test_run_concurrently_error(self):
+        def fail():
+            raise ValueError('foo')
+
+        with self.assertRaises(ValueError):
+            bench.run_concurrently(fail, 2, 1)
+
+
+class MemoryBenchTestCase(BaseTestCase):
+    def test_allocate(self):
+        ballast = bench.allocate(bench.PAGE_SIZE * 3)
+
+        self.assertEqual(len(ballast), bench.PAGE_SIZE * 3)
+        self.assertEqual(ballast[bench.PAGE_SIZE], 1)
+
+    def test_process_tree(self):
+        process = subprocess.Popen(['sleep', '10'])
+
+        try:
+            pids = bench.process_tree(os.getpid())
+        finally:
+            process.kill()
+            process.wait()
+
+        self.assertEqual(pids[0], os.getpid())
+        self.assertIn(process.pid, pids)
+
+    def test_memory_usage(self):
+        rss, pss = bench.memory_usage([os.getpid()])
+
+        self.assertGreater(rss, 0)
+        self.assertGreater(pss, 0)
+
+        process = subprocess.Popen(['true'])
+        process.wait()
+
+        # a process that exits between listing and reading is left out
+        rss, pss = bench.memory_usage([process.pid, os.getpid()])
+
+        self.assertGreater(rss, 0)
+        self.assertGreater(pss, 0)
+
+        self.assertEqual(bench.memory_usage([process.pid]), (None, None))
+
+    def test_measure_memory(self):
+        import resource
+
+        usage = {
+            resource.RUSAGE_SELF: [mock.Mock(ru_minflt=10, ru_majflt=1),
+                mock.Mock(ru_minflt=15, ru_majflt=1)],
+            resource.RUSAGE_CHILDREN: [mock.Mock(ru_minflt=100, ru_majflt=0),
+                mock.Mock(ru_minflt=300, ru_majflt=2)],
+        }
+
+        with mock.patch('resource.getrusage', side_effect=lambda who: usage[who].pop(0)):
+            result = bench.measure_memory(lambda: None, 1, 1)
+
+        self.assertEqual(result['count'], 1)
+        self.assertEqual(result['minor_faults'], 205)
+        self.assertEqual(result['major_faults'], 2)
+
+    def test_bench_memory(self):
+        results = bench.bench_memory(2, [1], bench.PAGE_SIZE)
+
+        self.assertEqual([r['name'] for r in results], ['popen', 'popen_fork', 'run_cmd'])
+        self.assertTrue(all(r['count'] == 2 for r in results))
+        self.assertGreater(results[0]['peak_rss'], 0)
+        self.assertNotIn('server_pss', results[0])
+        self.assertGreater(results[2]['server_pss'], 0)
@@ -0,0 +1,140 @@
+import threading
+import time
+
+from errand_boy import cache
+
+from .base import mock, BaseTestCase
+
+
+class CacheKeyTestCase(BaseTestCase):
+    def test_env_order(self):
+        self.assertEqual(
+            cache.cache_key('ls', {'A': '1', 'B': '2'}, '/tmp'),
+            cache.cache_key('ls', {'B': '2', 'A': '1'}, '/tmp'),
+        )
+
+    def test_different(self):
+        key = cache.cache_key('ls')
+
+        self.assertNotEqual(key, cache.cache_key('ls -al'))
+        self.assertNotEqual(key, cache.cache_key('ls', {}))
+        self.assertNotEqual(key, cache.cache_key('ls', cwd='/tmp'))
+        self.assertNotEqual(key, cache.cache_key(['ls']))
+
+
+class ResultCacheTestCase(BaseTestCase):
+    def setUp(self):
+        super(ResultCacheTestCase, self).setUp()
+        self.cache = cache.ResultCache(max_entries=2, max_bytes=10)
+
+    def test_claim_and_store(self):
+        self.assertEqual(self.cache.claim('a', 5), (None, True))
+
+        self.cache.store('a', 'foo', 5, 3)
+
+        self.assertEqual(self.cache.claim('a', 5), ('foo', False))
+        self.assertEqual(self.cache.get('a', 5), 'foo')
+        self.assertEqual(self.cache.size, 3)
+
+    def test_ttl(self):
+        with mock.patch.object(cache.time, 'time') as mock_time:
+            mock_time.return_value = 100
+
+            self.cache.store('a', 'foo', 5, 3)
+
+            mock_time.return_value = 103
+
+            self.assertEqual(self.cache.get('a', 5), 'foo')
+            # the request accepts less stale results than the entry's ttl
+            self.assertIsNone(self.cache.get('a', 2))
+            self.assertEqual(len(self.cache), 1)
+
+            mock_time.return_value = 105
+
+            self.assertIsNone(self.cache.get('a', 10))
+            self.assertEqual(len(self.cache), 0)
+            self.assertEqual(self.cache.size, 0)
+
+    def test_lru_entries(self):
+        self.cache.store('a', 'foo', 5, 1)
+        self.cache.store('b', 'bar', 5, 1)
+
+        # a is now the most recently used
+        self.cache.get('a', 5)
+
+        self.cache.store('c', 'baz', 5, 1)
+
+        self.assertEqual(self.cache.get('a', 5), 'foo')
+        self.assertIsNone(self.cache.get('b', 5))
+        self.assertEqual(self.cache.get('c', 5), 'baz')
+
+    def test_lru_bytes(self):
+        self.cache.store('a', 'foo', 5, 6)
+        self.cache.store('b', 'bar', 5, 6)
+
+        self.assertIsNone(self.cache.get('a', 5))
+        self.assertEqual(self.cache.get('b', 5), 'bar')
+        self.assertEqual(self.cache.size, 6)
+
+    def test_too_large(self):
+        self.cache.claim('a', 5)
+        self.cache.store('a', 'foo', 5, 11)
+
+        self.assertEqual(len(self.cache), 0)
+        # the claim is released all the same
+        self.assertEqual(self.cache.claim('a', 5), (None, True))
+
+    def test_claimed_without_wait(self):
+        self.cache.claim('a', 5)
+
+        self.assertEqual(self.cache.claim('a', 5, wait=False), (None, False))
+
+    def test_release(self):
+        self.cache.claim('a', 5)
+        self.cache.release('a')
+
+        self.assertEqual(self.cache.claim('a', 5), (None, True))
+
+    def test_coalesce(self):
+        self.cache.claim('a', 5)
+
+        results = []
+
+        def claim():
+            results.append(self.cache.claim('a', 5))
+
+        threads = [threading.Thread(target=claim) for i in range(3)]
+
+        for thread in threads:
+            thread.start()
+
+        time.sleep(0.1)
+
+        self.assertEqual(results, [])
+
+        self.cache.store('a', 'foo', 5, 3)
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [('foo', False)] * 3)
+
+    def test_coalesce_timeout(self):
+        self.cache.coalesce_timeout = 0.1
+
+        self.cache.claim('a', 5)
+
+        # the claimant is taking too long, take the key over
+        self.assertEqual(self.cache.claim('a', 5), (None, True))
+
+
+class StartCacheTestCase(BaseTestCase):
+    def test_shared(self):
+        manager, result_cache = cache.start_cache(10, 1024)
+
+        try:
+            result_cache.store('a', (b'foo', b'', 0), 5, 3)
+
+            self.assertEqual(result_cache.claim('a', 5), ((b'foo', b'', 0), False))
+        finally:
+            manager.shutdown()
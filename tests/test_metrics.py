@@ -0,0 +1,73 @@
+import threading
+
+from six.moves.urllib.request import urlopen
+
+from errand_boy import metrics
+
+from .base import BaseTestCase
+
+
+class HistogramTestCase(BaseTestCase):
+    def setUp(self):
+        super(HistogramTestCase, self).setUp()
+        self.histogram = metrics.Histogram('foo', 'Foo.', (1, 10), threading.Lock())
+
+    def test_snapshot(self):
+        for value in (0.5, 1, 5, 20):
+            self.histogram.observe(value)
+
+        snapshot = self.histogram.snapshot()
+
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['sum'], 26.5)
+        self.assertEqual(snapshot['buckets'], [(1, 2), (10, 3), (float('inf'), 4)])
+
+    def test_empty(self):
+        snapshot = self.histogram.snapshot()
+
+        self.assertEqual(snapshot['count'], 0)
+        self.assertEqual(snapshot['buckets'][-1], (float('inf'), 0))
+
+
+class ServerMetricsTestCase(BaseTestCase):
+    def setUp(self):
+        super(ServerMetricsTestCase, self).setUp()
+        self.metrics = metrics.ServerMetrics()
+
+    def test_snapshot(self):
+        self.metrics.workers.set(4)
+        self.metrics.busy.inc()
+        self.metrics.accepts.inc()
+        self.metrics.execution.observe(0.2)
+
+        stats = self.metrics.snapshot()
+
+        self.assertEqual(stats['workers'], 4)
+        self.assertEqual(stats['busy_workers'], 1)
+        self.assertEqual(stats['idle_workers'], 3)
+        self.assertEqual(stats['accepts'], 1)
+        self.assertEqual(stats['exec_seconds']['count'], 1)
+
+    def test_to_prometheus(self):
+        self.metrics.accepts.inc(3)
+        self.metrics.bytes_out.observe(100)
+
+        text = self.metrics.to_prometheus()
+
+        self.assertIn('# TYPE errand_boy_accepts counter\n', text)
+        self.assertIn('errand_boy_accepts_total 3\n', text)
+        self.assertIn('errand_boy_response_bytes_bucket{le="64"} 0\n', text)
+        self.assertIn('errand_boy_response_bytes_bucket{le="256"} 1\n', text)
+        self.assertIn('errand_boy_response_bytes_bucket{le="+Inf"} 1\n', text)
+        self.assertIn('errand_boy_response_bytes_count 1\n', text)
+
+    def test_serve_metrics(self):
+        self.metrics.accepts.inc()
+
+        server = metrics.serve_metrics(self.metrics, 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        response = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+
+        self.assertIn(b'errand_boy_accepts_total 1\n', response.read())
@@ -74,3 +74,19 @@ class MockTransportSimTestCase(BaseTestCase):
 
         self.assertEqual(mock_subprocess.Popen.call_count, 1)
         self.assertEqual(mock_subprocess.Popen.call_args_list[0][0][0], cmd)
+
+    def test_stream_cmd(self):
+        transport = mock_transport.MockTransport()
+
+        result = list(transport.stream_cmd('printf foo; printf bar >&2; exit 2'))
+
+        self.assertIn(('stdout', b'foo'), result)
+        self.assertIn(('stderr', b'bar'), result)
+        self.assertEqual(result[-1], ('returncode', 2))
+        self.assertEqual(len(result), 3)
+
+    def test_stream_cmd_error(self):
+        transport = mock_transport.MockTransport()
+
+        with self.assertRaises(OSError):
+            list(transport.stream_cmd(['/nonexistent/command']))
@@ -1,6 +1,6 @@
 import errand_boy
 from errand_boy import run
-from errand_boy.transports import unixsocket
+from errand_boy.transports import tcpsocket, unixsocket
 
 from .base import mock, BaseTestCase
 
@@ -49,7 +49,7 @@ class MainTestCase(BaseTestCase):
 
         self.assertEqual(transport.run_server.call_count, 1)
         self.assertEqual(transport.run_server.call_args_list[0][0], tuple())
-        self.assertEqual(transport.run_server.call_args_list[0][1], {'max_accepts': 5000, 'max_child_tasks': 100, 'pool_size': 10})
+        self.assertEqual(transport.run_server.call_args_list[0][1], {'max_accepts': 5000, 'max_child_tasks': 100, 'pool_size': 10, 'keepalive_timeout': None, 'prefork': False, 'min_workers': None, 'max_workers': None, 'worker_idle_timeout': 60, 'max_queue': None, 'overload': 'reject', 'handover_argv': None, 'handover_timeout': 10, 'metrics_port': None, 'cache_size': 0, 'cache_bytes': 67108864, 'max_session_objects': 1000})
 
     def test_server_with_options(self):
         argv = ['/srv/errand-boy/errand_boy/run.py', '--max-accepts', '5']
@@ -63,5 +63,107 @@ class MainTestCase(BaseTestCase):
 
         self.assertEqual(transport.run_server.call_count, 1)
         self.assertEqual(transport.run_server.call_args_list[0][0], tuple())
-        self.assertEqual(transport.run_server.call_args_list[0][1], {'max_accepts': int(argv[2]), 'max_child_tasks': 100, 'pool_size': 10})
+        self.assertEqual(transport.run_server.call_args_list[0][1], {'max_accepts': int(argv[2]), 'max_child_tasks': 100, 'pool_size': 10, 'keepalive_timeout': None, 'prefork': False, 'min_workers': None, 'max_workers': None, 'worker_idle_timeout': 60, 'max_queue': None, 'overload': 'reject', 'handover_argv': None, 'handover_timeout': 10, 'metrics_port': None, 'cache_size': 0, 'cache_bytes': 67108864, 'max_session_objects': 1000})
 
+    def test_server_keepalive_timeout(self):
+        argv = ['/srv/errand-boy/errand_boy/run.py', '--keepalive-timeout', '2.5']
+
+        with self.UNIXSocketTransport_patcher as UNIXSocketTransport:
+            transport = mock.Mock()
+
+            UNIXSocketTransport.return_value = transport
+
+            run.main(argv)
+
+        self.assertEqual(transport.run_server.call_args_list[0][1]['keepalive_timeout'], 2.5)
+
+    def test_server_prefork(self):
+        argv = ['/srv/errand-boy/errand_boy/run.py', '--prefork']
+
+        with self.UNIXSocketTransport_patcher as UNIXSocketTransport:
+            transport = mock.Mock()
+
+            UNIXSocketTransport.return_value = transport
+
+            run.main(argv)
+
+        self.assertEqual(transport.run_server.call_args_list[0][1]['prefork'], True)
+
+    def test_server_autoscale(self):
+        argv = ['/srv/errand-boy/errand_boy/run.py', '--min-workers', '2', '--max-workers', '20', '--worker-idle-timeout', '30']
+
+        with self.UNIXSocketTransport_patcher as UNIXSocketTransport:
+            transport = mock.Mock()
+
+            UNIXSocketTransport.return_value = transport
+
+            run.main(argv)
+
+        kwargs = transport.run_server.call_args_list[0][1]
+
+        self.assertEqual(kwargs['min_workers'], 2)
+        self.assertEqual(kwargs['max_workers'], 20)
+        self.assertEqual(kwargs['worker_idle_timeout'], 30)
+
+    def test_server_handover(self):
+        argv = ['/srv/errand-boy/errand_boy/run.py', '--handover', '--max-accepts', '5']
+
+        with self.UNIXSocketTransport_patcher as UNIXSocketTransport:
+            transport = mock.Mock()
+
+            UNIXSocketTransport.return_value = transport
+
+            run.main(argv)
+
+        kwargs = transport.run_server.call_args_list[0][1]
+
+        self.assertEqual(kwargs['handover_argv'], [run.sys.executable, '-m', 'errand_boy.run'] + argv[1:])
+
+    def test_server_metrics_port(self):
+        argv = ['/srv/errand-boy/errand_boy/run.py', '--metrics-port', '9100']
+
+        with self.UNIXSocketTransport_patcher as UNIXSocketTransport:
+            transport = mock.Mock()
+
+            UNIXSocketTransport.return_value = transport
+
+            run.main(argv)
+
+        self.assertEqual(transport.run_server.call_args_list[0][1]['metrics_port'], 9100)
+
+    def test_server_cache(self):
+        argv = ['/srv/errand-boy/errand_boy/run.py', '--cache-size', '100', '--cache-bytes', '1024']
+
+        with self.UNIXSocketTransport_patcher as UNIXSocketTransport:
+            transport = mock.Mock()
+
+            UNIXSocketTransport.return_value = transport
+
+            run.main(argv)
+
+        kwargs = transport.run_server.call_args_list[0][1]
+
+        self.assertEqual(kwargs['cache_size'], 100)
+        self.assertEqual(kwargs['cache_bytes'], 1024)
+
+    def test_max_session_objects(self):
+        argv = ['/srv/errand-boy/errand_boy/run.py', '--max-session-objects', '50']
+
+        with self.UNIXSocketTransport_patcher as UNIXSocketTransport:
+            transport = mock.Mock()
+
+            UNIXSocketTransport.return_value = transport
+
+            run.main(argv)
+
+        self.assertEqual(transport.run_server.call_args_list[0][1]['max_session_objects'], 50)
+
+    def test_transport_options(self):
+        argv = ['/srv/errand-boy/errand_boy/run.py', '-t', 'errand_boy.transports.tcpsocket.TCPSocketTransport',
+            '--port', '5000', '--reuse-port']
+
+        with mock.patch.object(tcpsocket, 'TCPSocketTransport', autospec=True) as TCPSocketTransport:
+            run.main(argv)
+
+        TCPSocketTransport.assert_called_once_with(port=5000, reuse_port=True)
+        self.assertEqual(TCPSocketTransport.return_value.run_server.call_count, 1)
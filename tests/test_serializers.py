@@ -0,0 +1,100 @@
+import pickle
+import unittest
+
+from errand_boy import serializers
+
+from .base import BaseTestCase
+
+
+OBJ = [('ls -al',), {'env': {'FOO': 'bar'}, 'cwd': None, 'n': -3, 'x': 1.5, 'ok': True,
+    'no': False, 'items': [b'a', u'\xe9']}]
+
+
+class SerializerTestCase(BaseTestCase):
+    def loads(self, chunks):
+        return serializers.loads(b''.join(bytes(chunk) for chunk in chunks))
+
+
+class PickleSerializerTestCase(SerializerTestCase):
+    def test_round_trip(self):
+        serializer = serializers.get_serializer('pickle')
+
+        chunks = serializer.dumps(OBJ)
+
+        self.assertEqual(chunks, [pickle.dumps(OBJ)])
+        self.assertEqual(self.loads(chunks), OBJ)
+        self.assertIs(serializers.detect(chunks[0]), serializer)
+
+
+@unittest.skipIf(pickle.HIGHEST_PROTOCOL < 5, 'pickle protocol 5 needs Python 3.8+')
+class Pickle5SerializerTestCase(SerializerTestCase):
+    def setUp(self):
+        super(Pickle5SerializerTestCase, self).setUp()
+        self.serializer = serializers.get_serializer('pickle5')
+
+    def test_round_trip(self):
+        self.assertEqual(self.loads(self.serializer.dumps(OBJ)), OBJ)
+
+    def test_out_of_band(self):
+        stdout = b'a' * serializers.OUT_OF_BAND_SIZE
+
+        chunks = self.serializer.dumps((stdout, b'', 0))
+
+        # the output is sent as it is, not copied into the pickle
+        self.assertEqual(len(chunks), 3)
+        self.assertIs(chunks[2].obj, stdout)
+        self.assertLess(len(chunks[1]), 100)
+
+        result = self.loads(chunks)
+
+        self.assertEqual(result, (stdout, b'', 0))
+        self.assertIsInstance(result[0], bytes)
+
+
+class FastSerializerTestCase(SerializerTestCase):
+    def setUp(self):
+        super(FastSerializerTestCase, self).setUp()
+        self.serializer = serializers.get_serializer('fast')
+
+    def test_round_trip(self):
+        result = self.loads(self.serializer.dumps(OBJ))
+
+        self.assertEqual(result, OBJ)
+        self.assertIsInstance(result[0], tuple)
+        self.assertIsInstance(result[1]['items'], list)
+
+    def test_large_bytes(self):
+        stdout = b'a' * serializers.OUT_OF_BAND_SIZE
+
+        chunks = self.serializer.dumps((stdout, b'', 0))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertIs(chunks[1], stdout)
+        self.assertEqual(self.loads(chunks), (stdout, b'', 0))
+
+    def test_result(self):
+        chunks = self.serializer.dumps((b'foo', b'bar', -1))
+
+        self.assertEqual(chunks[0][1:2], b'r')
+        self.assertEqual(self.loads(chunks), (b'foo', b'bar', -1))
+
+        # anything else of the same length uses the general format
+        self.assertEqual(self.loads(self.serializer.dumps((b'foo', u'bar', -1))), (b'foo', u'bar', -1))
+
+    def test_unsupported(self):
+        with self.assertRaises(TypeError):
+            self.serializer.dumps([object()])
+
+        with self.assertRaises(TypeError):
+            self.serializer.dumps(2 ** 64)
+
+    def test_unknown_tag(self):
+        with self.assertRaises(ValueError):
+            serializers.loads(serializers.FAST_MAGIC + b'z' + b'\x00' * 8)
+
+
+class GetSerializerTestCase(BaseTestCase):
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            serializers.get_serializer('foo')
+
@@ -0,0 +1,57 @@
+import os
+
+from errand_boy import serializers, shm
+
+from .base import BaseTestCase
+
+
+class SharedMemoryTestCase(BaseTestCase):
+    def read(self, body):
+        data = shm.open_body(body.fd, body.size)
+
+        try:
+            return bytes(data[:])
+        finally:
+            data.close()
+
+    def test_create(self):
+        body = shm.create([b'abc', memoryview(b'defg')])
+
+        self.assertEqual(len(body), 7)
+        self.assertEqual(self.read(body), b'abcdefg')
+
+    def test_open_body_closes_fd(self):
+        body = shm.create([b'abc'])
+
+        self.read(body)
+
+        with self.assertRaises(OSError):
+            os.fstat(body.fd)
+
+    def result_file(self, stdout):
+        fd = shm.create_file()
+
+        os.pwrite(fd, stdout, serializers.RESULT_OFFSET)
+
+        return fd
+
+    def test_result_body(self):
+        fd = self.result_file(b'foo\n' * 10)
+
+        body = shm.result_body(fd, b'bar\n', 3, 16)
+
+        self.assertIsInstance(body, shm.SharedBody)
+        self.assertEqual(serializers.loads(self.read(body)), (b'foo\n' * 10, b'bar\n', 3))
+
+    def test_result_body_small(self):
+        fd = self.result_file(b'foo\n')
+
+        self.assertEqual(shm.result_body(fd, b'', 0, 16), (b'foo\n', b'', 0))
+
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_result_body_no_output(self):
+        fd = shm.create_file()
+
+        self.assertEqual(shm.result_body(fd, b'', 1, 16), (b'', b'', 1))
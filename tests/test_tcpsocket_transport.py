@@ -0,0 +1,125 @@
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+from errand_boy.exceptions import ServerBusyError
+from errand_boy.transports import tcpsocket
+
+from .base import mock, BaseTestCase
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+
+class TCPSocketTransportTestCase(BaseTestCase):
+    def setUp(self):
+        super(TCPSocketTransportTestCase, self).setUp()
+        self.transport = tcpsocket.TCPSocketTransport(port=free_port(),
+            send_buffer_size=65536, recv_buffer_size=131072)
+
+    def test_configure_socket(self):
+        sock = mock.Mock()
+
+        self.transport.configure_socket(sock)
+
+        self.assertEqual(sock.setsockopt.call_args_list, [
+            mock.call(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            mock.call(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536),
+            mock.call(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072),
+        ])
+
+    def test_server_accept(self):
+        serversocket = self.transport.server_get_connection()
+
+        try:
+            clientsocket = self.transport.client_get_connection()
+
+            connection = self.transport.server_accept(serversocket)
+
+            self.assertTrue(connection[0].getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertTrue(clientsocket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
+            self.transport.client_close(clientsocket)
+            self.transport.server_close(connection)
+        finally:
+            serversocket.close()
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), 'SO_REUSEPORT is not supported')
+    def test_reuse_port(self):
+        self.transport.reuse_port = True
+
+        first = self.transport.server_get_connection()
+        second = self.transport.server_get_connection()
+
+        first.close()
+        second.close()
+
+    def test_reuse_port_unsupported(self):
+        with mock.patch.object(tcpsocket, 'socket', mock.Mock(spec=[])):
+            with self.assertRaises(ValueError):
+                tcpsocket.TCPSocketTransport(reuse_port=True)
+
+    def test_client_get_connection_fail_fast(self):
+        self.transport.fail_fast = True
+
+        with mock.patch.object(tcpsocket.socket, 'socket') as mock_socket:
+            mock_socket.return_value.connect.side_effect = tcpsocket.socket_timeout()
+
+            with self.assertRaises(ServerBusyError):
+                self.transport.client_get_connection()
+
+        mock_socket.return_value.settimeout.assert_called_once_with(1)
+        self.assertEqual(mock_socket.return_value.close.call_count, 1)
+
+    def test_shm_threshold(self):
+        with self.assertRaises(ValueError):
+            tcpsocket.TCPSocketTransport(shm_threshold=65536)
+
+    def test_run_cmd_stdio(self):
+        with self.assertRaises(ValueError):
+            self.transport.run_cmd('ls', stdout=1)
+
+    def test_client_get_connection_refused(self):
+        with self.assertRaises(socket.error):
+            self.transport.client_get_connection()
+
+
+class TCPSocketTransportLiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.port = free_port()
+
+        # two servers sharing the port
+        self.server_processes = [subprocess.Popen([sys.executable, '-m', 'errand_boy.run',
+            '-t', 'errand_boy.transports.tcpsocket.TCPSocketTransport',
+            '--port={}'.format(self.port), '--reuse-port', '--pool-size=2'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE) for i in range(2)]
+
+        # we need to wait for the servers to listen before we can connect.
+        time.sleep(1)
+
+    def tearDown(self):
+        for server_process in self.server_processes:
+            server_process.terminate()
+            server_process.wait()
+
+    def test_run_cmd(self):
+        transport = tcpsocket.TCPSocketTransport(port=self.port)
+
+        self.assertEqual(transport.run_cmd('echo foo'), (b'foo\n', b'', 0))
+
+        with transport.get_session() as session:
+            self.assertEqual(session.subprocess.PIPE, subprocess.PIPE)
+
+        # the workers' parents, which are the servers
+        masters = set(transport.run_cmd('ps -o ppid= -p $PPID')[0].strip() for i in range(20))
+
+        self.assertEqual(masters, set(str(server_process.pid).encode('utf-8')
+            for server_process in self.server_processes))
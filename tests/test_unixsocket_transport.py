@@ -1,12 +1,21 @@
+import errno
+import multiprocessing as real_multiprocessing
+import os
 import six
+import socket as real_socket
 import subprocess
+import unittest
 
 import errand_boy
-from errand_boy.exceptions import SessionClosedError
+from errand_boy import shm
+from errand_boy.exceptions import ProtocolError, ServerBusyError, SessionClosedError
 from errand_boy.transports import base, unixsocket
 
 from .base import mock, BaseTestCase
-from .data import get_command_data
+from .data import get_binary_run_command_data, get_command_data, get_hello_data, get_run_command_data, get_stream_command_data
+
+
+BUSY_RESPONSE = b'503 Busy\r\nContent-Length: 0\r\n'
 
 
 class UNIXSocketTransportTestCase(BaseTestCase):
@@ -29,6 +38,37 @@ class UNIXSocketTransportTestCase(BaseTestCase):
 
         self.assertEqual(connection[0].close.call_count, 1)
 
+    def test_server_recv_timeout(self):
+        connection = mock.Mock(), ''
+        connection[0].recv.side_effect = unixsocket.socket_timeout()
+
+        self.assertEqual(self.transport.server_recv(connection, 4096), b'')
+
+    def test_server_set_timeout(self):
+        connection = mock.Mock(), ''
+
+        self.transport.server_set_timeout(connection, 5)
+
+        self.assertEqual(connection[0].settimeout.call_args_list[0][0][0], 5)
+
+    def test_client_connection_alive(self):
+        connection = mock.Mock()
+        connection.recv.side_effect = unixsocket.socket_error(errno.EAGAIN, 'Resource temporarily unavailable')
+
+        self.assertTrue(self.transport.client_connection_alive(connection))
+
+    def test_client_connection_alive_hung_up(self):
+        connection = mock.Mock()
+        connection.recv.return_value = b''
+
+        self.assertFalse(self.transport.client_connection_alive(connection))
+
+    def test_client_connection_alive_closed(self):
+        connection = mock.Mock()
+        connection.recv.side_effect = unixsocket.socket_error(errno.EBADF, 'Bad file descriptor')
+
+        self.assertFalse(self.transport.client_connection_alive(connection))
+
     def test_client_close(self):
         connection = mock.Mock()
 
@@ -44,15 +84,61 @@ class UNIXSocketTransportTestCase(BaseTestCase):
 
         self.assertEqual(connection.close.call_count, 1)
 
+    @unittest.skipUnless(unixsocket.UNIXSocketTransport.passes_fds, 'descriptors can\'t be passed')
+    def test_pass_fds(self):
+        sender, receiver = real_socket.socketpair(real_socket.AF_UNIX)
+        read_fd, write_fd = os.pipe()
+
+        try:
+            self.transport._pending_fds[id(sender)] = [write_fd]
+            self.transport._fd_connections.add(id(receiver))
+
+            self.transport.client_send(sender, b'abc')
+
+            # the sender's copy is closed once sent
+            with self.assertRaises(OSError):
+                os.fstat(write_fd)
+
+            self.assertEqual(self.transport.client_recv(receiver, 16), b'abc')
+
+            passed_fd = self.transport._received_fds[id(receiver)].popleft()
+
+            os.write(passed_fd, b'def')
+            os.close(passed_fd)
+
+            self.assertEqual(os.read(read_fd, 16), b'def')
+        finally:
+            os.close(read_fd)
+            sender.close()
+            receiver.close()
+
+    @unittest.skipUnless(unixsocket.UNIXSocketTransport.passes_fds, 'descriptors can\'t be passed')
+    def test_too_many_fds(self):
+        sender, receiver = real_socket.socketpair(real_socket.AF_UNIX)
+        fds = [os.open(os.devnull, os.O_RDONLY) for i in range(shm.MAX_FDS + 1)]
+
+        try:
+            self.transport._pending_fds[id(sender)] = fds
+            self.transport._fd_connections.add(id(receiver))
+
+            self.transport.client_send(sender, b'abc')
+
+            with self.assertRaises(ProtocolError):
+                self.transport.client_recv_into(receiver, bytearray(16))
+        finally:
+            self.transport.forget_connection(receiver)
+            sender.close()
+            receiver.close()
+
 
 class UNIXSocketTransportClientSimTestCase(BaseTestCase):
     def test_run_cmd(self):
-        transport = unixsocket.UNIXSocketTransport()
+        transport = unixsocket.UNIXSocketTransport(framing='text')
 
         with self.socket_patcher as socket:
             clientsocket = mock.Mock()
 
-            cmd, stdout, stderr, returncode, requests, responses = get_command_data('ls -al')
+            cmd, stdout, stderr, returncode, requests, responses = get_run_command_data('ls -al')
 
             clientsocket.recv.side_effect = iter(responses)
 
@@ -74,9 +160,186 @@ class UNIXSocketTransportClientSimTestCase(BaseTestCase):
         self.assertEqual(result[1], stderr)
         self.assertEqual(result[2], returncode)
 
-    def test_session(self):
+    def test_stream_cmd(self):
+        transport = unixsocket.UNIXSocketTransport(framing='text')
+
+        with self.socket_patcher as socket:
+            clientsocket = mock.Mock()
+
+            cmd, stdout, stderr, returncode, requests, responses = get_stream_command_data('ls -al')
+
+            # both frames arrive in one read
+            clientsocket.recv.side_effect = iter([b''.join(responses)])
+
+            socket.socket.return_value = clientsocket
+
+            result = list(transport.stream_cmd(cmd))
+
+        self.assertEqual(clientsocket.sendall.call_count, 1)
+        self.assertEqual(clientsocket.sendall.call_args_list[0][0][0], requests[0])
+
+        self.assertEqual(result, [('stdout', stdout), ('returncode', returncode)])
+
+    def test_run_cmd_auto_single_round_trip(self):
         transport = unixsocket.UNIXSocketTransport()
 
+        with self.socket_patcher as socket:
+            clientsocket = mock.Mock()
+
+            cmd, stdout, stderr, returncode, requests, responses = get_run_command_data('ls -al')
+
+            clientsocket.recv.side_effect = iter(responses)
+
+            socket.socket.return_value = clientsocket
+
+            result = transport.run_cmd(cmd)
+
+        # an unpooled connection only carries one request, so no HELLO
+        self.assertEqual(clientsocket.sendall.call_count, 1)
+        self.assertEqual(clientsocket.sendall.call_args_list[0][0][0], requests[0])
+
+        self.assertEqual(result, (stdout, stderr, returncode))
+
+    def test_run_cmd_negotiate_binary(self):
+        transport = unixsocket.UNIXSocketTransport(client_pool_size=1)
+
+        with self.socket_patcher as socket:
+            clientsocket = mock.Mock()
+
+            hello_request, hello_response = get_hello_data('binary')
+            cmd, stdout, stderr, returncode, requests, responses = get_binary_run_command_data('ls -al')
+
+            clientsocket.recv.side_effect = iter([hello_response] + responses)
+
+            socket.socket.return_value = clientsocket
+
+            result = transport.run_cmd(cmd)
+
+        self.assertEqual(clientsocket.sendall.call_count, 2)
+        self.assertEqual(clientsocket.sendall.call_args_list[0][0][0], hello_request)
+        self.assertEqual(clientsocket.sendall.call_args_list[1][0][0], requests[0])
+
+        self.assertEqual(result, (stdout, stderr, returncode))
+        self.assertEqual(transport._binary_connections, set([id(clientsocket)]))
+
+    def test_run_cmd_negotiate_old_server(self):
+        transport = unixsocket.UNIXSocketTransport(client_pool_size=1)
+
+        with self.socket_patcher as socket:
+            clientsocket = mock.Mock()
+
+            hello_request, hello_response = get_hello_data(None)
+            cmd, stdout, stderr, returncode, requests, responses = get_run_command_data('ls -al')
+
+            clientsocket.recv.side_effect = iter([hello_response] + responses)
+
+            socket.socket.return_value = clientsocket
+
+            result = transport.run_cmd(cmd)
+
+        self.assertEqual(clientsocket.sendall.call_count, 2)
+        self.assertEqual(clientsocket.sendall.call_args_list[0][0][0], hello_request)
+        self.assertEqual(clientsocket.sendall.call_args_list[1][0][0], requests[0])
+
+        self.assertEqual(result, (stdout, stderr, returncode))
+
+    def test_run_cmd_binary(self):
+        transport = unixsocket.UNIXSocketTransport(framing='binary')
+
+        with self.socket_patcher as socket:
+            clientsocket = mock.Mock()
+
+            cmd, stdout, stderr, returncode, requests, responses = get_binary_run_command_data('ls -al')
+
+            clientsocket.recv.side_effect = iter(responses)
+
+            socket.socket.return_value = clientsocket
+
+            result = transport.run_cmd(cmd)
+
+        self.assertEqual(clientsocket.sendall.call_count, 1)
+        self.assertEqual(clientsocket.sendall.call_args_list[0][0][0], requests[0])
+
+        self.assertEqual(result, (stdout, stderr, returncode))
+
+    def test_run_cmd_pooled(self):
+        transport = unixsocket.UNIXSocketTransport(client_pool_size=1, framing='text')
+
+        with self.socket_patcher as socket:
+            clientsocket = mock.Mock()
+
+            cmd, stdout, stderr, returncode, requests, responses = get_run_command_data('ls -al')
+
+            responses = iter(responses * 2)
+
+            def recv(length, flags=0):
+                # health checks peek at an idle connection
+                if flags:
+                    raise unixsocket.socket_error(errno.EAGAIN, 'Resource temporarily unavailable')
+                return next(responses)
+
+            clientsocket.recv.side_effect = recv
+
+            socket.socket.return_value = clientsocket
+
+            results = [transport.run_cmd(cmd), transport.run_cmd(cmd)]
+
+        self.assertEqual(clientsocket.connect.call_count, 1)
+        self.assertEqual(clientsocket.close.call_count, 0)
+
+        self.assertEqual(clientsocket.sendall.call_count, 2)
+        for call in clientsocket.sendall.call_args_list:
+            self.assertEqual(call[0][0], requests[0])
+
+        for result in results:
+            self.assertEqual(result, (stdout, stderr, returncode))
+
+    def test_run_cmd_busy(self):
+        for framing in ('text', 'binary'):
+            transport = unixsocket.UNIXSocketTransport(framing=framing)
+
+            with self.socket_patcher as socket:
+                clientsocket = mock.Mock()
+                clientsocket.recv.side_effect = iter([BUSY_RESPONSE])
+
+                socket.socket.return_value = clientsocket
+
+                with self.assertRaises(ServerBusyError):
+                    transport.run_cmd('ls -al')
+
+            self.assertEqual(clientsocket.close.call_count, 1)
+
+    def test_run_cmd_busy_hung_up(self):
+        transport = unixsocket.UNIXSocketTransport(framing='text')
+
+        with self.socket_patcher as socket:
+            clientsocket = mock.Mock()
+            clientsocket.sendall.side_effect = unixsocket.socket_error(errno.EPIPE, 'Broken pipe')
+            clientsocket.recv.side_effect = iter([BUSY_RESPONSE])
+
+            socket.socket.return_value = clientsocket
+
+            with self.assertRaises(ServerBusyError):
+                transport.run_cmd('ls -al')
+
+    def test_fail_fast(self):
+        transport = unixsocket.UNIXSocketTransport(fail_fast=True)
+
+        with self.socket_patcher as socket:
+            clientsocket = mock.Mock()
+            clientsocket.connect.side_effect = unixsocket.socket_error(errno.EAGAIN, 'Resource temporarily unavailable')
+
+            socket.socket.return_value = clientsocket
+
+            with self.assertRaises(ServerBusyError):
+                transport.run_cmd('ls -al')
+
+        self.assertEqual(clientsocket.setblocking.call_args_list[0][0][0], False)
+        self.assertEqual(clientsocket.close.call_count, 1)
+
+    def test_session(self):
+        transport = unixsocket.UNIXSocketTransport(framing='text')
+
         with self.socket_patcher as socket:
             clientsocket = mock.Mock()
 
@@ -121,8 +384,7 @@ class UNIXSocketTransportServerSimTestCase(BaseTestCase):
                 self.reduce_socket_patcher as reduce_socket,\
                 self.rebuild_socket_patcher as rebuild_socket,\
                 self.multiprocessing_patcher as multiprocessing,\
-                self.subprocess_patcher as mock_subprocess,\
-                self.uuid_patcher as uuid:
+                self.subprocess_patcher as mock_subprocess:
             mock_subprocess.PIPE = subprocess.PIPE
 
             serversocket = mock.Mock()
@@ -135,8 +397,6 @@ class UNIXSocketTransportServerSimTestCase(BaseTestCase):
 
             mock_subprocess.Popen.return_value = process
 
-            uuid.side_effect = ('obj%s' % i for i in six.moves.range(1, 20))
-
             clientsocket = mock.Mock()
             clientsocket.recv.side_effect = iter(requests)
 
@@ -175,7 +435,103 @@ class UNIXSocketTransportServerSimTestCase(BaseTestCase):
         for i, response in enumerate(responses):
             self.assertEqual(clientsocket.sendall.call_args_list[i][0][0], response)
 
-    def test_max_accepts_zero(self):
+    def _run_server(self, transport, requests, stdout, stderr, returncode):
+        with self.socket_patcher as socket,\
+                self.reduce_socket_patcher as reduce_socket,\
+                self.rebuild_socket_patcher as rebuild_socket,\
+                self.multiprocessing_patcher as multiprocessing,\
+                self.subprocess_patcher as mock_subprocess:
+            mock_subprocess.PIPE = subprocess.PIPE
+
+            serversocket = mock.Mock()
+
+            process = mock.Mock()
+            process.communicate.return_value = stdout, stderr
+            process.returncode = returncode
+
+            mock_subprocess.Popen.return_value = process
+
+            clientsocket = mock.Mock()
+            clientsocket.recv.side_effect = iter(requests)
+
+            serversocket.accept.return_value = clientsocket, ''
+
+            socket.socket.return_value = serversocket
+
+            reduce_socket.return_value = (reduce_socket, ('I\'m a socket, NOT!', '', '', '',))
+            rebuild_socket.return_value = clientsocket
+
+            mock_Pool = mock.Mock()
+            mock_Pool.apply_async.side_effect = lambda f, args=(), kwargs={}: f(*args, **kwargs)
+            multiprocessing.Pool.return_value = mock_Pool
+
+            transport.run_server(max_accepts=1)
+
+        return clientsocket, mock_subprocess
+
+    def test_hello_and_binary_run(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        hello_request, hello_response = get_hello_data('binary')
+        cmd, stdout, stderr, returncode, requests, responses = get_binary_run_command_data('ls -al')
+
+        clientsocket, mock_subprocess = self._run_server(transport,
+            [hello_request] + requests, stdout, stderr, returncode)
+
+        self.assertEqual(mock_subprocess.Popen.call_count, 1)
+        self.assertEqual(mock_subprocess.Popen.call_args_list[0][0][0], cmd)
+
+        self.assertEqual(clientsocket.sendall.call_count, 2)
+        self.assertEqual(clientsocket.sendall.call_args_list[0][0][0], hello_response)
+        self.assertEqual(clientsocket.sendall.call_args_list[1][0][0], responses[0])
+
+    def test_run(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with self.socket_patcher as socket,\
+                self.reduce_socket_patcher as reduce_socket,\
+                self.rebuild_socket_patcher as rebuild_socket,\
+                self.multiprocessing_patcher as multiprocessing,\
+                self.subprocess_patcher as mock_subprocess:
+            mock_subprocess.PIPE = subprocess.PIPE
+
+            serversocket = mock.Mock()
+
+            cmd, stdout, stderr, returncode, requests, responses = get_run_command_data('ls -al')
+
+            process = mock.Mock()
+            process.communicate.return_value = stdout, stderr
+            process.returncode = returncode
+
+            mock_subprocess.Popen.return_value = process
+
+            clientsocket = mock.Mock()
+            clientsocket.recv.side_effect = iter(requests)
+
+            serversocket.accept.return_value = clientsocket, ''
+
+            socket.socket.return_value = serversocket
+
+            reduce_socket.return_value = (reduce_socket, ('I\'m a socket, NOT!', '', '', '',))
+            rebuild_socket.return_value = clientsocket
+
+            mock_Pool = mock.Mock()
+            mock_Pool.apply_async.side_effect = lambda f, args=(), kwargs={}: f(*args, **kwargs)
+            multiprocessing.Pool.return_value = mock_Pool
+
+            transport.run_server(max_accepts=1)
+
+        self.assertEqual(clientsocket.recv.call_count, len(requests))
+
+        self.assertEqual(mock_subprocess.Popen.call_count, 1)
+        self.assertEqual(mock_subprocess.Popen.call_args_list[0][0][0], cmd)
+        self.assertEqual(mock_subprocess.Popen.call_args_list[0][1]['shell'], True)
+
+        self.assertEqual(clientsocket.sendall.call_count, len(responses))
+        for i, response in enumerate(responses):
+            self.assertEqual(clientsocket.sendall.call_args_list[i][0][0], response)
+
+    def test_prefork(self):
         transport = unixsocket.UNIXSocketTransport()
 
         with self.socket_patcher as socket,\
@@ -183,12 +539,14 @@ class UNIXSocketTransportServerSimTestCase(BaseTestCase):
                 self.rebuild_socket_patcher as rebuild_socket,\
                 self.multiprocessing_patcher as multiprocessing,\
                 self.subprocess_patcher as mock_subprocess,\
-                self.uuid_patcher as uuid:
+                mock.patch.object(base, 'worker_init') as worker_init,\
+                mock.patch.object(base, 'signal'),\
+                mock.patch.object(base.time, 'sleep'):
             mock_subprocess.PIPE = subprocess.PIPE
 
             serversocket = mock.Mock()
 
-            cmd, stdout, stderr, returncode, requests, responses = get_command_data('ls -al')
+            cmd, stdout, stderr, returncode, requests, responses = get_run_command_data('ls -al')
 
             process = mock.Mock()
             process.communicate.return_value = stdout, stderr
@@ -196,7 +554,172 @@ class UNIXSocketTransportServerSimTestCase(BaseTestCase):
 
             mock_subprocess.Popen.return_value = process
 
-            uuid.side_effect = ('obj%s' % i for i in six.moves.range(1, 20))
+            clientsocket = mock.Mock()
+            clientsocket.recv.side_effect = iter(requests)
+
+            serversocket.accept.return_value = clientsocket, ''
+
+            socket.socket.return_value = serversocket
+
+            multiprocessing.Value.side_effect = real_multiprocessing.Value
+
+            # run each worker in this process as soon as it's started
+            def Process(target, args):
+                worker_process = mock.Mock()
+                worker_process.start.side_effect = lambda: target(*args)
+                worker_process.is_alive.return_value = False
+                return worker_process
+
+            multiprocessing.Process.side_effect = Process
+
+            transport.run_server(max_accepts=1, pool_size=2, prefork=True)
+
+        self.assertEqual(multiprocessing.Process.call_count, 2)
+        self.assertEqual(worker_init.call_count, 2)
+
+        self.assertEqual(serversocket.accept.call_count, 1)
+
+        self.assertEqual(reduce_socket.call_count, 0)
+        self.assertEqual(rebuild_socket.call_count, 0)
+
+        self.assertEqual(mock_subprocess.Popen.call_count, 1)
+        self.assertEqual(mock_subprocess.Popen.call_args_list[0][0][0], cmd)
+
+        self.assertEqual(clientsocket.sendall.call_count, len(responses))
+        for i, response in enumerate(responses):
+            self.assertEqual(clientsocket.sendall.call_args_list[i][0][0], response)
+
+    def _run_queued_server(self, **kwargs):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with self.socket_patcher as socket,\
+                self.reduce_socket_patcher as reduce_socket,\
+                self.multiprocessing_patcher as multiprocessing,\
+                mock.patch.object(base.time, 'sleep') as sleep:
+            serversocket = mock.Mock()
+
+            clientsockets = [mock.Mock(), mock.Mock()]
+
+            serversocket.accept.side_effect = iter([(clientsockets[0], ''),
+                (clientsockets[1], ''), KeyboardInterrupt()])
+
+            socket.socket.return_value = serversocket
+
+            reduce_socket.return_value = (reduce_socket, ('I\'m a socket, NOT!', '', '', '',))
+
+            # the first connection is served until the server has slept once
+            result = mock.Mock()
+            result.ready.side_effect = lambda: sleep.call_count > 0
+
+            mock_Pool = mock.Mock()
+            mock_Pool.apply_async.return_value = result
+            multiprocessing.Pool.return_value = mock_Pool
+
+            transport.run_server(pool_size=1, max_queue=0, **kwargs)
+
+        return clientsockets, mock_Pool, sleep
+
+    def test_max_queue_reject(self):
+        clientsockets, mock_Pool, sleep = self._run_queued_server()
+
+        self.assertEqual(mock_Pool.apply_async.call_count, 1)
+        self.assertEqual(sleep.call_count, 0)
+
+        self.assertEqual(clientsockets[1].sendall.call_args_list[0][0][0], BUSY_RESPONSE)
+        self.assertEqual(clientsockets[1].close.call_count, 1)
+
+    def test_max_queue_block(self):
+        clientsockets, mock_Pool, sleep = self._run_queued_server(overload='block')
+
+        self.assertEqual(mock_Pool.apply_async.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+
+        self.assertEqual(clientsockets[1].sendall.call_count, 0)
+
+    def test_handover(self):
+        transport = unixsocket.UNIXSocketTransport()
+        argv = ['/usr/bin/python', '-m', 'errand_boy.run', '--handover']
+
+        with self.socket_patcher as socket, \
+                self.reduce_socket_patcher as reduce_socket, \
+                self.multiprocessing_patcher as multiprocessing, \
+                mock.patch.object(base.os, 'execve') as execve, \
+                mock.patch.object(base.os, 'waitpid', return_value=(0, 0)), \
+                mock.patch.dict(base.os.environ, {base.DRAINING_PIDS_ENV: '41'}):
+            serversocket = mock.Mock()
+            serversocket.fileno.return_value = 3
+
+            serversocket.accept.return_value = mock.Mock(), ''
+
+            socket.socket.return_value = serversocket
+
+            reduce_socket.return_value = (reduce_socket, ('I\'m a socket, NOT!', '', '', '',))
+
+            process = mock.Mock()
+            process.pid = 42
+            multiprocessing.Process.return_value = process
+            multiprocessing.Value.side_effect = real_multiprocessing.Value
+
+            # nothing takes the queued connection, so this must give up
+            transport.run_server(pool_size=1, max_accepts=1, handover_argv=argv,
+                handover_timeout=0)
+
+        self.assertEqual(multiprocessing.Pool.call_count, 0)
+
+        self.assertEqual(execve.call_count, 1)
+        self.assertEqual(execve.call_args_list[0][0][:2], ('/usr/bin/python', argv))
+
+        env = execve.call_args_list[0][0][2]
+
+        self.assertEqual(env[base.LISTEN_FD_ENV], '3')
+        self.assertEqual(env[base.DRAINING_PIDS_ENV], '42,41')
+
+    def test_handover_prefork(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with self.assertRaises(ValueError):
+            transport.run_server(prefork=True, handover_argv=['python'])
+
+    def test_inherit_connection(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with self.socket_patcher as socket, \
+                self.multiprocessing_patcher, \
+                mock.patch.object(unixsocket.os, 'close') as close, \
+                mock.patch.dict(base.os.environ, {base.LISTEN_FD_ENV: '3'}):
+            serversocket = mock.Mock()
+            serversocket.accept.side_effect = KeyboardInterrupt()
+
+            socket.fromfd.return_value = serversocket
+
+            transport.run_server()
+
+            self.assertNotIn(base.LISTEN_FD_ENV, base.os.environ)
+
+        self.assertEqual(socket.fromfd.call_args_list[0][0][0], 3)
+        self.assertEqual(close.call_args_list[0][0][0], 3)
+        self.assertEqual(socket.socket.call_count, 0)
+        self.assertEqual(serversocket.accept.call_count, 1)
+
+    def test_max_accepts_zero(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with self.socket_patcher as socket, \
+                self.reduce_socket_patcher as reduce_socket, \
+                self.rebuild_socket_patcher as rebuild_socket, \
+                self.multiprocessing_patcher as multiprocessing, \
+                self.subprocess_patcher as mock_subprocess:
+            mock_subprocess.PIPE = subprocess.PIPE
+
+            serversocket = mock.Mock()
+
+            cmd, stdout, stderr, returncode, requests, responses = get_command_data('ls -al')
+
+            process = mock.Mock()
+            process.communicate.return_value = stdout, stderr
+            process.returncode = returncode
+
+            mock_subprocess.Popen.return_value = process
 
             clientsocket = mock.Mock()
             clientsocket.recv.side_effect = iter(requests)
@@ -1,23 +1,33 @@
+import os
 import six
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import unittest
+import zlib
+
+from six.moves.urllib.request import urlopen
 
 import errand_boy
+from errand_boy import serializers
 from errand_boy.constants import CRLF
-from errand_boy.exceptions import SessionClosedError
+from errand_boy.exceptions import ServerBusyError, SessionClosedError
 from errand_boy.transports import base, unixsocket
 
 from .base import BaseTestCase
 
 
-class UNIXSocketTransportLiveTestCase(unittest.TestCase):
+class LiveServerTestCase(unittest.TestCase):
+    server_args = []
+
     def setUp(self):
         print(sys.executable)
         self.server_process = subprocess.Popen(
-            sys.executable + ' -m errand_boy.run',
-            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            [sys.executable, '-m', 'errand_boy.run'] + self.server_args,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
         # we need to wait for the server to create the socket before we can
         # connect.
@@ -25,7 +35,10 @@ class UNIXSocketTransportLiveTestCase(unittest.TestCase):
 
     def tearDown(self):
         self.server_process.terminate()
+        self.server_process.wait()
+
 
+class UNIXSocketTransportLiveTestCase(LiveServerTestCase):
     def test_large_amount_of_data(self):
         """
         https://github.com/greyside/errand-boy/issues/1
@@ -67,3 +80,465 @@ class UNIXSocketTransportLiveTestCase(unittest.TestCase):
             res_returncode = process.returncode
 
         self.assertEqual(res_stdout, str_data)
+
+    def test_serializers(self):
+        for name in serializers.SERIALIZERS:
+            transport = unixsocket.UNIXSocketTransport(serializer=name)
+
+            result = transport.run_cmd(['head', '-c', '300000', '/dev/zero'], cwd='/')
+
+            self.assertEqual(result, (b'\0' * 300000, b'', 0))
+
+            # errors aren't supported by every serializer, and come back pickled
+            with self.assertRaises(OSError):
+                transport.run_cmd(['true'], cwd='/nonexistent')
+
+            with transport.get_session() as session:
+                self.assertEqual(session.subprocess.PIPE, subprocess.PIPE)
+
+    def test_run_cmd_timing(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        stdout, stderr, returncode, timing = transport.run_cmd('echo foo',
+            timing=True, request_id='abc')
+
+        self.assertEqual(stdout, b'foo\n')
+        self.assertEqual(timing.request_id, 'abc')
+        self.assertGreater(timing.execution, 0)
+        self.assertGreaterEqual(timing.total, timing.spawn + timing.execution + timing.serialize)
+
+    def test_run_cmd(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        stdout, stderr, returncode = transport.run_cmd('echo $FOO; pwd; exit 3',
+            env={'FOO': 'bar'}, cwd='/')
+
+        self.assertEqual(stdout, b'bar\n/\n')
+        self.assertEqual(stderr, b'')
+        self.assertEqual(returncode, 3)
+
+    def test_run_cmd_pooled(self):
+        transport = unixsocket.UNIXSocketTransport(client_pool_size=1)
+
+        first = transport.run_cmd('echo 1')
+        connection = transport.client_pool._idle[0][0]
+        second = transport.run_cmd('echo 2')
+
+        self.assertEqual(first[0], b'1\n')
+        self.assertEqual(second[0], b'2\n')
+        self.assertIs(transport.client_pool._idle[0][0], connection)
+
+        transport.client_pool.clear()
+
+    def test_run_cmds(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        commands = ['sleep 0.5; echo {}'.format(i) for i in six.moves.range(8)]
+        commands.append(['/nonexistent'])
+
+        started = time.time()
+
+        results = transport.run_cmds(commands, max_parallel=8, env={'FOO': 'foo'})
+
+        # they ran at once
+        self.assertLess(time.time() - started, 2)
+
+        self.assertEqual(results[:-1], [(str(i).encode('utf-8') + b'\n', b'', 0) for i in six.moves.range(8)])
+        self.assertIsInstance(results[-1], OSError)
+
+    def test_iter_cmds(self):
+        transport = unixsocket.UNIXSocketTransport(serializer='fast')
+
+        results = list(transport.iter_cmds(['sleep 0.3; echo 0', 'echo 1'], max_parallel=2))
+
+        self.assertEqual(results, [(1, (b'1\n', b'', 0)), (0, (b'0\n', b'', 0))])
+
+    def run_in_threads(self, target, count):
+        threads = [threading.Thread(target=target, args=(i,)) for i in six.moves.range(count)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_multiplexed_session(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        results = {}
+
+        with transport.get_multiplexed_session() as session:
+            def run(i):
+                results[i] = session.run_cmd('sleep 0.{}; echo {}'.format(5 - i % 5, i))
+
+            self.run_in_threads(run, 10)
+
+            connection = session._connection
+
+            chunks = list(session.stream_cmd('echo foo'))
+
+            self.assertEqual(chunks, [('stdout', b'foo\n'), ('returncode', 0)])
+            self.assertEqual(session.run_cmds(['echo 1', 'exit 2']), [(b'1\n', b'', 0), (b'', b'', 2)])
+
+            # every request shared one connection
+            self.assertTrue(connection.multiplexed)
+            self.assertIs(session._connection, connection)
+
+        self.assertEqual(results, dict((i, (str(i).encode('utf-8') + b'\n', b'', 0))
+            for i in six.moves.range(10)))
+
+    def test_multiplexed_session_slow_request(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with transport.get_multiplexed_session() as session:
+            slow = threading.Thread(target=session.run_cmd, args=('sleep 1',))
+            slow.start()
+
+            time.sleep(0.1)
+
+            started = time.time()
+
+            self.assertEqual(session.run_cmd('echo foo'), (b'foo\n', b'', 0))
+
+            # it didn't wait behind the slow one
+            self.assertLess(time.time() - started, 0.5)
+
+            slow.join()
+
+    def test_multiplexed_session_text_framing(self):
+        transport = unixsocket.UNIXSocketTransport(framing='text')
+
+        results = {}
+
+        with transport.get_multiplexed_session() as session:
+            def run(i):
+                results[i] = session.run_cmd('echo {}'.format(i))
+
+            self.run_in_threads(run, 4)
+
+            self.assertFalse(session._connection.multiplexed)
+
+        self.assertEqual(results, dict((i, (str(i).encode('utf-8') + b'\n', b'', 0))
+            for i in six.moves.range(4)))
+
+    def test_pipeline(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with transport.get_session() as session:
+            pipeline = session.pipeline()
+            subprocess = pipeline.subprocess
+
+            process = subprocess.Popen(['sh', '-c', 'cat; exit 3'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = process.communicate(b'foo')
+            returncode = process.returncode
+
+            missing = subprocess.missing(process)
+
+            stdout, stderr = pipeline.resolve(output)
+
+            self.assertEqual(stdout, b'foo')
+            self.assertEqual(pipeline.resolve(returncode), 3)
+
+            with self.assertRaises(AttributeError):
+                pipeline.resolve(missing)
+
+            # the session is still usable
+            self.assertEqual(pipeline.resolve(process).returncode, 3)
+
+    def test_binary_framing(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with transport.get_session() as session:
+            self.assertIn(id(session.connection), transport._binary_connections)
+
+            stdout, stderr, returncode = transport.send_run_request(session.connection, 'echo foo')
+
+        self.assertEqual(stdout, b'foo\n')
+
+    def test_text_framing(self):
+        transport = unixsocket.UNIXSocketTransport(framing='text')
+
+        self.assertEqual(transport.run_cmd('echo foo')[0], b'foo\n')
+
+    def test_stream_cmd(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        stdout = []
+        returncode = None
+
+        for stream, chunk in transport.stream_cmd('head -c 1000000 /dev/zero; echo bar >&2'):
+            if stream == 'stdout':
+                stdout.append(chunk)
+            elif stream == 'stderr':
+                self.assertEqual(chunk, b'bar\n')
+            else:
+                returncode = chunk
+
+        self.assertTrue(len(stdout) > 1)
+        self.assertEqual(b''.join(stdout), b'\0' * 1000000)
+        self.assertEqual(returncode, 0)
+
+
+class UNIXSocketTransportPreforkLiveTestCase(UNIXSocketTransportLiveTestCase):
+    server_args = ['--prefork', '--pool-size=2']
+
+
+class UNIXSocketTransportAutoscaleLiveTestCase(UNIXSocketTransportLiveTestCase):
+    server_args = ['--min-workers=1', '--max-workers=4']
+
+
+class UNIXSocketTransportMaxQueueLiveTestCase(LiveServerTestCase):
+    server_args = ['--pool-size=1', '--max-queue=0']
+
+    def test_busy(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with transport.get_session() as session:
+            # keep the only worker busy with this session
+            session.subprocess.PIPE
+
+            with self.assertRaises(ServerBusyError):
+                transport.run_cmd('true')
+
+
+class UNIXSocketTransportKeepaliveLiveTestCase(LiveServerTestCase):
+    server_args = ['--keepalive-timeout=1']
+
+    def test_multiplexed_session_slow_reader(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with transport.get_multiplexed_session() as session:
+            chunks = session.stream_cmd('head -c 10000000 /dev/zero')
+
+            size = len(next(chunks)[1])
+
+            # longer than the keepalive timeout, while the server is stuck
+            # sending the rest
+            time.sleep(2)
+
+            for name, value in chunks:
+                if name == 'stdout':
+                    size += len(value)
+
+            self.assertEqual(name, 'returncode')
+            self.assertEqual(value, 0)
+            self.assertEqual(size, 10000000)
+
+    def test_multiplexed_session_idle(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with transport.get_multiplexed_session() as session:
+            self.assertEqual(session.run_cmd('echo foo'), (b'foo\n', b'', 0))
+
+            connection = session._connection
+
+            # the server closes the connection in the meantime, a timeout
+            # after the request's thread is done
+            time.sleep(3)
+
+            self.assertEqual(session.run_cmd('echo bar'), (b'bar\n', b'', 0))
+            self.assertIsNot(session._connection, connection)
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class UNIXSocketTransportStatsLiveTestCase(LiveServerTestCase):
+    metrics_port = free_port()
+    server_args = ['--pool-size=3', '--metrics-port={}'.format(metrics_port)]
+
+    def test_stats(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        for i in six.moves.range(3):
+            transport.run_cmd('echo foo')
+
+        stats = transport.get_stats()
+
+        self.assertEqual(stats['workers'], 3)
+        self.assertEqual(stats['accepts'], 4)
+        # the STATS request itself is still being served, earlier
+        # connections may not have been noticed closing yet
+        self.assertGreaterEqual(stats['busy_workers'], 1)
+        self.assertEqual(stats['busy_workers'] + stats['idle_workers'], 3)
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['exec_seconds']['count'], 3)
+        self.assertEqual(stats['queue_wait_seconds']['count'], 4)
+
+        text = urlopen('http://127.0.0.1:{}/metrics'.format(self.metrics_port)).read()
+
+        self.assertIn(b'errand_boy_spawn_seconds_count 3\n', text)
+
+
+class UNIXSocketTransportHandoverLiveTestCase(UNIXSocketTransportLiveTestCase):
+    server_args = ['--handover', '--max-accepts=2', '--pool-size=2']
+
+    def test_handover(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        for i in six.moves.range(10):
+            self.assertEqual(transport.run_cmd('echo foo'), (b'foo\n', b'', 0))
+
+        # the same process is still serving
+        self.assertIsNone(self.server_process.poll())
+
+
+class UNIXSocketTransportSessionObjectsLiveTestCase(LiveServerTestCase):
+    server_args = ['--max-session-objects=2']
+
+    def test_evict(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        with transport.get_session() as session:
+            subprocess = session.subprocess
+
+            popen = subprocess.Popen
+            call = subprocess.call
+            check_call = subprocess.check_call
+
+            # the least recently used object was evicted
+            with self.assertRaises(KeyError):
+                popen(['true'])
+
+            self.assertEqual(call(['true']), 0)
+            self.assertEqual(check_call(['true']), 0)
+
+
+class UNIXSocketTransportCacheLiveTestCase(LiveServerTestCase):
+    server_args = ['--pool-size=3', '--cache-size=10']
+
+    def test_cache(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        stdout, stderr, returncode, timing = transport.run_cmd('date +%s%N', cache_ttl=60, timing=True)
+
+        self.assertEqual(timing.cache, 'miss')
+
+        stdout2, stderr2, returncode2, timing = transport.run_cmd('date +%s%N', cache_ttl=60, timing=True)
+
+        self.assertEqual(timing.cache, 'hit')
+        self.assertEqual(stdout2, stdout)
+
+        self.assertNotEqual(transport.run_cmd('date +%s%N')[0], stdout)
+
+        stats = transport.get_stats()
+
+        self.assertEqual(stats['cache_hits'], 1)
+        self.assertEqual(stats['cache_misses'], 1)
+
+    def test_coalesce(self):
+        transport = unixsocket.UNIXSocketTransport()
+
+        results = []
+
+        def run():
+            results.append(transport.run_cmd('sleep 0.5; date +%s%N', cache_ttl=60))
+
+        threads = [threading.Thread(target=run) for i in six.moves.range(3)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(transport.get_stats()['exec_seconds']['count'], 1)
+
+
+class UNIXSocketTransportPreforkCacheLiveTestCase(UNIXSocketTransportCacheLiveTestCase):
+    server_args = ['--pool-size=3', '--cache-size=10', '--prefork']
+
+
+@unittest.skipUnless(unixsocket.UNIXSocketTransport.passes_fds, 'descriptors can\'t be passed')
+class UNIXSocketTransportSharedMemoryLiveTestCase(LiveServerTestCase):
+    def test_run_cmd(self):
+        transport = unixsocket.UNIXSocketTransport(shm_threshold=65536)
+
+        stdout, stderr, returncode = transport.run_cmd('head -c 1000000 /dev/zero; echo foo >&2; exit 3')
+
+        self.assertEqual((stdout, stderr, returncode), (b'\0' * 1000000, b'foo\n', 3))
+        self.assertEqual(transport.run_cmd('echo foo'), (b'foo\n', b'', 0))
+
+    def test_session(self):
+        transport = unixsocket.UNIXSocketTransport(shm_threshold=65536)
+
+        data = b'a' * 1000000
+
+        with transport.get_session() as session:
+            foo = session.subprocess
+
+            process = foo.Popen(['cat'], stdin=foo.PIPE, stdout=foo.PIPE, stderr=foo.PIPE)
+
+            res_stdout, res_stderr = process.communicate(data)
+
+        self.assertEqual(res_stdout, data)
+        self.assertEqual(res_stderr, b'')
+
+    def test_multiplexed_session(self):
+        transport = unixsocket.UNIXSocketTransport(shm_threshold=65536)
+
+        with transport.get_multiplexed_session() as session:
+            results = session.run_cmds(['head -c 100000 /dev/zero', 'echo foo'] * 4)
+
+        self.assertEqual([result[0] for result in results], [b'\0' * 100000, b'foo\n'] * 4)
+
+
+@unittest.skipUnless(unixsocket.UNIXSocketTransport.passes_fds, 'descriptors can\'t be passed')
+class UNIXSocketTransportStdioLiveTestCase(LiveServerTestCase):
+    def test_run_cmd(self):
+        transport = unixsocket.UNIXSocketTransport(client_pool_size=1)
+
+        with tempfile.TemporaryFile() as stdin, tempfile.TemporaryFile() as stdout:
+            stdin.write(b'foo\n' * 100000)
+            stdin.seek(0)
+
+            result = transport.run_cmd('gzip -c; echo bar >&2', stdin=stdin, stdout=stdout)
+
+            self.assertEqual(result, (None, b'bar\n', 0))
+
+            stdout.seek(0)
+
+            self.assertEqual(subprocess.check_output(['gunzip', '-c'], stdin=stdout), b'foo\n' * 100000)
+
+        # the pooled connection takes descriptors without asking again
+        read_fd, write_fd = os.pipe()
+
+        try:
+            self.assertEqual(transport.run_cmd('echo foo >&2', stderr=write_fd), (b'', None, 0))
+            self.assertEqual(os.read(read_fd, 16), b'foo\n')
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+        self.assertEqual(transport.run_cmd('echo foo'), (b'foo\n', b'', 0))
+
+
+class UNIXSocketTransportInputLiveTestCase(LiveServerTestCase):
+    def test_run_cmd(self):
+        transport = unixsocket.UNIXSocketTransport(client_pool_size=1)
+
+        data = b'a,b,c\n' * 1000000
+
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+
+            stdout, stderr, returncode = transport.run_cmd('gzip -c', input=f)
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(zlib.decompress(stdout, 31), data)
+
+        # the pooled connection was asked already
+        self.assertEqual(transport.run_cmd('cat', input=(chunk for chunk in [b'foo', b'bar'])),
+            (b'foobar', b'', 0))
+        self.assertEqual(transport.run_cmd('echo foo'), (b'foo\n', b'', 0))
+
+    def test_run_cmd_text_framing(self):
+        transport = unixsocket.UNIXSocketTransport(framing='text')
+
+        self.assertEqual(transport.run_cmd('cat', input=b'foo'), (b'foo', b'', 0))